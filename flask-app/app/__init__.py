@@ -8,17 +8,29 @@ import os
 from flasgger import Swagger
 from flask import Flask, Blueprint
 
+from app.admission import init_app as init_admission
 from app.api import (
     PathParameterExampleApi,
     JsonPayloadExampleApi,
     QueryParameterExampleApi,
     MultiParameterLocationExampleApi,
     UpdateStockLevelApi,
+    UpdateStockLevelBatchApi,
     GetStockLevelReportApi,
+    GetStockLevelHistoryApi,
+    GetStockLevelMatrixApi,
 )  # Import defined endpoints created using SwaggerView class
+from app.asgi import AsyncFlask
 from app.errors import (
     errors,
 )  # import blueprint containing error handler for application
+from app.json_provider import FastJSONProvider
+from app.logs import init_app as init_logging
+from app.metrics import init_app as init_metrics
+from app.openapi import init_app as init_openapi
+from app.profiling import init_app as init_profiling
+from app.retention import init_app as init_retention
+from app.utils import configure_dedup_cache, configure_write_buffer, get_store
 
 
 def _register_endpoints(app: Flask):
@@ -35,6 +47,11 @@ def _register_endpoints(app: Flask):
         view_func=UpdateStockLevelApi.as_view("UpdateStockLevelApi"),
         methods=["POST"],
     )
+    api_v1.add_url_rule(
+        "/stocklevel/batch",
+        view_func=UpdateStockLevelBatchApi.as_view("UpdateStockLevelBatchApi"),
+        methods=["POST"],
+    )
     #############################################
     # Exercise 4: Add GetStockLevelReportApi endpoint ROUTE here
     #############################################
@@ -43,6 +60,16 @@ def _register_endpoints(app: Flask):
         view_func=GetStockLevelReportApi.as_view("GetStockLevelReportApi"),
         methods=["GET"],
     )
+    api_v1.add_url_rule(
+        "/stocklevel/history",
+        view_func=GetStockLevelHistoryApi.as_view("GetStockLevelHistoryApi"),
+        methods=["GET"],
+    )
+    api_v1.add_url_rule(
+        "/stocklevel/matrix",
+        view_func=GetStockLevelMatrixApi.as_view("GetStockLevelMatrixApi"),
+        methods=["GET"],
+    )
 
 
 
@@ -84,19 +111,22 @@ def _initialize_errorhandlers(app: Flask):
     app.register_blueprint(errors)
 
 
-def create_app() -> Flask:
+def create_app(open_store: bool = True) -> Flask:
     """
     Create an app by initializing components.
 
+    Everything built here is shared copy-on-write by the workers of gunicorn --preload (see gunicorn.conf.py), the
+    threads and connections of a worker are created lazily in the worker.
+
     args:
-        None
+        open_store (bool): open the storage backend, False for tooling which only needs the routes (build_openapi.py)
 
     returns:
         app (Flask): Flask app object
     """
 
-    # Create Flask App object
-    app = Flask(__name__)  # pylint: disable = invalid-name
+    # Create Flask App object, the stock endpoints are async views
+    app = AsyncFlask(__name__)  # pylint: disable = invalid-name
 
     # Get Flask App config based on environment variable
     config_env = "config.{}Config".format(
@@ -104,15 +134,64 @@ def create_app() -> Flask:
     )  # config object as defined in config.py
     app.config.from_object(config_env)  # Set to chosen configs
 
+    # write the app logs from a background thread, tagged with the id of the request being handled
+    init_logging(app)
+
+    # Serialize every jsonify response (endpoints & error handler) with the configured encoder
+    app.json = FastJSONProvider(app, encoder=app.config["JSON_ENCODER"])
+
     # Swagger Documentation Settings, enable autodocumentation of your APIs
     # produces swagger api webpage under {app_url}/swagger, locally: http://0.0.0.0:5000/swagger (urls can be configured on settings see: https://github.com/flasgger/flasgger
     # full json spec found under {app_url}/apispec_1.json, locally: http://0.0.0.0:5000/apispec_1.json
-    swagger = Swagger(app)  # pylint: disable = unused-variable
+    swagger = Swagger(app)
+    app.extensions["flasgger"] = swagger
 
     # Add endpoints to application object
     _register_endpoints(app)
 
+    # serve the OpenAPI documents built once (or at build time with build_openapi.py) instead of on every request
+    init_openapi(app, swagger)
+
     # initialise error handlers
     _initialize_errorhandlers(app)
 
+    # compact the reports older than STOCK_RETENTION_DAYS in the background
+    compactor = init_retention(app, get_store)
+
+    def gauges():
+        values = {
+            "stock_store_" + name: value for name, value in get_store().stats().items()
+        }
+        if compactor is not None:
+            values.update(compactor.gauges())
+        return values
+
+    # time every request and serve the prometheus metrics at /metrics, the store gauges are read on each scrape
+    init_metrics(app, gauges)
+
+    # shed requests beyond the concurrency and queue limits of their class with 503, stock submissions first
+    init_admission(
+        app,
+        {
+            "api_v1.UpdateStockLevelApi": "write",
+            "api_v1.UpdateStockLevelBatchApi": "write",
+            "api_v1.GetStockLevelReportApi": "read",
+            "api_v1.GetStockLevelHistoryApi": "read",
+            "api_v1.GetStockLevelMatrixApi": "read",
+        },
+    )
+
+    # profile requests carrying the PROFILING_TOKEN header or sampled with PROFILING_SAMPLE_RATE
+    init_profiling(app)
+
+    # open the storage backend once at startup, e.g. build the latest stock index from the history file
+    if open_store:
+        get_store()
+
+    # group-commit stock submissions in a background thread when STOCK_WRITE_BUFFER is set
+    configure_write_buffer(app.config)
+
+    # acknowledge retried stock submissions without writing them again, the keys are shared by the workers
+    configure_dedup_cache(app.config)
+
     return app
@@ -0,0 +1,193 @@
+"""
+Admission control of the requests served by a worker process
+
+Every request belongs to a class, by priority: "write" (stock submissions), "read" (stock reports) and "other" (Swagger,
+example endpoints). A class runs at most ADMISSION_LIMITS[class][0] requests at once and every class together at most
+ADMISSION_MAX_IN_FLIGHT, the rest wait in the queue of their class, which holds at most ADMISSION_LIMITS[class][1]
+requests, for at most ADMISSION_QUEUE_TIMEOUT seconds. A request of a lower class also waits while a request of a
+higher class waits for a slot it could take. Requests finding the queue of their class full, or waiting too long, are
+shed: they get a 503 response with a Retry-After header from the error handler in errors.py instead of piling up until
+the worker times out.
+
+The limits apply to the threads serving the requests of a worker, e.g. gunicorn --threads or ASGI_THREADS. /metrics is
+never shed.
+"""
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from flask import Flask, g, request
+
+from app.metrics import observe_stage, registry
+
+# class of the requests whose endpoint is not classified
+DEFAULT_CLASS = "other"
+# endpoints always admitted
+EXEMPT_ENDPOINTS = frozenset(["metrics"])
+
+
+class Overloaded(Exception):
+    """
+    Raised for a request shed by the admission control
+    """
+
+    def __init__(self, request_class: str, retry_after: int):
+        super().__init__(
+            "Too many {} requests, retry in {} seconds".format(
+                request_class, retry_after
+            )
+        )
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Concurrency and queue limits of each request class of a worker process
+    """
+
+    def __init__(
+        self,
+        limits: Dict[str, Tuple[int, int]],
+        max_in_flight: int,
+        queue_timeout: float,
+        retry_after: int,
+    ):
+        """
+        Args:
+            limits (Dict[str, Tuple[int, int]]): maximum requests running and queued of each class, highest priority
+                first
+            max_in_flight (int): maximum requests running in every class
+            queue_timeout (float): seconds a request waits in a queue before being shed
+            retry_after (int): seconds the shed clients are asked to wait before retrying
+        """
+        self.limits = limits
+        self.classes = list(limits)
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._wakeups = {name: threading.Condition(self._lock) for name in limits}
+        self._running = dict.fromkeys(limits, 0)
+        self._waiting = dict.fromkeys(limits, 0)
+        self._in_flight = 0
+
+    def _has_slot(self, request_class: str) -> bool:
+        return (
+            self._running[request_class] < self.limits[request_class][0]
+            and self._in_flight < self.max_in_flight
+        )
+
+    def _can_run(self, request_class: str) -> bool:
+        if not self._has_slot(request_class):
+            return False
+        # yield to the waiting requests of the higher classes, unless their own class is full
+        for name in self.classes:
+            if name == request_class:
+                return True
+            if self._waiting[name] and self._running[name] < self.limits[name][0]:
+                return False
+        return True
+
+    def _wake(self):
+        # the highest class with a waiting request able to run
+        for name in self.classes:
+            if self._waiting[name] and self._can_run(name):
+                self._wakeups[name].notify()
+                return
+
+    def acquire(self, request_class: str) -> float:
+        """
+        Wait for a slot of the class
+
+        Args:
+            request_class (str): class of the request, a key of limits
+
+        Returns:
+            float: seconds waited in the queue
+
+        Raises:
+            Overloaded: the queue of the class is full or the wait timed out
+        """
+        with self._lock:
+            waited = 0.0
+            # a request arriving while others wait joins the queue rather than overtaking them
+            if self._waiting[request_class] or not self._can_run(request_class):
+                if self._waiting[request_class] >= self.limits[request_class][1]:
+                    registry.inc(
+                        "stock_requests_shed_total",
+                        (("class", request_class), ("reason", "queue_full")),
+                    )
+                    raise Overloaded(request_class, self.retry_after)
+                started = time.monotonic()
+                deadline = started + self.queue_timeout
+                self._waiting[request_class] += 1
+                while not self._can_run(request_class):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._waiting[request_class] -= 1
+                        # a lower class may have been waiting for this request to leave the queue
+                        self._wake()
+                        registry.inc(
+                            "stock_requests_shed_total",
+                            (("class", request_class), ("reason", "timeout")),
+                        )
+                        raise Overloaded(request_class, self.retry_after)
+                    self._wakeups[request_class].wait(remaining)
+                self._waiting[request_class] -= 1
+                waited = time.monotonic() - started
+            self._running[request_class] += 1
+            self._in_flight += 1
+            return waited
+
+    def release(self, request_class: str):
+        """
+        Free the slot of a request admitted by acquire()
+        """
+        with self._lock:
+            self._running[request_class] -= 1
+            self._in_flight -= 1
+            self._wake()
+
+
+def init_app(app: Flask, endpoint_classes: Dict[str, str]):
+    """
+    Limit the requests of the app according to the ADMISSION_* settings of the app config
+
+    Args:
+        app (Flask): app whose requests are limited
+        endpoint_classes (Dict[str, str]): class of each endpoint, the other endpoints are in DEFAULT_CLASS
+    """
+    config = app.config
+    if not config["ADMISSION_CONTROL"]:
+        return
+    limits = config["ADMISSION_LIMITS"]
+    unknown = (set(endpoint_classes.values()) | {DEFAULT_CLASS}) - set(limits)
+    if unknown:
+        raise ValueError(
+            "ADMISSION_LIMITS has no limits for the classes {}".format(sorted(unknown))
+        )
+    controller = AdmissionController(
+        limits,
+        config["ADMISSION_MAX_IN_FLIGHT"],
+        config["ADMISSION_QUEUE_TIMEOUT"],
+        config["ADMISSION_RETRY_AFTER"],
+    )
+    app.extensions["admission"] = controller
+
+    def admit():
+        endpoint = request.endpoint
+        if endpoint is None or endpoint in EXEMPT_ENDPOINTS:
+            return  # e.g. 404, answered without work
+        request_class = endpoint_classes.get(endpoint, DEFAULT_CLASS)
+        waited = controller.acquire(request_class)
+        g.admission_class = request_class
+        if waited:
+            observe_stage("queue", waited)
+
+    def leave(error):  # pylint: disable = unused-argument
+        request_class: Optional[str] = g.pop("admission_class", None)
+        if request_class is not None:
+            controller.release(request_class)
+
+    app.before_request(admit)
+    app.teardown_request(leave)
@@ -16,9 +16,19 @@ Docs: https://github.com/flasgger/flasgger
 Example: https://github.com/flasgger/flasgger/blob/master/examples/marshmallow_apispec.py
 """
 
+import json
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
 from flasgger import SwaggerView
-from flask import Response, jsonify, request
-from webargs.flaskparser import parser
+from flask import Response, current_app, jsonify, request
+from marshmallow import ValidationError
+from app.errors import IncorrectArgument
+from app.metrics import current_endpoint, observe_stage, parser, stage
+from app.retention import hide_stale, stale_cutoff
+from app.storage import DATETIME_FORMAT
 
 from app.schema import (  # import marshmallow schema objects
     AddressExtended,
@@ -26,12 +36,38 @@ from app.schema import (  # import marshmallow schema objects
     ErrorResponseSchema,
     StandardResponseSchema,
     User,
+    StockBatchResponseSchema,
+    StockHistoryQuerySchema,
+    StockHistoryResponseSchema,
     StockItemSchema,
+    StockLevelMatrixSchema,
+    StockLevelQuerySchema,
     StockLevelReportSchema,
-    StockProductTypeSchema,
 )
 
-from app.utils import submit_stocklevel, get_stocklevel
+from app.utils import (
+    create_logger,
+    get_stocklevel,
+    get_stocklevel_as_of,
+    get_stocklevel_history,
+    get_stocklevel_matrix,
+    get_stocklevel_matrix_version,
+    get_stocklevel_nearby,
+    get_stocklevel_page,
+    get_stocklevel_version,
+    get_stocklevel_within,
+    iter_stocklevel,
+    project_stocklevels,
+    submit_stocklevel,
+    submit_stocklevels,
+    validate_stocklevel,
+    validate_stocklevels,
+)
+
+logger = create_logger(__name__)
+
+# header of a client-generated key identifying a submission and its retries
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
 
 # Define the different responses for each error response code experienced by every endpoint
 responses = {
@@ -59,24 +95,225 @@ class UpdateStockLevelApi(SwaggerView):
     # DO NOT leave blank, defining the response is ESSENTIAL for collaboration
     responses = {200: {"description": "200 OK", "schema": StandardResponseSchema}}
 
-    # use parser decorator to auto-validate parameters
-    @parser.use_args(StockItemSchema)  # default location is json body
-    def post(self, payload):
+    async def post(self):
         """
         Add a stock level of an item for a given location
+
+        Retries are safe: a submission repeating the Idempotency-Key header of an earlier one, or without the header
+        the same report, is acknowledged without recording the report again and with an Idempotent-Replayed header.
         """
+        # validated with the compiled StockItemSchema rather than @parser.use_args, see app/validation.py
+        with stage("parse"):
+            body = _read_json_object()
+        idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        try:
+            if idempotency_key is not None and not 0 < len(idempotency_key) <= 255:
+                raise ValidationError(
+                    {IDEMPOTENCY_KEY_HEADER: ["Length must be between 1 and 255."]}
+                )
+            payload = validate_stocklevel(body)
+        except ValidationError as error:
+            raise IncorrectArgument(error)
+
         # json payload (body) in "payload" object
-        print(payload)
+        logger.debug("Stock report received", extra=dict(report=payload))
 
         # Update the db with
-        success = submit_stocklevel(payload)
+        try:
+            success = await submit_stocklevel(payload, idempotency_key)
+        except ValidationError as error:
+            raise IncorrectArgument(error)
         ###
 
         # TEMP response for demo purposes
-        response = dict(status=200, message="Stock Successfully Added")
+        response = jsonify(dict(status=200, message="Stock Successfully Added"))
+        if not success:
+            response.headers["Idempotent-Replayed"] = "true"
         ###
+        return response, 200
+
+
+def _read_json_object() -> dict:
+    """
+    Read a json object request body the way @parser.use_args does
+
+    An empty body or a body which is not an object gives no fields, a body which is not json is a 400 error.
+    """
+    data = request.get_data(cache=True)
+    if not data:
+        return {}
+    try:
+        body = json.loads(data)
+    except ValueError:
+        # webargs' message, its handler aborts with a werkzeug BadRequest the error handler does not know
+        raise IncorrectArgument(
+            ValidationError({"json": ["Invalid JSON body."]}), status_code=400
+        )
+    return body if isinstance(body, dict) else {}
+
+
+def _read_batch_items() -> list:
+    """
+    Read the stock reports of a batch request body
+
+    The body is either a json array or newline delimited json (Content-Type: application/x-ndjson), which is read
+    line by line from the request stream. A ndjson line that is not valid json is kept as a string so that it is
+    reported as an invalid record instead of failing the whole batch.
+    """
+    max_records = current_app.config["STOCK_BATCH_MAX_RECORDS"]
+
+    if request.mimetype == "application/x-ndjson":
+        items = []
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(line.decode("utf-8", "replace"))
+            if len(items) > max_records:
+                break
+    else:
+        body = request.get_json(silent=True)
+        if not isinstance(body, list):
+            raise IncorrectArgument(
+                ValidationError(
+                    "Body must be a json array or application/x-ndjson stock items"
+                )
+            )
+        items = body
+
+    if len(items) > max_records:
+        raise IncorrectArgument(
+            ValidationError(
+                "A batch can contain at most {} stock items".format(max_records)
+            )
+        )
+    return items
+
+
+class UpdateStockLevelBatchApi(SwaggerView):
+    """
+    Json array / ndjson POST API
+
+    Update the stock levels of many stores in a single request
+    """
+
+    # Define swagger definitions needed for Open API Specification
+    tags = ["Stock Level"]
+    consumes = ["application/json", "application/x-ndjson"]
+    # Input Parameters
+    parameters = [
+        {
+            "name": "body",
+            "in": "body",
+            "required": True,
+            "description": "json array of stock items, or one stock item per line for application/x-ndjson",
+            "schema": {"type": "array", "items": StockItemSchema},
+        },
+    ]
+
+    # DO NOT leave blank, defining the response is ESSENTIAL for collaboration
+    responses = {
+        200: {"description": "200 OK", "schema": StockBatchResponseSchema},
+        422: {"description": "Body is not a batch", "schema": ErrorResponseSchema},
+    }
+
+    async def post(self):
+        """
+        Add the stock levels of many items and locations, invalid items are reported without failing the batch
+        """
+        with stage("parse"):
+            items = _read_batch_items()
+
+        # validate every record, then store the valid ones in one storage operation
+        records, errors = validate_stocklevels(items)
+        accepted = await submit_stocklevels(records)
+
+        response = dict(
+            status=200,
+            message="{} of {} stock items added".format(accepted, len(items)),
+            accepted=accepted,
+            rejected=len(errors),
+            errors=errors,
+        )
         return jsonify(response), 200
 
+
+def _accepts_ndjson() -> bool:
+    """
+    Check if the client prefers newline delimited json over json
+    """
+    best = request.accept_mimetypes.best_match(
+        ["application/json", "application/x-ndjson"]
+    )
+    return best == "application/x-ndjson"
+
+
+def _stream_records(records) -> Response:
+    """
+    Stream records as newline delimited json, each record is serialized as it is produced by the storage layer
+    """
+    # the response is generated after the request context is gone
+    dumps = current_app.json.dumps
+    endpoint = current_endpoint()
+
+    def generate():
+        # storage reads and serialization are interleaved, only the serialization is timed
+        serialize_seconds = 0.0
+        for record in records:
+            started = time.perf_counter()
+            line = dumps(record) + "\n"
+            serialize_seconds += time.perf_counter() - started
+            yield line
+        observe_stage("serialize", serialize_seconds, endpoint)
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+async def _not_modified(product_type: str, stale: Optional[str] = None):
+    """
+    Conditional GET of a stock level report
+
+    The ETag combines the version of the product type with the request url and Accept header, as they select the
+    representation, and the stale cutoff, as reports go stale without a new version. Returns a 304 response when the
+    client already has it, otherwise None and the validators to set on the full response.
+    """
+    version, modified = await get_stocklevel_version(product_type)
+    variant = zlib.crc32(
+        "{} {} {}".format(request.full_path, request.accept_mimetypes, stale).encode(
+            "utf-8"
+        )
+    )
+    etag = "{}-{}-{:08x}".format(product_type, version, variant)
+    if modified is not None:
+        modified = modified.replace(tzinfo=timezone.utc, microsecond=0)
+        if stale is not None:
+            # the report also changes when the cutoff moves
+            cutoff = datetime.strptime(stale, DATETIME_FORMAT)
+            modified = max(modified, cutoff.replace(tzinfo=timezone.utc))
+
+    if request.if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = bool(
+            modified is not None
+            and request.if_modified_since is not None
+            and modified <= request.if_modified_since
+        )
+
+    if not not_modified:
+        return None, etag, modified
+
+    response = Response(status=304)
+    response.set_etag(etag)
+    if modified is not None:
+        response.last_modified = modified
+    return response, etag, modified
+
+
 # EXERCISE 4:
 class GetStockLevelReportApi(SwaggerView):
     """
@@ -93,28 +330,287 @@ class GetStockLevelReportApi(SwaggerView):
             "type": "str",
             "description": "product_type",
         },
+        {
+            "name": "stream",
+            "in": "query",
+            "type": "boolean",
+            "required": False,
+            "description": "stream one stock item per line as application/x-ndjson, also chosen by the Accept header",
+        },
+        {
+            "name": "lat",
+            "in": "query",
+            "type": "number",
+            "required": False,
+            "description": "latitude of the user, used with lng & radius_km",
+        },
+        {
+            "name": "lng",
+            "in": "query",
+            "type": "number",
+            "required": False,
+            "description": "longitude of the user, used with lat & radius_km",
+        },
+        {
+            "name": "radius_km",
+            "in": "query",
+            "type": "number",
+            "required": False,
+            "description": "only return locations within this distance (km) of lat/lng, nearest first",
+        },
+        {
+            "name": "min_lat",
+            "in": "query",
+            "type": "number",
+            "required": False,
+            "description": "bounding box south edge",
+        },
+        {
+            "name": "min_lng",
+            "in": "query",
+            "type": "number",
+            "required": False,
+            "description": "bounding box west edge",
+        },
+        {
+            "name": "max_lat",
+            "in": "query",
+            "type": "number",
+            "required": False,
+            "description": "bounding box north edge",
+        },
+        {
+            "name": "max_lng",
+            "in": "query",
+            "type": "number",
+            "required": False,
+            "description": "bounding box east edge",
+        },
+        {
+            "name": "limit",
+            "in": "query",
+            "type": "integer",
+            "required": False,
+            "description": "page size, locations are ordered by geocode",
+        },
+        {
+            "name": "cursor",
+            "in": "query",
+            "type": "string",
+            "required": False,
+            "description": "next_cursor returned by the previous page",
+        },
+        {
+            "name": "as_of",
+            "in": "query",
+            "type": "string",
+            "format": "date-time",
+            "required": False,
+            "description": "report the stock levels as they were at this time (UTC)",
+        },
+        {
+            "name": "fields",
+            "in": "query",
+            "type": "string",
+            "required": False,
+            "description": "comma separated fields of each stock item to return, e.g. lat,lng,stock_level",
+        },
     ]
-    responses = {200: {"description": "200 OK", "schema": StockLevelReportSchema}}
+    produces = ["application/json", "application/x-ndjson"]
+    responses = {
+        200: {"description": "200 OK", "schema": StockLevelReportSchema},
+        304: {"description": "Not Modified, the ETag given in If-None-Match is current"},
+    }
 
     # use parser decorator to auto-validate parameters
     @parser.use_args(
-        StockProductTypeSchema, locations=["querystring"]
+        StockLevelQuerySchema, locations=["querystring"]
     )  # default location is json body, here specify a query string parameter
-    def get(self, params):
+    async def get(self, params):
         """
         GET the most recent stock level report
         """
         # query parameters in "params" object
-        print(params)
+        logger.debug("Stock level report requested", extra=dict(params=params))
         product_type = params["product_type"]
 
-        #### Get most recent stock levels for each location
-        # exercise 4: finish the get_stocklevel function
-        stock_levels = get_stocklevel(product_type)
+        # reports older than STOCK_STALE_AFTER are left out of the latest stock levels
+        stale = None
+        if "as_of" not in params:
+            stale = stale_cutoff(current_app.config["STOCK_STALE_AFTER"])
+
+        # answer polling clients without building the report when nothing changed
+        not_modified, etag, modified = await _not_modified(product_type, stale)
+        if not_modified is not None:
+            return not_modified
+
+        stream = params["stream"] or _accepts_ndjson()
+        next_cursor = None
+
+        if "radius_km" in params:
+            # only the grid cells around the user are visited
+            stock_levels = await get_stocklevel_nearby(
+                product_type, params["lat"], params["lng"], params["radius_km"]
+            )
+        elif "min_lat" in params:
+            bbox = (
+                params["min_lat"],
+                params["min_lng"],
+                params["max_lat"],
+                params["max_lng"],
+            )
+            stock_levels = await get_stocklevel_within(product_type, bbox)
+        elif "limit" in params:
+            # keyset pagination, a deep page costs the same as the first one
+            try:
+                stock_levels, next_cursor = await get_stocklevel_page(
+                    product_type, params.get("cursor"), params["limit"]
+                )
+            except ValueError:
+                raise IncorrectArgument(
+                    ValidationError({"cursor": ["Invalid cursor"]})
+                )
+        elif "as_of" in params:
+            # binary search in the time-sorted reports of each location
+            stock_levels = await get_stocklevel_as_of(product_type, params["as_of"])
+        elif stream:
+            stock_levels = iter_stocklevel(product_type)
+        else:
+            #### Get most recent stock levels for each location
+            # exercise 4: finish the get_stocklevel function
+            stock_levels = await get_stocklevel(product_type)
+
+        if stale is not None:
+            # a page may come back short, next_cursor still follows the unfiltered page
+            stock_levels = hide_stale(stock_levels, stale)
+
+        if "projection" in params:
+            stock_levels = project_stocklevels(stock_levels, params["projection"])
+
+        if stream:
+            response = _stream_records(stock_levels)
+        else:
+            body = {"data": list(stock_levels)}
+            if "limit" in params:
+                body["next_cursor"] = next_cursor
+            response = jsonify(body)
+
+        response.set_etag(etag)
+        if modified is not None:
+            response.last_modified = modified
+        return response, 200
+
+
+class GetStockLevelHistoryApi(SwaggerView):
+    """
+    GET the stock level history of a location aggregated per hour or per day
+    """
 
-        response = {"data": stock_levels.to_json(orient="records")}
+    tags = ["Stock Level"]
+    parameters = [
+        {
+            "name": "product_type",
+            "in": "query",
+            "type": "str",
+            "description": "product_type",
+        },
+        {
+            "name": "geocode",
+            "in": "query",
+            "type": "string",
+            "description": "geocode of the location",
+        },
+        {
+            "name": "start",
+            "in": "query",
+            "type": "string",
+            "format": "date-time",
+            "required": False,
+            "description": "start of the time range (UTC), defaults to 7 days before end",
+        },
+        {
+            "name": "end",
+            "in": "query",
+            "type": "string",
+            "format": "date-time",
+            "required": False,
+            "description": "end of the time range (UTC), defaults to now",
+        },
+        {
+            "name": "bucket",
+            "in": "query",
+            "type": "string",
+            "enum": ["hour", "day"],
+            "required": False,
+            "description": "size of the time buckets, defaults to hour",
+        },
+    ]
+    responses = {
+        200: {"description": "200 OK", "schema": StockHistoryResponseSchema},
+    }
 
-        return jsonify(response), 200
+    @parser.use_args(StockHistoryQuerySchema, locations=["querystring"])
+    async def get(self, params):
+        """
+        GET the hourly or daily stock level history of a location
+        """
+        history = await get_stocklevel_history(
+            params["product_type"],
+            params["geocode"],
+            params["bucket"],
+            params.get("start"),
+            params.get("end"),
+        )
+        return jsonify({"data": history}), 200
+
+
+# encoded body of the last stock level matrix served by this worker and its version, the matrix only changes with it
+_matrix_body: Tuple[Optional[int], bytes] = (None, b"")
+
+
+class GetStockLevelMatrixApi(SwaggerView):
+    """
+    GET the most recent stock level of every product type at every location
+    """
+
+    tags = ["Stock Level"]
+    produces = ["application/json"]
+    responses = {
+        200: {"description": "200 OK", "schema": StockLevelMatrixSchema},
+        304: {"description": "Not Modified, the ETag given in If-None-Match is current"},
+    }
+
+    async def get(self):
+        """
+        GET the latest stock levels of all the product types in one dense matrix
+
+        levels[row][column] is the stock level of product_types[row] at locations[column], null when the location has
+        no report for the product type. One request replaces a report request per product type.
+        """
+        global _matrix_body  # pylint: disable = global-statement
+
+        version = await get_stocklevel_matrix_version()
+        if request.if_none_match.contains(_matrix_etag(version)):
+            response = Response(status=304)
+            response.set_etag(_matrix_etag(version))
+            return response
+
+        body_version, body = _matrix_body
+        if body_version != version:
+            matrix = await get_stocklevel_matrix()
+            # the matrix may be newer than the version read above
+            version = matrix["version"]
+            with stage("serialize"):
+                body = current_app.json.dumps(matrix).encode("utf-8")
+            _matrix_body = (version, body)
+
+        response = Response(body, mimetype="application/json")
+        response.set_etag(_matrix_etag(version))
+        return response, 200
+
+
+def _matrix_etag(version: int) -> str:
+    return "matrix-{}".format(version)
 
 
 # ************************************* Example API Types *******************************************
@@ -210,8 +706,7 @@ class JsonPayloadExampleApi(SwaggerView):
         Add User to the DB
         """
         # request.json or user contains json payload User object as defined
-        print(user)
-        print(request.json)
+        logger.debug("User received", extra=dict(user=user))
 
         ####
         # INSERT YOUR API BUSINESS LOGIC HERE
@@ -255,7 +750,7 @@ class QueryParameterExampleApi(SwaggerView):
         Guess the app's favourite colour
         """
         # Query string parameters in args object
-        print(args)
+        logger.debug("Colour guess received", extra=dict(params=args))
 
         ####
         # INSERT YOUR API BUSINESS LOGIC HERE
@@ -312,10 +807,8 @@ class MultiParameterLocationExampleApi(SwaggerView):
         """
         add a user & their favourite colour
         """
-        # query string parameters in "args" object
-        print(params)
-        # json payload (body) in "payload" object
-        print(payload)
+        # query string parameters in "args" object, json payload (body) in "payload" object
+        logger.debug("User colour received", extra=dict(params=params, user=payload))
 
         ####
         # INSERT YOUR API BUSINESS LOGIC HERE
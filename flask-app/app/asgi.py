@@ -0,0 +1,205 @@
+"""
+Async serving mode of the app
+
+The stock endpoints are coroutines which await the storage backend through AsyncStockStore (see storage.py). Flask
+dispatches a request synchronously, so AsyncFlask runs the coroutine of a view on an event loop owned by the thread
+serving the request, which is cheaper than the new loop per request of Flask's default.
+
+Under an ASGI server the app is wrapped in AsgiApp:
+    uvicorn asgi:app --workers 4
+The event loop of the server reads the request bodies and writes the responses, which is where slow clients spend
+their time, and a request only holds one of the ASGI_THREADS threads of its worker while Flask handles it.
+"""
+import asyncio
+import functools
+import os
+import sys
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from typing import IO, Callable, Dict, List, Optional
+
+from flask import Flask
+
+_thread_loops = threading.local()
+
+
+def _reset_thread_loops():
+    global _thread_loops  # pylint: disable = global-statement
+
+    # a forked worker must not share the selector of its parent's loops
+    _thread_loops = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset_thread_loops)
+
+
+class _ThreadLoop:
+    """
+    Event loop owned by a thread, closed when the thread exits or at interpreter exit
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        weakref.finalize(self, self.loop.close)
+
+
+def thread_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Event loop of the current thread, created on first use and kept for the next requests served by the thread
+    """
+    owned = getattr(_thread_loops, "owned", None)
+    if owned is None:
+        owned = _thread_loops.owned = _ThreadLoop()
+    return owned.loop
+
+
+class AsyncFlask(Flask):
+    """
+    Flask app running its async views on the event loop of the thread serving the request
+    """
+
+    def async_to_sync(self, func: Callable) -> Callable:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            # called from a coroutine, e.g. the test client in an async test: fall back to asgiref
+            return super().async_to_sync(func)
+
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            return thread_event_loop().run_until_complete(func(*args, **kwargs))
+
+        return run
+
+
+def _environ(scope: Dict, body: IO[bytes]) -> Dict:
+    """
+    WSGI environ of the request of an ASGI http scope, as specified by the WSGI compatibility section of the ASGI spec
+    """
+    script_name = scope.get("root_path", "").encode("utf8").decode("latin1")
+    path_info = scope["path"].encode("utf8").decode("latin1")
+    if path_info.startswith(script_name):
+        path_info = path_info[len(script_name) :]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": script_name,
+        "PATH_INFO": path_info,
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1] or 0),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope["http_version"]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+        environ["REMOTE_PORT"] = str(scope["client"][1])
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        value = value.decode("latin1")
+        # repeated headers are joined as in a single header
+        if name in environ:
+            value = environ[name] + "," + value
+        environ[name] = value
+    return environ
+
+
+class AsgiApp:
+    """
+    ASGI application serving a Flask app with a bounded pool of threads
+
+    Request bodies are read and responses written by the event loop of the ASGI server, the Flask app runs on one of
+    the threads of the pool in the meantime. asgiref's WsgiToAsgi would run every request of the process on a single
+    thread.
+    """
+
+    def __init__(self, app: Flask, threads: Optional[int] = None):
+        self.wsgi_application = app
+        self.threads = threads or app.config["ASGI_THREADS"]
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            # nothing to start or stop, the storage backend is opened by create_app
+            while True:
+                message = await receive()
+                await send({"type": message["type"] + ".complete"})
+                if message["type"] == "lifespan.shutdown":
+                    return
+        if scope["type"] != "http":
+            raise ValueError("AsgiApp received a non-HTTP scope")
+        if self._executor is None:
+            # created in the worker process, the threads of a pool would not survive a fork
+            self._executor = ThreadPoolExecutor(
+                self.threads, thread_name_prefix="asgi"
+            )
+        loop = asyncio.get_running_loop()
+        with SpooledTemporaryFile(max_size=65536) as body:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                body.write(message.get("body", b""))
+                if not message.get("more_body"):
+                    break
+            body.seek(0)
+
+            def send_from_thread(message: Dict):
+                asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+            await loop.run_in_executor(
+                self._executor, self._run, _environ(scope, body), send_from_thread
+            )
+
+    def _run(self, environ: Dict, send: Callable[[Dict], None]):
+        """
+        Call the Flask app on a thread of the pool and send its response
+        """
+        response: List = []
+        started = False
+
+        def start_response(status: str, headers: List, exc_info=None):
+            if exc_info is not None and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [status, headers]
+
+        def start():
+            status, headers = response
+            send(
+                {
+                    "type": "http.response.start",
+                    "status": int(status.split(" ", 1)[0]),
+                    "headers": [
+                        (name.lower().encode("latin1"), value.encode("latin1"))
+                        for name, value in headers
+                    ],
+                }
+            )
+
+        result = self.wsgi_application(environ, start_response)
+        try:
+            for chunk in result:
+                if not chunk:
+                    continue
+                if not started:
+                    start()
+                    started = True
+                send({"type": "http.response.body", "body": chunk, "more_body": True})
+            if not started:
+                start()
+            send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(result, "close"):
+                result.close()
@@ -0,0 +1,271 @@
+"""
+Columnar on-disk format of the stock report history
+
+Each column is an append-only file of fixed width little endian values, read through numpy memory maps so every worker
+process shares the same pages of the page cache:
+    datetime.values                 int64 seconds since the epoch (UTC)
+    lat.values, lng.values          float64 degrees
+    stock_level.values              int8
+
+product_type, geocode, input_address and resolved_address are dictionary encoded: <column>.codes holds integer codes
+and <column>.dict holds one json encoded string per line, the code of a string being its line number.
+
+Convert an existing csv history with:
+    python convert_to_columnar.py db/stock_db.csv db/stock_db.columns
+"""
+import fcntl
+import json
+import os
+import threading
+from typing import Callable, Dict, List, Mapping, Optional, Sequence
+
+import numpy as np
+
+# dtype of every column, dictionary encoded columns hold the dtype of their codes
+NUMERIC_COLUMNS: Dict[str, np.dtype] = {
+    "datetime": np.dtype("<i8"),
+    "lat": np.dtype("<f8"),
+    "lng": np.dtype("<f8"),
+    "stock_level": np.dtype("i1"),
+}
+DICTIONARY_COLUMNS: Dict[str, np.dtype] = {
+    "product_type": np.dtype("<u2"),
+    "geocode": np.dtype("<u4"),
+    "input_address": np.dtype("<u4"),
+    "resolved_address": np.dtype("<u4"),
+}
+COLUMNS = {**NUMERIC_COLUMNS, **DICTIONARY_COLUMNS}
+
+
+class ColumnarHistory:
+    """
+    Reader and appender of a columnar history directory
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        # decoded dictionaries, loaded incrementally as other workers append to them
+        self._values: Dict[str, List[str]] = {name: [] for name in DICTIONARY_COLUMNS}
+        self._codes: Dict[str, Dict[str, int]] = {
+            name: {} for name in DICTIONARY_COLUMNS
+        }
+        self._dictionary_offsets = {name: 0 for name in DICTIONARY_COLUMNS}
+        # the dictionaries are loaded by request threads and storage threads alike
+        self._dictionary_lock = threading.Lock()
+
+        self._maps: Dict[str, np.memmap] = {}
+        self._mapped_rows = 0
+
+    def _path(self, name: str) -> str:
+        if name in DICTIONARY_COLUMNS:
+            return os.path.join(self.directory, name + ".codes")
+        return os.path.join(self.directory, name + ".values")
+
+    def _dictionary_path(self, name: str) -> str:
+        return os.path.join(self.directory, name + ".dict")
+
+    def row_count(self) -> int:
+        """
+        Number of complete rows, a row is complete once it was appended to every column
+
+        Returns:
+            int: number of rows
+        """
+        counts = []
+        for name, dtype in COLUMNS.items():
+            try:
+                counts.append(os.stat(self._path(name)).st_size // dtype.itemsize)
+            except FileNotFoundError:
+                return 0
+        return min(counts)
+
+    def columns(self, n_rows: int) -> Dict[str, np.ndarray]:
+        """
+        Memory mapped columns of the first n_rows rows
+
+        Args:
+            n_rows (int): number of rows, at most row_count()
+
+        Returns:
+            Dict[str, np.ndarray]: read only array of each column
+        """
+        if n_rows > self._mapped_rows or not self._maps:
+            # a memory map has a fixed length, map the grown files again
+            self._maps = {
+                name: np.memmap(self._path(name), dtype=dtype, mode="r")
+                for name, dtype in COLUMNS.items()
+            }
+            self._mapped_rows = n_rows
+        return {name: column[:n_rows] for name, column in self._maps.items()}
+
+    def decode(self, name: str, code: int) -> str:
+        """
+        String of a dictionary code
+
+        Args:
+            name (str): dictionary encoded column
+            code (int): code read from the column
+
+        Returns:
+            str: decoded value
+        """
+        values = self._values[name]
+        if code >= len(values):
+            # appended by another worker since the dictionary was loaded
+            self._load_dictionary(name)
+        return values[code]
+
+    def dictionary(self, name: str) -> List[str]:
+        """
+        Every string of a dictionary, indexed by code
+
+        Args:
+            name (str): dictionary encoded column
+
+        Returns:
+            List[str]: decoded values, including the ones appended by other workers
+        """
+        self._load_dictionary(name)
+        return self._values[name]
+
+    def _load_dictionary(self, name: str):
+        """
+        Read the entries appended to a dictionary file since the last load
+        """
+        with self._dictionary_lock:
+            try:
+                with open(self._dictionary_path(name), "rb") as dictionary:
+                    dictionary.seek(self._dictionary_offsets[name])
+                    data = dictionary.read()
+            except FileNotFoundError:
+                return
+
+            end = data.rfind(b"\n") + 1
+            self._dictionary_offsets[name] += end
+            values, codes = self._values[name], self._codes[name]
+            for line in data[:end].splitlines():
+                value = json.loads(line)
+                codes[value] = len(values)
+                values.append(value)
+
+    def append(
+        self,
+        columns: Mapping[str, Sequence],
+        sync: Optional[Callable[[int], None]] = None,
+    ):
+        """
+        Append rows while holding an exclusive cross-process lock
+
+        Args:
+            columns (Mapping[str, Sequence]): values of every column, strings for the dictionary encoded columns and
+                numbers (datetime in seconds since the epoch) for the others
+            sync (Optional[Callable[[int], None]]): called with the file descriptor of each written file, e.g. to fsync
+        """
+        lock_fd = os.open(
+            os.path.join(self.directory, "LOCK"), os.O_RDWR | os.O_CREAT, 0o644
+        )
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            try:
+                self._truncate_partial_rows()
+
+                encoded = {
+                    name: self._encode(name, columns[name], sync)
+                    for name in DICTIONARY_COLUMNS
+                }
+                encoded.update(
+                    (name, np.asarray(columns[name])) for name in NUMERIC_COLUMNS
+                )
+
+                for name, dtype in COLUMNS.items():
+                    data = encoded[name].astype(dtype).tobytes()
+                    self._write(self._path(name), data, sync)
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        finally:
+            os.close(lock_fd)
+
+    def _encode(
+        self, name: str, values: Sequence, sync: Optional[Callable[[int], None]]
+    ) -> np.ndarray:
+        """
+        Dictionary codes of string values, strings never seen are appended to the dictionary file
+        """
+        self._load_dictionary(name)
+        uniques, inverse = np.unique(
+            np.asarray(values, dtype=object), return_inverse=True
+        )
+
+        codes = self._codes[name]
+        new_values = [value for value in uniques if value not in codes]
+        if new_values:
+            lines = "".join(json.dumps(value) + "\n" for value in new_values)
+            self._write(self._dictionary_path(name), lines.encode("utf-8"), sync)
+            self._load_dictionary(name)
+
+        unique_codes = np.array([codes[value] for value in uniques], dtype=np.int64)
+        return unique_codes[inverse.reshape(-1)]
+
+    def _truncate_partial_rows(self):
+        """
+        Cut the columns back to the complete rows, e.g. after a crash in the middle of an append
+        """
+        n_rows = self.row_count()
+        for name, dtype in COLUMNS.items():
+            path = self._path(name)
+            if (
+                os.path.exists(path)
+                and os.stat(path).st_size != n_rows * dtype.itemsize
+            ):
+                os.truncate(path, n_rows * dtype.itemsize)
+
+    @staticmethod
+    def _write(path: str, data: bytes, sync: Optional[Callable[[int], None]]):
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+            if sync is not None:
+                sync(fd)
+        finally:
+            os.close(fd)
+
+
+def convert_csv(csv_path: str, directory: str, chunksize: int = 1000000) -> int:
+    """
+    One shot conversion of a csv history file to the columnar format
+
+    Args:
+        csv_path (str): csv history file, e.g. db/stock_db.csv
+        directory (str): columnar history directory, the rows are appended to any existing rows
+        chunksize (int): rows converted at a time
+
+    Returns:
+        int: number of rows converted
+    """
+    # only needed for the conversion, not to serve requests
+    import pandas as pd  # pylint: disable = import-outside-toplevel
+
+    from app.storage import DATETIME_FORMAT  # pylint: disable = import-outside-toplevel
+
+    history = ColumnarHistory(directory)
+    n_rows = 0
+    for chunk in pd.read_csv(
+        csv_path, chunksize=chunksize, dtype=str, keep_default_na=False
+    ):
+        timestamps = pd.to_datetime(chunk["datetime"], format=DATETIME_FORMAT)
+        columns = {
+            name: chunk[name].to_numpy(dtype=object) for name in DICTIONARY_COLUMNS
+        }
+        columns.update(
+            # seconds since the epoch
+            datetime=timestamps.to_numpy(dtype="datetime64[s]").astype(np.int64),
+            lat=chunk["lat"].astype(float).to_numpy(),
+            lng=chunk["lng"].astype(float).to_numpy(),
+            stock_level=chunk["stock_level"].astype(float).to_numpy(),
+        )
+        history.append(columns)
+        n_rows += len(chunk)
+    return n_rows
+
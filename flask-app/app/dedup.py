@@ -0,0 +1,217 @@
+"""
+Deduplication of retried stock submissions
+
+A client retrying POST /api/v1/stocklevel sends the same Idempotency-Key header, or without one the same report, which
+is then identified by a hash of its geocode, product_type, datetime and stock_level. The first submission claims its
+key in the DedupCache as pending, then marks it done once its report is written or releases it if the write fails.
+The retries finding the key done are acknowledged without writing the report again, those finding it pending are
+answered 409 so that they retry once the outcome of the first submission is known.
+
+The cache is a sqlite database file (IDEMPOTENCY_DB) shared by the workers of a host, deduplication is disabled when
+it is not set. A key expires IDEMPOTENCY_TTL seconds after its submission is written, a pending key PENDING_TTL
+seconds after its claim, e.g. when its worker was killed. Once in a while the expired keys are deleted and the oldest
+keys beyond IDEMPOTENCY_MAX_KEYS are evicted.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# claims made by a worker between two prunings of the expired and extra keys
+PRUNE_INTERVAL = 1000
+# seconds after which the claim of a submission whose write did not finish can be made again
+PENDING_TTL = 60
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+    "key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, expires REAL NOT NULL, "
+    "done INTEGER NOT NULL DEFAULT 0"
+    ") WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS idempotency_keys_expires ON idempotency_keys (expires)",
+)
+
+# a key is claimed again once expired
+_CLAIM = (
+    "INSERT INTO idempotency_keys (key, fingerprint, expires, done) VALUES (?, ?, ?, 0) "
+    "ON CONFLICT (key) DO UPDATE "
+    "SET fingerprint = excluded.fingerprint, expires = excluded.expires, done = 0 "
+    "WHERE idempotency_keys.expires <= ?"
+)
+
+
+class SubmissionInProgress(Exception):
+    """
+    Raised for a retry of a submission whose first attempt is still being written
+    """
+
+    def __init__(self, retry_after: int = 1):
+        super().__init__(
+            "The submission is in progress, retry in {} seconds".format(retry_after)
+        )
+        self.retry_after = retry_after
+
+
+def report_fingerprint(stock_data: Dict) -> str:
+    """
+    Hash of the fields identifying a stock report, two submissions of the same report have the same fingerprint
+
+    Args:
+        stock_data (Dict): report deserialized with the StockItemSchema object found in schema.py
+
+    Returns:
+        str: hex digest
+    """
+    timestamp = stock_data["datetime"]
+    if hasattr(timestamp, "isoformat"):
+        timestamp = timestamp.isoformat()
+    content = "\x1f".join(
+        [
+            stock_data["geocode"],
+            stock_data["product_type"],
+            timestamp,
+            str(stock_data["stock_level"]),
+        ]
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def submission_key(
+    stock_data: Dict, idempotency_key: Optional[str] = None
+) -> Tuple[str, str]:
+    """
+    Key of a submission in the DedupCache and the fingerprint of its report
+
+    Args:
+        stock_data (Dict): deserialized report
+        idempotency_key (Optional[str]): Idempotency-Key header of the request, the report fingerprint is the key
+            when it is not given
+
+    Returns:
+        Tuple[str, str]: key and fingerprint
+    """
+    fingerprint = report_fingerprint(stock_data)
+    if idempotency_key is None:
+        return "report:" + fingerprint, fingerprint
+    return "key:" + idempotency_key, fingerprint
+
+
+class DedupCache:
+    """
+    Keys of the submissions made in the last ttl seconds, shared by the processes opening the same sqlite file
+    """
+
+    def __init__(self, path: str, ttl: float, max_keys: int):
+        """
+        Args:
+            path (str): sqlite database file, created when missing
+            ttl (float): seconds during which a key is remembered
+            max_keys (int): keys kept once pruned, the oldest are evicted first
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._local = threading.local()
+        # connections of the parent of a forked worker
+        self._inherited: Optional[threading.local] = None
+        self._claims = 0
+        # sqlite connections must not be used across a fork, a forked worker opens its own
+        os.register_at_fork(after_in_child=self._forget_connections)
+        # create the table once, before the workers race for it
+        self._open().close()
+
+    def _forget_connections(self):
+        # the connections of the parent are kept but never used, closing them could checkpoint its database
+        self._inherited = self._local
+        self._local = threading.local()
+        self._claims = 0
+
+    def _open(self) -> sqlite3.Connection:
+        # autocommit, each statement is its own transaction
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        # readers do not block the writer, the cache may lose its last keys on a power failure
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        for statement in _SCHEMA:
+            connection.execute(statement)
+        columns = connection.execute("PRAGMA table_info(idempotency_keys)").fetchall()
+        if "done" not in [column[1] for column in columns]:
+            # created before the keys were claimed as pending, its keys were all written
+            connection.execute(
+                "ALTER TABLE idempotency_keys ADD COLUMN done INTEGER NOT NULL DEFAULT 1"
+            )
+        return connection
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Connection of the calling thread, opened on first use
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._open()
+        return connection
+
+    def claim(self, key: str, fingerprint: str) -> Optional[Tuple[str, bool]]:
+        """
+        Remember a key as pending unless a submission made it already, see complete and release
+
+        Args:
+            key (str): key of the submission, see submission_key
+            fingerprint (str): fingerprint of the submitted report
+
+        Returns:
+            Optional[Tuple[str, bool]]: None when the key is claimed by this submission, otherwise the fingerprint of
+                the report of the earlier submission and whether that submission was written
+        """
+        connection = self._connection()
+        now = time.time()
+        claimed = connection.execute(_CLAIM, (key, fingerprint, now + PENDING_TTL, now))
+        if claimed.rowcount:
+            self._claims += 1
+            if self._claims % PRUNE_INTERVAL == 0:
+                self.prune()
+            return None
+        row = connection.execute(
+            "SELECT fingerprint, done FROM idempotency_keys WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            # evicted meanwhile, the submission was made all the same
+            return fingerprint, True
+        return row[0], bool(row[1])
+
+    def complete(self, key: str):
+        """
+        Mark a claimed key done once its submission is written, its retries are then acknowledged for ttl seconds
+        """
+        self._connection().execute(
+            "UPDATE idempotency_keys SET done = 1, expires = ? WHERE key = ?",
+            (time.time() + self.ttl, key),
+        )
+
+    def release(self, key: str):
+        """
+        Forget a pending key whose submission failed, so that a retry is written
+        """
+        self._connection().execute(
+            "DELETE FROM idempotency_keys WHERE key = ? AND done = 0", (key,)
+        )
+
+    def prune(self) -> int:
+        """
+        Delete the expired keys, then the oldest keys beyond max_keys
+
+        Returns:
+            int: number of keys deleted
+        """
+        connection = self._connection()
+        deleted = connection.execute(
+            "DELETE FROM idempotency_keys WHERE expires <= ?", (time.time(),)
+        ).rowcount
+        deleted += connection.execute(
+            "DELETE FROM idempotency_keys WHERE key IN ("
+            "SELECT key FROM idempotency_keys ORDER BY expires DESC LIMIT -1 OFFSET ?"
+            ")",
+            (self.max_keys,),
+        ).rowcount
+        return deleted
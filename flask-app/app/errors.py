@@ -2,12 +2,15 @@
 Custom App Errors
 """
 from flask import Blueprint, jsonify
-from webargs.flaskparser import parser
 from werkzeug.exceptions import NotFound, MethodNotAllowed
 from marshmallow import ValidationError
+from app.admission import Overloaded
+from app.dedup import SubmissionInProgress
+from app.metrics import parser
 from app.utils import create_logger
+from app.write_buffer import WriteBufferFull
 
-logger = create_logger()
+logger = create_logger(__name__)
 
 
 class IncorrectArgument(Exception):
@@ -54,6 +57,7 @@ def handle_unexpected_error(error):
     message = [str(x) for x in error.args]
     error_type = error.__class__.__name__
     status_code = 500
+    headers = {}
 
 
 
@@ -67,6 +71,17 @@ def handle_unexpected_error(error):
         status_code = 404
     elif isinstance(error, MethodNotAllowed):
         status_code = 405
+    elif isinstance(error, WriteBufferFull):
+        # write-behind queue is full, the client should retry
+        status_code = 503
+    elif isinstance(error, Overloaded):
+        # shed by the admission control, see admission.py
+        status_code = 503
+        headers["Retry-After"] = str(error.retry_after)
+    elif isinstance(error, SubmissionInProgress):
+        # a retry of a submission still being written, see dedup.py
+        status_code = 409
+        headers["Retry-After"] = str(error.retry_after)
 
     #############################################
     # Exercise 4: add another error handler here
@@ -81,4 +96,4 @@ def handle_unexpected_error(error):
     # Format a standard Error response, corresponsing to the ErrorResponseSchema
     response = {"success": success, "error": {"type": error_type, "message": message}}
 
-    return jsonify(response), status_code
+    return jsonify(response), status_code, headers
@@ -0,0 +1,154 @@
+"""
+Geospatial helpers for the "what's in stock near me" queries
+"""
+import math
+from typing import Dict, Iterator, Optional, Tuple
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = 111.32
+
+# (min_lat, min_lng, max_lat, max_lng)
+BoundingBox = Tuple[float, float, float, float]
+
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """
+    Great circle distance between two points
+
+    Args:
+        lat1 (float): latitude of the first point in degrees
+        lng1 (float): longitude of the first point in degrees
+        lat2 (float): latitude of the second point in degrees
+        lng2 (float): longitude of the second point in degrees
+
+    Returns:
+        float: distance in km
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = (
+        math.sin(d_phi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_bbox(lat: float, lng: float, radius_km: float) -> BoundingBox:
+    """
+    Smallest bounding box containing a circle, used to prefilter a radius query
+
+    Args:
+        lat (float): latitude of the centre in degrees
+        lng (float): longitude of the centre in degrees
+        radius_km (float): radius of the circle
+
+    Returns:
+        BoundingBox: (min_lat, min_lng, max_lat, max_lng)
+    """
+    d_lat = radius_km / KM_PER_DEGREE_LAT
+    cos_lat = math.cos(math.radians(lat))
+    # close to the poles the circle spans every longitude
+    d_lng = 180.0 if cos_lat < 1e-6 else min(180.0, d_lat / cos_lat)
+    return (
+        max(-90.0, lat - d_lat),
+        max(-180.0, lng - d_lng),
+        min(90.0, lat + d_lat),
+        min(180.0, lng + d_lng),
+    )
+
+
+def record_position(record: Dict) -> Optional[Tuple[float, float]]:
+    """
+    Position of a stock report, None if its lat/lng are not numbers
+
+    Args:
+        record (Dict): stock report, lat and lng are strings as defined by the StockItemSchema object
+
+    Returns:
+        Optional[Tuple[float, float]]: (lat, lng) in degrees
+    """
+    try:
+        return float(record["lat"]), float(record["lng"])
+    except (TypeError, ValueError):
+        return None
+
+
+class SpatialGrid:
+    """
+    Uniform lat/lng grid of stock reports
+
+    A bounding box query only visits the cells overlapping the box instead of every report.
+    """
+
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        # cell -> key -> (lat, lng, report), the position is parsed once when the report is added
+        self._cells: Dict[Tuple[int, int], Dict[str, Tuple[float, float, Dict]]] = {}
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_size), math.floor(lng / self.cell_size)
+
+    def add(self, key: str, record: Dict):
+        """
+        Add a report to the cell of its position
+
+        Args:
+            key (str): unique key of the report in the grid, e.g. its geocode
+            record (Dict): stock report
+        """
+        position = record_position(record)
+        if position is not None:
+            self._cells.setdefault(self._cell(*position), {})[key] = (*position, record)
+
+    def remove(self, key: str, record: Dict):
+        """
+        Remove a report previously added with add()
+
+        Args:
+            key (str): unique key of the report in the grid
+            record (Dict): stock report
+        """
+        position = record_position(record)
+        if position is None:
+            return
+        cell = self._cell(*position)
+        reports = self._cells.get(cell)
+        if reports is not None:
+            reports.pop(key, None)
+            if not reports:
+                del self._cells[cell]
+
+    def within(self, bbox: BoundingBox) -> Iterator[Dict]:
+        """
+        Iterate over the reports inside a bounding box
+
+        Args:
+            bbox (BoundingBox): (min_lat, min_lng, max_lat, max_lng)
+
+        Returns:
+            Iterator[Dict]: stock reports
+        """
+        min_lat, min_lng, max_lat, max_lng = bbox
+        low_row, low_col = self._cell(min_lat, min_lng)
+        high_row, high_col = self._cell(max_lat, max_lng)
+
+        # visit the overlapping cells, or every occupied cell when that is cheaper
+        n_cells = (high_row - low_row + 1) * (high_col - low_col + 1)
+        if n_cells <= len(self._cells):
+            cells = (
+                self._cells.get((row, col), {})
+                for row in range(low_row, high_row + 1)
+                for col in range(low_col, high_col + 1)
+            )
+        else:
+            cells = (
+                reports
+                for (row, col), reports in list(self._cells.items())
+                if low_row <= row <= high_row and low_col <= col <= high_col
+            )
+
+        for reports in cells:
+            for lat, lng, record in list(reports.values()):
+                if min_lat <= lat <= max_lat and min_lng <= lng <= max_lng:
+                    yield record
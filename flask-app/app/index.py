@@ -0,0 +1,958 @@
+"""
+In-process indexes over the stock report history
+
+The history is append only, so a storage backend only has to remember how far into it an index has read. Every worker
+process keeps its own index and catches up on reports appended by other workers by reading the new tail of the history.
+"""
+import bisect
+import csv
+import io
+import os
+from datetime import datetime, timezone
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from app.geo import BoundingBox, SpatialGrid
+
+if TYPE_CHECKING:
+    # numpy is only imported once the arrays of the timeline or the rollups are needed
+    import numpy as np
+
+# bytes of the history file read at most at a time, so that reading a large history holds a part of its reports
+READ_BYTES = 16 << 20
+
+# the numpy arrays of the timeline and the rollups are sorted by keys made of a location id shifted by this many bits
+# plus a datetime or a bucket number
+LOCATION_SHIFT = 32
+KEY_MASK = (1 << LOCATION_SHIFT) - 1
+
+
+def parse_stock_record(row: Dict) -> Dict:
+    """
+    Normalise a raw history row to the types of the StockItemSchema object found in schema.py
+
+    Args:
+        row (Dict): row read from the history file, all values are strings
+
+    Returns:
+        Dict: stock report with an int stock_level
+    """
+    record = dict(row)
+    # old rows were written by pandas and hold the stock level as a float e.g. "2.0"
+    record["stock_level"] = int(float(record["stock_level"]))
+    return record
+
+
+class LatestStockIndex:
+    """
+    Index holding only the newest report for each (product_type, geocode) pair
+
+    Reports are compared on their datetime string, which sorts chronologically as it is written in
+    '%Y-%m-%dT%H:%M:%Sz' format.
+    """
+
+    def __init__(self, cell_size: float = 0.05):
+        self.cell_size = cell_size
+        self._latest: Dict[str, Dict[str, Dict]] = {}
+        # spatial grid over the latest reports of each product type
+        self._grids: Dict[str, SpatialGrid] = {}
+        # sorted geocodes of each product type, the stable ordering key of paginated reports
+        self._geocodes: Dict[str, List[str]] = {}
+        # number of reports read and newest report datetime of each product type
+        self._versions: Dict[str, int] = {}
+        self._modified: Dict[str, str] = {}
+        # dense product type x location matrix of the latest stock levels, updated in place by every placed report
+        self._locations: List[str] = []  # sorted geocodes of every product type
+        self._levels: Dict[str, List[Optional[int]]] = {}
+        self._matrix: Optional[Dict] = None  # last snapshot of the matrix
+
+    def add(self, record: Dict) -> bool:
+        """
+        Add a report to the index, older reports for the same location are ignored
+
+        Args:
+            record (Dict): normalised stock report
+
+        Returns:
+            bool: whether the report is now the latest of its location
+        """
+        self.count(record["product_type"], 1, record["datetime"])
+        return self.place(record)
+
+    def count(self, product_type: str, n_reports: int, newest: str):
+        """
+        Count reports read for a product type without placing them, see add()
+
+        Every worker reads the same history, so they all agree on the resulting version.
+
+        Args:
+            product_type (str): one of the given product types
+            n_reports (int): number of reports read
+            newest (str): datetime of the newest of these reports
+        """
+        self._versions[product_type] = self._versions.get(product_type, 0) + n_reports
+        if newest > self._modified.get(product_type, ""):
+            self._modified[product_type] = newest
+
+    def place(self, record: Dict) -> bool:
+        """
+        Make a report the latest of its location unless a newer one is already indexed, see add()
+
+        Args:
+            record (Dict): normalised stock report
+
+        Returns:
+            bool: whether the report is now the latest of its location
+        """
+        product_type = record["product_type"]
+        locations = self._latest.setdefault(product_type, {})
+        current = locations.get(record["geocode"])
+        if current is None or record["datetime"] >= current["datetime"]:
+            locations[record["geocode"]] = record
+            if current is None:
+                bisect.insort(
+                    self._geocodes.setdefault(record["product_type"], []),
+                    record["geocode"],
+                )
+
+            grid = self._grids.get(record["product_type"])
+            if grid is None:
+                grid = self._grids[record["product_type"]] = SpatialGrid(
+                    self.cell_size
+                )
+            if current is not None:
+                grid.remove(record["geocode"], current)
+            grid.add(record["geocode"], record)
+            self._set_level(product_type, record["geocode"], record["stock_level"])
+            return True
+        return False
+
+    def _set_level(self, product_type: str, geocode: str, stock_level: int):
+        """
+        Set a cell of the matrix, a new location inserts a column in every row
+        """
+        locations = self._locations
+        column = bisect.bisect_left(locations, geocode)
+        if column == len(locations) or locations[column] != geocode:
+            locations.insert(column, geocode)
+            for levels in self._levels.values():
+                levels.insert(column, None)
+        row = self._levels.get(product_type)
+        if row is None:
+            row = self._levels[product_type] = [None] * len(locations)
+        row[column] = stock_level
+
+    def version(self, product_type: str) -> Tuple[int, Optional[str]]:
+        """
+        Version of the reports of a product type
+
+        Args:
+            product_type (str): one of the given product types
+
+        Returns:
+            Tuple[int, Optional[str]]: number of reports read for the product type, increases with every report, and
+                the datetime of its newest report
+        """
+        return self._versions.get(product_type, 0), self._modified.get(product_type)
+
+    def counts(self) -> Tuple[int, int]:
+        """
+        Size of the index
+
+        Returns:
+            Tuple[int, int]: number of reports read and number of (product_type, geocode) locations
+        """
+        # snapshots of the values, a refresh in another thread may add a product type meanwhile
+        return (
+            sum(list(self._versions.values())),
+            sum(len(locations) for locations in list(self._latest.values())),
+        )
+
+    def latest(self, product_type: str) -> List[Dict]:
+        """
+        Get the newest report of every location for a product type
+
+        Args:
+            product_type (str): one of the given product types
+
+        Returns:
+            List[Dict]: stock reports, most recent first
+        """
+        records = list(self._latest.get(product_type, {}).values())
+        records.sort(key=lambda record: record["datetime"], reverse=True)
+        return records
+
+    def iter_latest(self, product_type: str) -> Iterator[Dict]:
+        """
+        Iterate over the newest report of every location for a product type, unsorted
+
+        Args:
+            product_type (str): one of the given product types
+
+        Returns:
+            Iterator[Dict]: stock reports
+        """
+        # iterate over a snapshot of the references, the index may be refreshed by another thread meanwhile
+        return iter(list(self._latest.get(product_type, {}).values()))
+
+    def page(self, product_type: str, after: Optional[str], limit: int) -> List[Dict]:
+        """
+        Get the newest reports of a product type ordered by geocode, starting after a given geocode
+
+        Args:
+            product_type (str): one of the given product types
+            after (Optional[str]): last geocode of the previous page, None for the first page
+            limit (int): maximum number of reports
+
+        Returns:
+            List[Dict]: stock reports
+        """
+        geocodes = self._geocodes.get(product_type, [])
+        locations = self._latest.get(product_type, {})
+        start = 0 if after is None else bisect.bisect_right(geocodes, after)
+        return [locations[geocode] for geocode in geocodes[start : start + limit]]
+
+    def within(self, product_type: str, bbox: BoundingBox) -> List[Dict]:
+        """
+        Get the newest report of every location of a product type inside a bounding box
+
+        Args:
+            product_type (str): one of the given product types
+            bbox (BoundingBox): (min_lat, min_lng, max_lat, max_lng)
+
+        Returns:
+            List[Dict]: stock reports
+        """
+        grid = self._grids.get(product_type)
+        if grid is None:
+            return []
+        return list(grid.within(bbox))
+
+    def matrix(self, product_types: List[str]) -> Dict:
+        """
+        Snapshot of the latest stock level of every product type at every location
+
+        The snapshot is copied from the matrix once per version and shared by the callers until reports are read, it
+        must not be modified. Call with the index locked, the matrix is updated in place.
+
+        Args:
+            product_types (List[str]): product type of each row
+
+        Returns:
+            Dict: version (number of reports read), product_types, locations (sorted geocodes) and levels, one row per
+                product type with a stock level or None for each location
+        """
+        version = self.counts()[0]
+        snapshot = self._matrix
+        if (
+            snapshot is None
+            or snapshot["version"] != version
+            or snapshot["product_types"] != product_types
+        ):
+            empty = [None] * len(self._locations)
+            snapshot = self._matrix = dict(
+                version=version,
+                product_types=list(product_types),
+                locations=list(self._locations),
+                levels=[
+                    list(self._levels.get(product_type, empty))
+                    for product_type in product_types
+                ],
+            )
+        return snapshot
+
+    def reset(self):
+        """
+        Forget every report, e.g. before reading a replaced history from the start
+        """
+        self._latest = {}
+        self._grids = {}
+        self._geocodes = {}
+        self._versions = {}
+        self._modified = {}
+        self._locations = []
+        self._levels = {}
+        self._matrix = None
+
+
+class CsvHistoryTail:
+    """
+    Reader of the reports appended to a csv history file since the last read
+
+    The file read stays open, so that reports can be read again from their offsets even once the file is replaced.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._columns: Optional[List[str]] = None
+        self._offset = 0  # bytes of the history file consumed so far
+        self._file: Optional[BinaryIO] = None
+
+    def replaced(self) -> bool:
+        """
+        Whether the file was replaced or truncated since the last read, the next read starts from the start
+        """
+        if self._file is None:
+            return False
+        try:
+            stat = os.stat(self.filepath)
+        except FileNotFoundError:
+            return False
+        opened = os.fstat(self._file.fileno())
+        return (stat.st_dev, stat.st_ino) != (
+            opened.st_dev,
+            opened.st_ino,
+        ) or stat.st_size < self._offset
+
+    def read(self, limit: int = READ_BYTES) -> Tuple[bool, List[Dict], List[int]]:
+        """
+        Read the reports appended to the history file since the last read
+
+        The file is read from the start if it was replaced or truncated.
+
+        Args:
+            limit (int): bytes to read at most, the rest is left to the next read
+
+        Returns:
+            Tuple[bool, List[Dict], List[int]]: whether the file was read from the start, then the new normalised
+                reports and the offset of each in the file
+        """
+        restarted = False
+        if self._file is None or self.replaced():
+            try:
+                history = open(self.filepath, "rb")
+            except FileNotFoundError:
+                return False, [], []
+            # the previous file is closed once no reader of its reports holds it
+            restarted = self._file is not None
+            self._file, self._columns, self._offset = history, None, 0
+
+        fileno = self._file.fileno()
+        available = os.fstat(fileno).st_size - self._offset
+        while True:
+            data = os.pread(fileno, min(available, limit), self._offset)
+            # only consume complete lines, a write from another worker may still be in flight
+            end = data.rfind(b"\n") + 1
+            if end or len(data) < limit:
+                break
+            limit *= 2  # a line longer than limit
+        if end == 0:
+            return restarted, [], []
+        records, offsets = self._parse(data[:end], self._offset)
+        self._offset += end
+        return restarted, records, offsets
+
+    def _parse(self, data: bytes, offset: int) -> Tuple[List[Dict], List[int]]:
+        """
+        Parse csv lines of the history file starting at offset, the first line read from the file is its header
+        """
+        starts: List[int] = []  # offset of each line taken by the csv reader
+
+        def lines() -> Iterator[str]:
+            position = offset
+            for line in io.BytesIO(data):
+                starts.append(position)
+                position += len(line)
+                yield line.decode("utf-8")
+
+        reader = csv.reader(lines())
+        columns = self._columns
+        if columns is None:
+            # data holds at least one complete line
+            columns = self._columns = next(reader)
+        records, offsets = [], []
+        first_line = len(starts)
+        for values in reader:
+            if values:
+                records.append(parse_stock_record(dict(zip(columns, values))))
+                # a quoted value may span lines, a report starts at the first line of its values
+                offsets.append(starts[first_line])
+            first_line = len(starts)
+        return records, offsets
+
+    def reader(self) -> Callable[[List[int]], List[Dict]]:
+        """
+        Function reading again the reports at offsets returned by read(), from the file read so far even once it is
+        replaced
+        """
+        history, columns = self._file, self._columns
+        if history is None or columns is None:
+            # nothing was read yet, so there is no report to read again
+            return lambda offsets: []
+
+        def read_reports(offsets: List[int]) -> List[Dict]:
+            records = []
+            for offset in offsets:
+                data, end = b"", 0
+                while not end:
+                    block = os.pread(history.fileno(), 512, offset + len(data))
+                    if not block:
+                        break
+                    data += block
+                    end = _record_end(data)
+                values = next(csv.reader([data[: end or len(data)].decode("utf-8")]))
+                records.append(parse_stock_record(dict(zip(columns, values))))
+            return records
+
+        return read_reports
+
+
+def _record_end(data: bytes) -> int:
+    """
+    Length of the first csv record of data including its line terminator, 0 if data holds no complete record
+    """
+    newline = data.find(b"\n")
+    # a newline inside a quoted value is preceded by an odd number of quotes
+    while newline >= 0 and data.count(b'"', 0, newline) % 2:
+        newline = data.find(b"\n", newline + 1)
+    return newline + 1
+
+
+# reports added one at a time are folded into the numpy arrays of the timeline past this many
+FOLD_REPORTS = 10000
+
+
+class StockTimeline:
+    """
+    Time-sorted reports of each (product_type, geocode) pair, for point-in-time queries
+
+    A report is referenced by an integer the storage backend reads it back from, e.g. its row or its offset in the
+    history. The references live in a numpy array sorted by location then datetime, so a report costs 16 bytes and
+    as_of() searches every location of a product type with one np.searchsorted. The reports added one at a time go
+    to per-location lists, folded into the arrays once they hold FOLD_REPORTS reports.
+    """
+
+    def __init__(self):
+        # (product_type, geocode) -> location id, and the location ids of each product type
+        self._location_ids: Dict[Tuple[str, str], int] = {}
+        self._product_locations: Dict[str, List[int]] = {}
+        self._product_arrays: Dict[str, "np.ndarray"] = {}
+        # sorted keys (location id << LOCATION_SHIFT | report datetime) and the reference of each key
+        self._sorted: Optional[Tuple["np.ndarray", "np.ndarray"]] = None
+        # product_type -> location id -> (sorted report datetimes, references) of the reports not folded yet
+        self._pending: Dict[str, Dict[int, Tuple[List[int], List[int]]]] = {}
+        self._n_pending = 0
+
+    def _location_id(self, product_type: str, geocode: str) -> int:
+        location = (product_type, geocode)
+        location_id = self._location_ids.get(location)
+        if location_id is None:
+            location_id = self._location_ids[location] = len(self._location_ids)
+            self._product_locations.setdefault(product_type, []).append(location_id)
+        return location_id
+
+    def add(self, product_type: str, geocode: str, timestamp: int, reference: int):
+        """
+        Add a report to the timeline of its location
+
+        Args:
+            product_type (str): one of the given product types
+            geocode (str): geocode of the location
+            timestamp (int): datetime of the report in seconds since the epoch
+            reference (int): reference to the report returned by as_of()
+        """
+        times, references = self._pending.setdefault(product_type, {}).setdefault(
+            self._location_id(product_type, geocode), ([], [])
+        )
+        # a late report goes after the reports with the same datetime so it wins ties like in LatestStockIndex
+        position = bisect.bisect_right(times, timestamp)
+        times.insert(position, timestamp)
+        references.insert(position, reference)
+        self._n_pending += 1
+        if self._n_pending >= FOLD_REPORTS:
+            self._fold_pending()
+
+    def add_many(
+        self,
+        locations: List[Tuple[str, str]],
+        location_index: "np.ndarray",
+        timestamps: "np.ndarray",
+        references: "np.ndarray",
+    ):
+        """
+        Add many reports with vectorised operations, e.g. when reading the history at startup
+
+        Args:
+            locations (List[Tuple[str, str]]): distinct (product_type, geocode) pairs of the reports
+            location_index (np.ndarray): position in locations of the pair of each report
+            timestamps (np.ndarray): datetime of each report in seconds since the epoch
+            references (np.ndarray): reference to each report, a later one wins the ties of its location
+        """
+        import numpy as np  # pylint: disable = import-outside-toplevel
+
+        # the reports added so far lose the ties
+        self._fold_pending()
+        location_ids = np.array(
+            [self._location_id(*location) for location in locations], dtype=np.int64
+        )
+        keys = (
+            location_ids[np.asarray(location_index, dtype=np.int64)] << LOCATION_SHIFT
+        ) + np.asarray(timestamps, dtype=np.int64)
+        self._fold(keys, np.asarray(references, dtype=np.int64))
+
+    def _fold_pending(self):
+        """
+        Move the reports added one at a time into the numpy arrays
+        """
+        if not self._pending and self._sorted is not None:
+            return
+        import numpy as np  # pylint: disable = import-outside-toplevel
+
+        keys: List[int] = []
+        references: List[int] = []
+        for locations in self._pending.values():
+            for location_id, (times, location_references) in locations.items():
+                keys.extend((location_id << LOCATION_SHIFT) + time for time in times)
+                references.extend(location_references)
+        self._fold(np.array(keys, dtype=np.int64), np.array(references, dtype=np.int64))
+        self._pending.clear()
+        self._n_pending = 0
+
+    def _fold(self, keys: "np.ndarray", references: "np.ndarray"):
+        """
+        Insert reports into new arrays, so that a reader of the current ones is not disturbed, after the reports with
+        the same key
+        """
+        import numpy as np  # pylint: disable = import-outside-toplevel
+
+        order = np.argsort(keys, kind="stable")
+        keys, references = keys[order], references[order]
+        if self._sorted is not None:
+            current_keys, current_references = self._sorted
+            positions = current_keys.searchsorted(keys, side="right")
+            keys = np.insert(current_keys, positions, keys)
+            references = np.insert(current_references, positions, references)
+        self._sorted = (keys, references)
+
+    def as_of(self, product_type: str, timestamp: int) -> List[int]:
+        """
+        Get the newest report of every location of a product type at a point in time
+
+        Args:
+            product_type (str): one of the given product types
+            timestamp (int): point in time in seconds since the epoch, reports at that exact time are included
+
+        Returns:
+            List[int]: references to the reports, one per location which had a report at that time
+        """
+        location_ids = self._product_locations.get(product_type)
+        if not location_ids or timestamp < 0:
+            return []
+
+        found: Dict[int, Tuple[int, int]] = {}
+        if self._sorted is not None:
+            import numpy as np  # pylint: disable = import-outside-toplevel
+
+            ids = self._product_arrays.get(product_type)
+            if ids is None or len(ids) != len(location_ids):
+                ids = self._product_arrays[product_type] = (
+                    np.array(location_ids, dtype=np.int64) << LOCATION_SHIFT
+                )
+            keys, all_references = self._sorted
+            # the key after the last report of each location at that time, and after its reports
+            ends = keys.searchsorted(ids + min(timestamp, KEY_MASK), side="right")
+            has_report = ends > keys.searchsorted(ids)
+            positions = ends[has_report] - 1
+            references = all_references[positions]
+            pending = self._pending.get(product_type)
+            if not pending:
+                return references.tolist()
+            found = dict(
+                zip(
+                    (ids[has_report] >> LOCATION_SHIFT).tolist(),
+                    zip((keys[positions] & KEY_MASK).tolist(), references.tolist()),
+                )
+            )
+
+        for location_id, (times, location_references) in self._pending.get(
+            product_type, {}
+        ).items():
+            position = bisect.bisect_right(times, timestamp)
+            if position and times[position - 1] >= found.get(location_id, (-1,))[0]:
+                found[location_id] = (
+                    times[position - 1],
+                    location_references[position - 1],
+                )
+        return [reference for _, reference in found.values()]
+
+    def reset(self):
+        """
+        Forget every report
+        """
+        self._location_ids.clear()
+        self._product_locations.clear()
+        self._product_arrays.clear()
+        self._sorted = None
+        self._pending.clear()
+        self._n_pending = 0
+
+
+# size in seconds of the time buckets of the rollups
+BUCKET_SECONDS = {"hour": 3600, "day": 86400}
+
+# a refresh reading at least this many reports adds them to the rollups in bulk instead of one report at a time
+BACKFILL_MIN_ROWS = 10000
+
+# buckets updated one report at a time are folded into the numpy arrays of the rollups past this many
+FOLD_BUCKETS = 10000
+
+# dtypes of the numpy arrays of the aggregates
+AGGREGATE_DTYPES = ("int32", "int16", "int16", "int64", "int64", "int16")
+
+
+def _combine(current: List, aggregates: List):
+    """
+    Combine aggregates into the aggregates of a bucket, the newer last report wins ties
+    """
+    current[0] += aggregates[0]
+    current[1] = min(current[1], aggregates[1])
+    current[2] = max(current[2], aggregates[2])
+    current[3] += aggregates[3]
+    if aggregates[4] >= current[4]:
+        current[4], current[5] = aggregates[4], aggregates[5]
+
+
+class StockRollups:
+    """
+    Aggregates of the stock level of each (product_type, geocode) pair per hour and per day
+
+    A bucket holds [count, min, max, sum, datetime of the last report, stock level of the last report]. The buckets
+    live in numpy arrays sorted by location then start, filled with vectorised operations by add_many() when reading
+    the history, so a bucket costs 34 bytes and the arrays built by the gunicorn master are shared by its workers. The
+    reports added one at a time update dicts, folded into the arrays once they hold FOLD_BUCKETS buckets. numpy is
+    only loaded once arrays are needed.
+    """
+
+    def __init__(self):
+        # (product_type, geocode) -> location id, and the location of each id
+        self._location_ids: Dict[Tuple[str, str], int] = {}
+        self._locations: List[Tuple[str, str]] = []
+        # bucket size -> sorted keys (location id << LOCATION_SHIFT | start // bucket seconds) and aggregate columns
+        self._arrays: Dict[str, Tuple["np.ndarray", List["np.ndarray"]]] = {}
+        # location id -> bucket size -> bucket start (seconds since the epoch) -> aggregates, not folded yet
+        self._rollups: Dict[int, Dict[str, Dict[int, List]]] = {}
+        self._n_pending = 0
+
+    def _location_id(self, product_type: str, geocode: str) -> int:
+        location = (product_type, geocode)
+        location_id = self._location_ids.get(location)
+        if location_id is None:
+            location_id = self._location_ids[location] = len(self._locations)
+            self._locations.append(location)
+        return location_id
+
+    def add(self, product_type: str, geocode: str, timestamp: int, stock_level: int):
+        """
+        Add a report to the buckets containing it
+
+        Args:
+            product_type (str): one of the given product types
+            geocode (str): geocode of the location
+            timestamp (int): datetime of the report in seconds since the epoch
+            stock_level (int): reported stock level
+        """
+        for bucket_size, seconds in BUCKET_SECONDS.items():
+            self.merge(
+                product_type,
+                geocode,
+                bucket_size,
+                timestamp - timestamp % seconds,
+                [1, stock_level, stock_level, stock_level, timestamp, stock_level],
+            )
+
+    def merge(
+        self,
+        product_type: str,
+        geocode: str,
+        bucket_size: str,
+        start: int,
+        aggregates: List,
+    ):
+        """
+        Combine aggregates with a bucket
+
+        Args:
+            product_type (str): one of the given product types
+            geocode (str): geocode of the location
+            bucket_size (str): one of BUCKET_SECONDS
+            start (int): start of the bucket in seconds since the epoch
+            aggregates (List): [count, min, max, sum, last datetime, last stock level] of the reports to combine
+        """
+        buckets = self._rollups.setdefault(
+            self._location_id(product_type, geocode), {}
+        ).setdefault(bucket_size, {})
+        current = buckets.get(start)
+        if current is not None:
+            _combine(current, aggregates)
+            return
+        buckets[start] = list(aggregates)
+        self._n_pending += 1
+        if self._n_pending >= FOLD_BUCKETS:
+            self._fold_pending()
+
+    def add_many(
+        self,
+        locations: List[Tuple[str, str]],
+        location_index: "np.ndarray",
+        timestamps: "np.ndarray",
+        stock_levels: "np.ndarray",
+    ):
+        """
+        Add many reports with vectorised aggregation, e.g. when reading the history at startup
+
+        Args:
+            locations (List[Tuple[str, str]]): distinct (product_type, geocode) pairs of the reports
+            location_index (np.ndarray): position in locations of the pair of each report
+            timestamps (np.ndarray): datetime of each report in seconds since the epoch
+            stock_levels (np.ndarray): stock level of each report
+        """
+        import numpy as np  # pylint: disable = import-outside-toplevel
+
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        stock_levels = np.asarray(stock_levels, dtype=np.int64)
+        aggregates = [
+            np.ones(len(timestamps), dtype=np.int64),
+            stock_levels,
+            stock_levels,
+            stock_levels,
+            timestamps,
+            stock_levels,
+        ]
+        for bucket_size, seconds in BUCKET_SECONDS.items():
+            self.merge_many(
+                bucket_size,
+                locations,
+                location_index,
+                timestamps - timestamps % seconds,
+                aggregates,
+            )
+
+    def merge_many(
+        self,
+        bucket_size: str,
+        locations: List[Tuple[str, str]],
+        location_index: "np.ndarray",
+        starts: "np.ndarray",
+        aggregates: List["np.ndarray"],
+    ):
+        """
+        Combine many aggregates with their buckets, see merge()
+
+        Args:
+            bucket_size (str): one of BUCKET_SECONDS
+            locations (List[Tuple[str, str]]): distinct (product_type, geocode) pairs of the aggregates
+            location_index (np.ndarray): position in locations of the pair of each aggregates
+            starts (np.ndarray): start of the bucket of each aggregates in seconds since the epoch
+            aggregates (List[np.ndarray]): count, min, max, sum, last datetime and last stock level columns
+        """
+        import numpy as np  # pylint: disable = import-outside-toplevel
+
+        # the buckets added so far are older, they lose the ties of the last report
+        self._fold_pending()
+        location_ids = np.array(
+            [self._location_id(*location) for location in locations], dtype=np.int64
+        )
+        keys = (
+            location_ids[np.asarray(location_index, dtype=np.int64)] << LOCATION_SHIFT
+        ) + (np.asarray(starts, dtype=np.int64) // BUCKET_SECONDS[bucket_size])
+        self._fold(bucket_size, keys, [np.asarray(column) for column in aggregates])
+
+    def _fold_pending(self):
+        """
+        Move the buckets updated one report at a time into the numpy arrays
+        """
+        if not self._rollups and self._arrays:
+            return
+        import numpy as np  # pylint: disable = import-outside-toplevel
+
+        for bucket_size, seconds in BUCKET_SECONDS.items():
+            keys, rows = [], []
+            for location_id, sizes in self._rollups.items():
+                for start, aggregates in sizes.get(bucket_size, {}).items():
+                    keys.append((location_id << LOCATION_SHIFT) + start // seconds)
+                    rows.append(aggregates)
+            columns = np.array(rows, dtype=np.int64).reshape(-1, 6).T
+            self._fold(bucket_size, np.array(keys, dtype=np.int64), list(columns))
+        self._rollups.clear()
+        self._n_pending = 0
+
+    def _fold(self, bucket_size: str, keys: "np.ndarray", columns: List["np.ndarray"]):
+        """
+        Combine buckets with the arrays of a bucket size, into new arrays so that a reader of the current ones is not
+        disturbed
+
+        Args:
+            bucket_size (str): one of BUCKET_SECONDS
+            keys (np.ndarray): key of each bucket, a key may appear several times and the later ones win the ties of
+                the last report
+            columns (List[np.ndarray]): aggregates of each bucket
+        """
+        import numpy as np  # pylint: disable = import-outside-toplevel
+
+        # combine the buckets of the same key, the stable sort keeps the ties in order
+        order = np.lexsort((columns[4], keys))
+        keys = keys[order]
+        columns = [column[order] for column in columns]
+        if len(keys):
+            firsts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            lasts = np.r_[firsts[1:], len(keys)] - 1
+            keys = keys[firsts]
+            columns = [
+                np.add.reduceat(columns[0], firsts),
+                np.minimum.reduceat(columns[1], firsts),
+                np.maximum.reduceat(columns[2], firsts),
+                np.add.reduceat(columns[3], firsts),
+                columns[4][lasts],
+                columns[5][lasts],
+            ]
+
+        current = self._arrays.get(bucket_size)
+        if current is not None:
+            current_keys, current_columns = current
+            positions = np.searchsorted(current_keys, keys)
+            found = positions < len(current_keys)
+            found[found] = current_keys[positions[found]] == keys[found]
+            # combine with the existing buckets
+            merged = [column.copy() for column in current_columns]
+            at, new = positions[found], [column[found] for column in columns]
+            merged[0][at] += new[0]
+            merged[1][at] = np.minimum(merged[1][at], new[1])
+            merged[2][at] = np.maximum(merged[2][at], new[2])
+            merged[3][at] += new[3]
+            newer = new[4] >= merged[4][at]
+            merged[4][at[newer]] = new[4][newer]
+            merged[5][at[newer]] = new[5][newer]
+            # insert the others
+            inserted = ~found
+            keys = np.insert(current_keys, positions[inserted], keys[inserted])
+            columns = [
+                np.insert(column, positions[inserted], values[inserted])
+                for column, values in zip(merged, columns)
+            ]
+
+        self._arrays[bucket_size] = (
+            keys.astype(np.int64, copy=False),
+            [
+                column.astype(dtype, copy=False)
+                for column, dtype in zip(columns, AGGREGATE_DTYPES)
+            ],
+        )
+
+    def query(
+        self, product_type: str, geocode: str, bucket_size: str, start: int, end: int
+    ) -> List[Dict]:
+        """
+        Buckets of a location overlapping a time range
+
+        Args:
+            product_type (str): one of the given product types
+            geocode (str): geocode of the location
+            bucket_size (str): one of BUCKET_SECONDS
+            start (int): start of the range in seconds since the epoch
+            end (int): end of the range in seconds since the epoch
+
+        Returns:
+            List[Dict]: aggregates of each bucket, oldest first
+        """
+        location_id = self._location_ids.get((product_type, geocode))
+        if location_id is None or end < 0:
+            return []
+        seconds = BUCKET_SECONDS[bucket_size]
+        first = max(0, start - start % seconds)
+
+        buckets: Dict[int, List] = {}
+        if bucket_size in self._arrays:
+            keys, columns = self._arrays[bucket_size]
+            location_key = location_id << LOCATION_SHIFT
+            low = int(keys.searchsorted(location_key + first // seconds))
+            high = int(
+                keys.searchsorted(
+                    location_key + min(end // seconds, KEY_MASK), side="right"
+                )
+            )
+            for key, *aggregates in zip(
+                keys[low:high].tolist(),
+                *(column[low:high].tolist() for column in columns)
+            ):
+                buckets[(key & KEY_MASK) * seconds] = aggregates
+        for bucket_start, aggregates in (
+            self._rollups.get(location_id, {}).get(bucket_size, {}).items()
+        ):
+            if not first <= bucket_start <= end:
+                continue
+            if bucket_start in buckets:
+                _combine(buckets[bucket_start], aggregates)
+            else:
+                buckets[bucket_start] = list(aggregates)
+        return [
+            rollup_record(bucket_start, buckets[bucket_start])
+            for bucket_start in sorted(buckets)
+        ]
+
+    def buckets(self, bucket_size: str) -> Iterator[Tuple[str, str, int, List]]:
+        """
+        Every bucket of a size, e.g. to write the daily summaries of compacted reports
+
+        Args:
+            bucket_size (str): one of BUCKET_SECONDS
+
+        Returns:
+            Iterator[Tuple[str, str, int, List]]: product_type, geocode, start and aggregates of each bucket
+        """
+        if not self._arrays:
+            for location_id, sizes in self._rollups.items():
+                product_type, geocode = self._locations[location_id]
+                for start, aggregates in sorted(sizes.get(bucket_size, {}).items()):
+                    yield product_type, geocode, start, aggregates
+            return
+
+        self._fold_pending()
+        keys, columns = self._arrays[bucket_size]
+        seconds = BUCKET_SECONDS[bucket_size]
+        for key, *aggregates in zip(
+            keys.tolist(), *(column.tolist() for column in columns)
+        ):
+            product_type, geocode = self._locations[key >> LOCATION_SHIFT]
+            yield product_type, geocode, (key & KEY_MASK) * seconds, aggregates
+
+    def reset(self):
+        """
+        Forget every report
+        """
+        self._location_ids.clear()
+        self._locations.clear()
+        self._arrays.clear()
+        self._rollups.clear()
+        self._n_pending = 0
+
+
+def rollup_record(start: int, aggregates: List) -> Dict:
+    """
+    Format the aggregates of a bucket as returned by the history endpoint
+
+    Args:
+        start (int): start of the bucket in seconds since the epoch
+        aggregates (List): [count, min, max, sum, last datetime, last stock level]
+
+    Returns:
+        Dict: follows the schema of the StockHistoryBucketSchema object found in schema.py
+    """
+    count, minimum, maximum, total, _, last = aggregates
+    return dict(
+        bucket_start=datetime.fromtimestamp(start, timezone.utc).strftime(
+            "%Y-%m-%dT%H:%M:%Sz"
+        ),
+        count=count,
+        min=minimum,
+        max=maximum,
+        mean=round(total / count, 3),
+        last=last,
+    )
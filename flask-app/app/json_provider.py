@@ -0,0 +1,66 @@
+"""
+JSON serialization for every jsonify response of the app
+
+Set on the app in create_app, so the API endpoints and the error handler in errors.py use the same encoder. orjson is
+used when it is installed and selected with the JSON_ENCODER config setting, otherwise the stdlib json module.
+"""
+from typing import Any
+
+from flask.json.provider import DefaultJSONProvider
+
+from app.metrics import stage
+
+try:
+    import orjson
+except ImportError:  # optional speedup, fall back to the stdlib json module
+    orjson = None  # type: ignore[assignment]
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider which serializes with orjson when available
+
+    Keeps the behaviour of the default provider: sorted keys when sort_keys is set, indented output for pretty printed
+    responses, and the default provider's handling of dates, decimals, uuids and dataclasses.
+    """
+
+    def __init__(self, app, encoder: str = "orjson"):
+        super().__init__(app)
+        self.use_orjson = encoder == "orjson" and orjson is not None
+
+    def _orjson_options(self, indent: bool = False) -> int:
+        """
+        orjson options matching the settings of this provider
+        """
+        # dates go through the default provider's http date format like the stdlib path
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if indent:
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if self.use_orjson and not kwargs:
+            data = orjson.dumps(
+                obj, default=self.default, option=self._orjson_options()
+            )
+            return data.decode("utf-8")
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args: Any, **kwargs: Any):
+        with stage("serialize"):
+            return self._response(*args, **kwargs)
+
+    def _response(self, *args: Any, **kwargs: Any):
+        if not self.use_orjson:
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        # orjson produces bytes, skip encoding to and from str
+        data = orjson.dumps(
+            obj, default=self.default, option=self._orjson_options(indent)
+        )
+        return self._app.response_class(data + b"\n", mimetype=self.mimetype)
+
@@ -0,0 +1,251 @@
+"""
+Logging of the app
+
+The loggers of the app ("app" and its children, see create_logger in utils.py) have a single handler, which only
+appends the records to a bounded buffer: a background thread of each worker process formats them and writes them to
+stdout every LOG_FLUSH_INTERVAL seconds, so a request never waits for the output. A record is dropped, and counted in
+the stock_log_records_dropped_total metric, when LOG_MAX_RECORDS records are waiting already.
+
+    - LOG_FORMAT: "text" lines or "json" objects, one per record, extra fields given with logger.x(..., extra={...})
+      are part of the json objects
+    - every record logged while handling a request carries the request_id of the request, read from the
+      X-Request-ID header when the client (or a proxy) sends one and returned in the X-Request-ID response header
+    - debug records are kept for a LOG_DEBUG_SAMPLE_RATE fraction of the requests, all the debug records of a request
+      are kept or dropped together
+"""
+import atexit
+import collections
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import uuid
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from flask import Flask, Response, g, request
+
+from app.metrics import registry
+
+LOG_FORMATS = ("text", "json")
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+REQUEST_ID_HEADER = "X-Request-ID"
+# request ids accepted from the clients, anything else is replaced by a new id
+_REQUEST_ID = re.compile(r"[A-Za-z0-9._:-]{1,128}\Z")
+
+# (request id, debug records sampled) of the request being handled, a context variable is much cheaper to read in
+# every record than flask.g
+_request_log: ContextVar[Tuple[Optional[str], Optional[bool]]] = ContextVar(
+    "request_log", default=(None, None)
+)
+
+# attributes of every LogRecord, the other attributes of a record are the extra fields of the json format
+_RECORD_ATTRIBUTES = frozenset(
+    logging.LogRecord("", 0, "", 0, "", (), None).__dict__
+) | {"message", "asctime", "request_id"}
+
+
+def _extra_fields(record: logging.LogRecord) -> Dict[str, Any]:
+    return {
+        key: value
+        for key, value in record.__dict__.items()
+        if key not in _RECORD_ATTRIBUTES
+    }
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Format a record as TEXT_FORMAT followed by its extra fields, e.g. "... Wrote stock reports n_reports=3"
+    """
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT, DATE_FORMAT)
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        if getattr(record, "request_id", None) is None:
+            record.request_id = "-"  # logged outside of a request
+        message = super().formatMessage(record)
+        extra = _extra_fields(record)
+        if not extra:
+            return message
+        return message + "".join(
+            " {}={}".format(key, value) for key, value in extra.items()
+        )
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format a record as a single line json object
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = dict(
+            time=self.formatTime(record, DATE_FORMAT),
+            level=record.levelname,
+            logger=record.name,
+            message=record.getMessage(),
+            request_id=getattr(record, "request_id", None),
+        )
+        entry.update(_extra_fields(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _RequestContextFilter(logging.Filter):
+    """
+    Tag records with the request id and drop the debug records of the requests left out of the sample, runs on the
+    thread logging the record
+    """
+
+    def __init__(self, debug_sample_rate: float):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id, sampled = _request_log.get()
+        if record.levelno > logging.DEBUG or self.debug_sample_rate >= 1:
+            return True
+        if sampled is None:
+            # outside of a request, e.g. the write buffer thread, each record is sampled on its own
+            sampled = random.random() < self.debug_sample_rate
+        return sampled
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    Collect the records of the app for a background thread writing them with another handler
+
+    Logging a record only appends it to a deque: the thread is not woken up for each record, which would hand it the
+    GIL in the middle of the request, it writes what was collected every flush_interval seconds.
+    """
+
+    def __init__(
+        self, handler: logging.Handler, max_records: int, flush_interval: float
+    ):
+        super().__init__()
+        self.handler = handler
+        self.max_records = max_records
+        self.flush_interval = flush_interval
+        self._reset()
+        # a forked worker starts its own thread, the thread of its parent is not forked
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.stop)
+
+    def _reset(self):
+        self._records: Deque[logging.LogRecord] = collections.deque()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        """
+        Start the background thread in this process, lazily so that no thread is forked with the gunicorn master
+        """
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._stopped.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name="log-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self._write()
+        self._write()
+
+    def _write(self):
+        records = self._records
+        while records:
+            self.handler.handle(records.popleft())
+
+    def stop(self):
+        """
+        Write the collected records and stop the background thread, registered to run at interpreter exit
+        """
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def emit(self, record: logging.LogRecord):
+        if len(self._records) >= self.max_records:
+            registry.inc("stock_log_records_dropped_total", ())
+            return
+        # the record is formatted by the background thread, only the message arguments and the traceback, which may
+        # change or go away once the call returns, are rendered here
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self._ensure_started()
+        self._records.append(record)
+
+
+def _finish_request(response: Response) -> Response:
+    request_id = g.get("request_id")
+    if request_id is not None:
+        response.headers[REQUEST_ID_HEADER] = request_id
+    return response
+
+
+def _teardown_request(error):  # pylint: disable = unused-argument
+    token = g.pop("log_context", None)
+    if token is not None:
+        # the thread serves other requests next
+        _request_log.reset(token)
+
+
+def init_app(app: Flask):
+    """
+    Send the records of the app loggers to the background thread and tag them with request ids, according to the
+    LOG_* settings of the app config
+
+    Args:
+        app (Flask): app whose requests get a request id
+    """
+    config = app.config
+    log_format = config["LOG_FORMAT"]
+    if log_format not in LOG_FORMATS:
+        raise ValueError(
+            "LOG_FORMAT must be one of {}, got {!r}".format(LOG_FORMATS, log_format)
+        )
+    sample_rate = config["LOG_DEBUG_SAMPLE_RATE"]
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+    handler = AsyncLogHandler(
+        output, config["LOG_MAX_RECORDS"], config["LOG_FLUSH_INTERVAL"]
+    )
+    handler.addFilter(_RequestContextFilter(sample_rate))
+
+    logger = logging.getLogger("app")
+    logger.setLevel(config["LOG_LEVEL"])
+    for previous in list(logger.handlers):
+        # create_app called again, e.g. by the benchmarks
+        if isinstance(previous, AsyncLogHandler):
+            logger.removeHandler(previous)
+            previous.stop()
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    def start_request():
+        request_id = request.headers.get(REQUEST_ID_HEADER)
+        if request_id is None or not _REQUEST_ID.match(request_id):
+            request_id = uuid.uuid4().hex
+        g.request_id = request_id
+        g.log_context = _request_log.set((request_id, random.random() < sample_rate))
+
+    app.before_request(start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,458 @@
+"""
+Prometheus metrics of the app, served at /metrics in the Prometheus text format
+
+Every worker process counts its requests and stage timings in memory, the hot path is a few dictionary updates. With
+METRICS_DIR set, each worker also writes a snapshot of its metrics to its own file in that directory at most every
+METRICS_FLUSH_INTERVAL seconds from a background thread, and /metrics sums the snapshots of every worker, so the
+totals do not depend on the worker answering the scrape. Snapshots of stopped workers are kept so counters never go
+backwards, clear the directory when deploying. gunicorn.conf.py sets a directory for its workers when METRICS_DIR is
+not set, other servers running several workers need METRICS_DIR.
+
+Stages timed with stage(): queue (waiting for admission, see admission.py), parse (reading the request), validate
+(schema load), deduplicate (idempotency key lookup), storage_read, storage_write and serialize.
+"""
+import asyncio
+import atexit
+import bisect
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from flask import Flask, Response, g, has_request_context, request
+from webargs.flaskparser import FlaskParser
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the latency histograms, stages often take well under a millisecond
+DURATION_BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# type and help text of every metric
+METRICS = {
+    "stock_http_requests_total": (
+        "counter",
+        "Requests answered by endpoint, method and status",
+    ),
+    "stock_http_request_duration_seconds": (
+        "histogram",
+        "Time to produce a response by endpoint and method",
+    ),
+    "stock_stage_duration_seconds": (
+        "histogram",
+        "Time spent in each stage of a request by endpoint and stage",
+    ),
+    "stock_store_reports": ("gauge", "Stock reports held by the storage backend"),
+    "stock_store_locations": ("gauge", "Locations with at least one stock report"),
+    "stock_store_size_bytes": ("gauge", "Size of the stock report history on disk"),
+    "stock_log_records_dropped_total": (
+        "counter",
+        "Log records dropped because the log queue was full",
+    ),
+    "stock_duplicate_submissions_total": (
+        "counter",
+        "Retried stock submissions acknowledged without writing the report again",
+    ),
+    "stock_requests_shed_total": (
+        "counter",
+        "Requests answered 503 by the admission control by class and reason",
+    ),
+    "stock_compaction_running": (
+        "gauge",
+        "Whether a worker of the host is compacting the stock history",
+    ),
+    "stock_compaction_progress_ratio": (
+        "gauge",
+        "Fraction of the running compaction done",
+    ),
+    "stock_compaction_last_success_timestamp_seconds": (
+        "gauge",
+        "Time the last successful compaction finished",
+    ),
+    "stock_compaction_reports_compacted_total": (
+        "counter",
+        "Stock reports replaced by daily summaries",
+    ),
+    "stock_compaction_reclaimed_bytes_total": (
+        "counter",
+        "Bytes of stock history reclaimed by the compactions",
+    ),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms of one worker process
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.directory: Optional[str] = None
+        self.flush_interval = 1.0
+        self._lock = threading.Lock()
+        self._reset()
+        # a forked worker starts from scratch instead of counting its parent's requests again
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        # bucket counts (the last one is +Inf) followed by the sum of the observations
+        self._histograms: Dict[Tuple[str, Labels], List[float]] = {}
+        self._dirty = False
+        self._flusher: Optional[threading.Thread] = None
+        self._filename = "metrics_{}_{}.json".format(os.getpid(), uuid.uuid4().hex[:8])
+
+    def configure(self, enabled: bool, directory: Optional[str], flush_interval: float):
+        """
+        Apply the METRICS_* settings of the Flask app config
+        """
+        self.enabled = enabled
+        self.directory = directory
+        self.flush_interval = flush_interval
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def inc(self, name: str, labels: Labels, value: float = 1):
+        """
+        Increase a counter
+        """
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: Labels, seconds: float):
+        """
+        Add an observation to a histogram
+        """
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(DURATION_BUCKETS) + 2)
+            histogram[bisect.bisect_left(DURATION_BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    def snapshot(self) -> Dict:
+        """
+        Json serializable copy of the metrics of this process
+        """
+        with self._lock:
+            return dict(
+                counters=[
+                    [name, list(labels), value]
+                    for (name, labels), value in self._counters.items()
+                ],
+                histograms=[
+                    [name, list(labels), list(values)]
+                    for (name, labels), values in self._histograms.items()
+                ],
+            )
+
+    def schedule_flush(self):
+        """
+        Have the snapshot file of this process written within flush_interval seconds, by a background thread
+        """
+        if not self.directory:
+            return
+        self._dirty = True
+        if self._flusher is None:
+            # started lazily so that no thread is forked with the gunicorn master
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(
+                        target=self._flush_periodically,
+                        name="metrics-flush",
+                        daemon=True,
+                    )
+                    self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self._dirty:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the snapshot file of this process, atomically so a scrape never reads half a file
+        """
+        if not self.directory or not self.enabled:
+            return
+        self._dirty = False
+        path = os.path.join(self.directory, self._filename)
+        with open(path + ".tmp", "w") as snapshot:
+            json.dump(self.snapshot(), snapshot)
+        os.replace(path + ".tmp", path)
+
+    def collect(self) -> Dict:
+        """
+        Metrics of every worker process, this process' metrics are up to date, the others' as of their last flush
+
+        Returns:
+            Dict: counters and histograms keyed by (name, labels)
+        """
+        snapshots = [self.snapshot()]
+        if self.directory:
+            for filename in os.listdir(self.directory):
+                if filename == self._filename or not filename.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, filename)) as snapshot_file:
+                        snapshots.append(json.load(snapshot_file))
+                except (OSError, ValueError):
+                    continue  # replaced or removed meanwhile
+
+        counters: Dict[Tuple[str, Labels], float] = {}
+        histograms: Dict[Tuple[str, Labels], List[float]] = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                merged = histograms.setdefault(key, [0] * len(values))
+                for position, value in enumerate(values):
+                    merged[position] += value
+        return dict(counters=counters, histograms=histograms)
+
+    def render(self, gauges: Dict[str, float]) -> str:
+        """
+        Every metric in the Prometheus text exposition format
+
+        Args:
+            gauges (Dict[str, float]): current value of gauges, e.g. the store statistics
+
+        Returns:
+            str: metrics page
+        """
+        collected = self.collect()
+        families: Dict[str, List[str]] = {}
+
+        for (name, labels), value in sorted(collected["counters"].items()):
+            families.setdefault(name, []).append(_sample(name, labels, value))
+
+        for (name, labels), values in sorted(collected["histograms"].items()):
+            lines = families.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS + ("+Inf",), values[:-1]):
+                cumulative += count
+                bucket_labels = labels + (("le", str(bound)),)
+                lines.append(_sample(name + "_bucket", bucket_labels, cumulative))
+            lines.append(_sample(name + "_sum", labels, values[-1]))
+            lines.append(_sample(name + "_count", labels, cumulative))
+
+        for name, value in sorted(gauges.items()):
+            families.setdefault(name, []).append(_sample(name, (), value))
+
+        page = []
+        for name, lines in families.items():
+            metric_type, description = METRICS.get(name, ("untyped", name))
+            page.append("# HELP {} {}".format(name, description))
+            page.append("# TYPE {} {}".format(name, metric_type))
+            page.extend(lines)
+        return "\n".join(page) + "\n"
+
+
+def _sample(name: str, labels: Labels, value: float) -> str:
+    """
+    One line of the exposition format
+    """
+    if not labels:
+        return "{} {}".format(name, _number(value))
+    formatted = ",".join(
+        '{}="{}"'.format(
+            key,
+            str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for key, label in labels
+    )
+    return "{}{{{}}} {}".format(name, formatted, _number(value))
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+registry = MetricsRegistry()
+
+
+def current_endpoint() -> str:
+    """
+    Route of the current request, the label of every request metric
+    """
+    if not has_request_context():
+        return "background"
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Time a stage of the current request, e.g. with stage("storage_read"): ...
+
+    Args:
+        name (str): parse, validate, storage_read, storage_write or serialize
+    """
+    if not registry.enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+def observe_stage(name: str, seconds: float, endpoint: Optional[str] = None):
+    """
+    Record the duration of a stage timed by the caller, see stage()
+
+    Args:
+        name (str): name of the stage
+        seconds (float): duration
+        endpoint (Optional[str]): route of the request, defaults to the current request's
+    """
+    registry.observe(
+        "stock_stage_duration_seconds",
+        (("endpoint", endpoint or current_endpoint()), ("stage", name)),
+        seconds,
+    )
+
+
+_parse_times = threading.local()
+
+
+class InstrumentedFlaskParser(FlaskParser):
+    """
+    webargs parser timing the parse (reading the arguments from the request) and validate (schema load) stages
+
+    use_args also decorates async views.
+    """
+
+    def _parse_request(self, schema, req, locations):
+        started = time.perf_counter()
+        try:
+            return super()._parse_request(schema, req, locations)
+        finally:
+            _parse_times.seconds = time.perf_counter() - started
+            observe_stage("parse", _parse_times.seconds)
+
+    def use_args(self, argmap, *args, **kwargs):  # pylint: disable = arguments-differ
+        decorator = super().use_args(argmap, *args, **kwargs)
+
+        def async_aware(func):
+            wrapper = decorator(func)
+            if not asyncio.iscoroutinefunction(func):
+                return wrapper
+
+            # keep async views recognisable as coroutine functions by Flask
+            @functools.wraps(func)
+            async def async_wrapper(*view_args, **view_kwargs):
+                return await wrapper(*view_args, **view_kwargs)
+
+            return async_wrapper
+
+        return async_aware
+
+    def parse(self, *args, **kwargs):  # pylint: disable = arguments-differ
+        _parse_times.seconds = 0.0
+        started = time.perf_counter()
+        try:
+            return super().parse(*args, **kwargs)
+        finally:
+            observe_stage(
+                "validate", time.perf_counter() - started - _parse_times.seconds
+            )
+
+
+# parser of the api arguments, used by the @parser.use_args decorators in api.py
+parser = InstrumentedFlaskParser()
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+
+
+def _finish_request(response: Response) -> Response:
+    endpoint = current_endpoint()
+    registry.inc(
+        "stock_http_requests_total",
+        (
+            ("endpoint", endpoint),
+            ("method", request.method),
+            ("status", str(response.status_code)),
+        ),
+    )
+    started = g.get("metrics_started")
+    if started is not None:
+        registry.observe(
+            "stock_http_request_duration_seconds",
+            (("endpoint", endpoint), ("method", request.method)),
+            time.perf_counter() - started,
+        )
+    registry.schedule_flush()
+    return response
+
+
+def init_app(app: Flask, gauges: Callable[[], Dict[str, float]]):
+    """
+    Time every request of the app and serve /metrics, according to the METRICS_* settings of the app config
+
+    Args:
+        app (Flask): app to instrument
+        gauges (Callable[[], Dict[str, float]]): called on each scrape for the current gauge values
+    """
+    registry.configure(
+        app.config["METRICS_ENABLED"],
+        app.config["METRICS_DIR"],
+        app.config["METRICS_FLUSH_INTERVAL"],
+    )
+    if not registry.enabled:
+        return
+    if not registry.directory and multiprocessing.current_process().name != "MainProcess":
+        # e.g. a worker of uvicorn --workers, gunicorn workers are forked rather than started by multiprocessing,
+        # not parent_process() which is Python 3.8+
+        logger.warning(
+            "METRICS_DIR is not set: /metrics only counts the requests of the worker answering the scrape"
+        )
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+    def metrics():
+        return Response(
+            registry.render(gauges()),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+    app.add_url_rule("/metrics", "metrics", metrics, methods=["GET"])
@@ -0,0 +1,359 @@
+"""
+OpenAPI documents and Swagger UI of the app: /apispec_1.json, /swagger/ and its assets under /flasgger_static/
+
+flasgger builds a document from the docstrings of every view each time it is requested (when DEBUG is set) and
+serializes it again on every request otherwise, renders the Swagger UI page on every request and sends the assets
+without caching headers. They only change with the code, so init_app serves them as static responses (StaticBody):
+    - built at most once per process, a generated document is built again only when routes are added
+    - with a strong ETag, answered by 304 Not Modified, and a Cache-Control max-age of OPENAPI_CACHE_MAX_AGE (documents
+      and page) or SWAGGER_UI_CACHE_MAX_AGE (assets)
+    - compressed once per content coding, brotli (when installed) or gzip, following the Accept-Encoding header
+
+build_openapi.py writes the documents and the compressed variants of the documents and assets, at the highest
+compression levels, to OPENAPI_SPEC_DIR at build time, the workers then read them instead of building them.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from flasgger import Swagger
+from flask import Flask, Response, request
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # optional, responses are only compressed with gzip without it
+    brotli = None
+
+SPEC_MIMETYPE = "application/json"
+
+# content codings in order of preference, with the suffix of their files written by build_openapi.py
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+# compression levels at runtime, the highest levels take seconds for the Swagger UI bundle
+RUNTIME_LEVELS = {"br": 5, "gzip": 6}
+BUILD_LEVELS = {"br": 11, "gzip": 9}
+# mimetypes worth compressing, e.g. not the favicons
+COMPRESSIBLE = ("text/", "application/javascript", "application/json")
+# subdirectory of OPENAPI_SPEC_DIR holding the compressed Swagger UI assets
+ASSETS_DIRECTORY = "swagger-ui"
+
+
+def _encodings(mimetype: str) -> List[str]:
+    """
+    Content codings offered for a mimetype, in order of preference
+    """
+    if not mimetype.startswith(COMPRESSIBLE):
+        return []
+    return [encoding for encoding in ENCODINGS if encoding != "br" or brotli]
+
+
+def compress(body: bytes, encoding: str, level: int) -> bytes:
+    """
+    Compress a body with a content coding of ENCODINGS
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=level)
+    return gzip.compress(body, level)
+
+
+def _read_file(path: str) -> Callable[[], bytes]:
+    def read() -> bytes:
+        with open(path, "rb") as static_file:
+            return static_file.read()
+
+    return read
+
+
+class StaticBody:
+    """
+    Body of a response served like a static file, with its strong ETag and compressed variants built at most once per
+    process
+    """
+
+    def __init__(
+        self,
+        load: Callable[[], bytes],
+        mimetype: str,
+        max_age: int,
+        precompressed: Optional[str] = None,
+        version: Optional[Callable[[], Hashable]] = None,
+    ):
+        """
+        Args:
+            load (Callable[[], bytes]): returns the body
+            mimetype (str): type of the body
+            max_age (int): seconds during which clients and proxies reuse the response without revalidating it
+            precompressed (Optional[str]): path of the body, compressed variants are read from <path>.br and
+                <path>.gz when they exist
+            version (Optional[Callable[[], Hashable]]): the body is loaded again when the value returned changes
+        """
+        self._load = load
+        self.mimetype = mimetype
+        self.cache_control = "public, max-age={}".format(max_age)
+        self.precompressed = precompressed
+        self.encodings = _encodings(mimetype)
+        self._version = version
+        self._loaded_version: Hashable = None
+        # body and ETag of each content coding, "identity" for the uncompressed body
+        self._variants: Dict[str, Tuple[bytes, str]] = {}
+        self._lock = threading.Lock()
+
+    def variant(self, encoding: str) -> Tuple[bytes, str]:
+        """
+        Body and ETag of a content coding, "identity" for the uncompressed body
+        """
+        version = self._version() if self._version is not None else None
+        variants = self._variants
+        if encoding in variants and version == self._loaded_version:
+            return variants[encoding]
+        with self._lock:
+            if "identity" not in self._variants or version != self._loaded_version:
+                body = self._load()
+                self._variants = {
+                    "identity": (body, hashlib.sha256(body).hexdigest()[:32])
+                }
+                self._loaded_version = version
+            if encoding not in self._variants:
+                body, etag = self._variants["identity"]
+                self._variants[encoding] = (
+                    self._compress(body, encoding),
+                    "{}-{}".format(etag, encoding),
+                )
+            return self._variants[encoding]
+
+    def _compress(self, body: bytes, encoding: str) -> bytes:
+        if self.precompressed:
+            path = self.precompressed + ENCODINGS[encoding]
+            if os.path.exists(path):
+                return _read_file(path)()
+        return compress(body, encoding, RUNTIME_LEVELS[encoding])
+
+    def load(self):
+        """
+        Build the body and every compressed variant now rather than on the requests asking for them
+        """
+        for encoding in ["identity"] + self.encodings:
+            self.variant(encoding)
+
+    def response(self) -> Response:
+        """
+        Response to the current request: the variant of the best accepted content coding, or 304 Not Modified when
+        the client holds it already
+        """
+        encoding = "identity"
+        if self.encodings:
+            accepted = request.accept_encodings
+            # the first of the preferred codings wins a tie
+            best = max(self.encodings, key=lambda candidate: accepted[candidate])
+            if accepted[best] > 0:
+                encoding = best
+        body, etag = self.variant(encoding)
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype=self.mimetype)
+            if encoding != "identity":
+                response.headers["Content-Encoding"] = encoding
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = self.cache_control
+        if self.encodings:
+            response.vary.add("Accept-Encoding")
+        return response
+
+
+def spec_endpoints(swagger: Swagger) -> Dict[str, str]:
+    """
+    Flask endpoint of the view serving each document, keyed by the endpoint of the document in the SWAGGER config
+    """
+    blueprint = swagger.config.get("endpoint", "flasgger")
+    return {
+        spec["endpoint"]: "{}.{}".format(blueprint, spec["endpoint"])
+        for spec in swagger.config["specs"]
+    }
+
+
+def build_spec(app: Flask, swagger: Swagger, endpoint: str) -> Dict:
+    """
+    Generate a document from the registered views
+
+    Args:
+        app (Flask): app with every endpoint registered
+        swagger (Swagger): flasgger extension of the app
+        endpoint (str): endpoint of the document in the SWAGGER config, e.g. apispec_1
+
+    Returns:
+        Dict: OpenAPI document
+    """
+    with app.app_context():
+        return swagger.get_apispecs(endpoint)
+
+
+def _write(path: str, body: bytes, encodings: List[str], variants_only: bool = False):
+    """
+    Write a body and its variants compressed at BUILD_LEVELS, each file atomically
+    """
+    variants = [] if variants_only else [(path, body)]
+    variants += [
+        (path + ENCODINGS[encoding], compress(body, encoding, BUILD_LEVELS[encoding]))
+        for encoding in encodings
+    ]
+    for variant_path, variant in variants:
+        with open(variant_path + ".tmp", "wb") as output:
+            output.write(variant)
+        os.replace(variant_path + ".tmp", variant_path)
+
+
+def write_specs(app: Flask, swagger: Swagger, directory: str) -> Dict[str, str]:
+    """
+    Write every document of the app to directory/<endpoint>.json with its compressed variants, see build_openapi.py
+
+    Returns:
+        Dict[str, str]: path of the file written for each document
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for endpoint in spec_endpoints(swagger):
+        path = os.path.join(directory, endpoint + ".json")
+        body = json.dumps(build_spec(app, swagger, endpoint), sort_keys=True)
+        _write(path, body.encode("utf-8"), _encodings(SPEC_MIMETYPE))
+        paths[endpoint] = path
+    return paths
+
+
+def write_assets(app: Flask, swagger: Swagger, directory: str) -> int:
+    """
+    Write the compressed variants of the Swagger UI assets to directory/swagger-ui, see build_openapi.py
+
+    Returns:
+        int: number of assets compressed
+    """
+    blueprint = app.blueprints.get(swagger.config.get("endpoint", "flasgger"))
+    # i.e. has_static_folder, which the type checker does not narrow on
+    static_folder = blueprint.static_folder if blueprint is not None else None
+    if static_folder is None:
+        return 0
+    n_assets = 0
+    for root, _, filenames in os.walk(static_folder):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            encodings = _encodings(mimetypes.guess_type(path)[0] or "")
+            if not encodings:
+                continue
+            output = os.path.join(
+                directory,
+                ASSETS_DIRECTORY,
+                os.path.relpath(path, static_folder),
+            )
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            # the asset itself is served from the flasgger package
+            _write(output, _read_file(path)(), encodings, variants_only=True)
+            n_assets += 1
+    return n_assets
+
+
+def init_app(app: Flask, swagger: Swagger):
+    """
+    Serve the documents, the Swagger UI page and its assets as StaticBody responses instead of flasgger's views, call
+    once every endpoint is registered
+
+    Args:
+        app (Flask): app to serve the documents of
+        swagger (Swagger): flasgger extension of the app
+    """
+    directory = app.config["OPENAPI_SPEC_DIR"]
+    spec_max_age = app.config["OPENAPI_CACHE_MAX_AGE"]
+    assets_max_age = app.config["SWAGGER_UI_CACHE_MAX_AGE"]
+    blueprint = swagger.config.get("endpoint", "flasgger")
+    specs: List[StaticBody] = []
+    app.extensions["openapi_specs"] = specs
+
+    def routes() -> int:
+        # routes are only ever added
+        return sum(1 for _ in app.url_map.iter_rules())
+
+    def spec_view(endpoint: str) -> Callable[[], Response]:
+        path = os.path.join(directory, endpoint + ".json") if directory else None
+        if path and os.path.exists(path):
+            spec = StaticBody(
+                _read_file(path), SPEC_MIMETYPE, spec_max_age, precompressed=path
+            )
+        else:
+
+            def build() -> bytes:
+                document = build_spec(app, swagger, endpoint)
+                return app.json.dumps(document).encode("utf-8")
+
+            spec = StaticBody(build, SPEC_MIMETYPE, spec_max_age, version=routes)
+        specs.append(spec)
+
+        # a function rather than a bound method or callable object, flasgger inspects the source of every view
+        def openapi_spec() -> Response:
+            return spec.response()
+
+        return openapi_spec
+
+    for endpoint, view_name in spec_endpoints(swagger).items():
+        app.view_functions[view_name] = spec_view(endpoint)
+
+    page_view = app.view_functions.get(blueprint + ".apidocs")
+    if page_view is not None:
+        # rendered once for each script root, the links of the page are relative to it
+        pages: Dict[str, StaticBody] = {}
+
+        def swagger_ui() -> Response:
+            if request.args:
+                return page_view()  # e.g. ?json=1, the list of the documents
+            page = pages.get(request.script_root)
+            if page is None:
+                html = page_view().encode("utf-8")
+                page = pages.setdefault(
+                    request.script_root,
+                    StaticBody(lambda: html, "text/html", spec_max_age),
+                )
+            return page.response()
+
+        app.view_functions[blueprint + ".apidocs"] = swagger_ui
+
+    flasgger_blueprint = app.blueprints.get(blueprint)
+    static_folder = (
+        flasgger_blueprint.static_folder if flasgger_blueprint is not None else None
+    )
+    if static_folder is not None:
+        assets: Dict[str, StaticBody] = {}
+
+        def swagger_ui_asset(filename: str) -> Response:
+            asset = assets.get(filename)
+            if asset is None:
+                path = safe_join(static_folder, filename)
+                if path is None or not os.path.isfile(path):
+                    raise NotFound()
+                precompressed = None
+                if directory:
+                    precompressed = os.path.join(directory, ASSETS_DIRECTORY, filename)
+                asset = assets.setdefault(
+                    filename,
+                    StaticBody(
+                        _read_file(path),
+                        mimetypes.guess_type(path)[0] or "application/octet-stream",
+                        assets_max_age,
+                        precompressed=precompressed,
+                    ),
+                )
+            return asset.response()
+
+        app.view_functions[blueprint + ".static"] = swagger_ui_asset
+
+
+def load_specs(app: Flask):
+    """
+    Build every document served by init_app and its compressed variants now rather than on their first request, e.g.
+    in the gunicorn master so the workers share them
+    """
+    for spec in app.extensions.get("openapi_specs", []):
+        spec.load()
@@ -0,0 +1,264 @@
+"""
+Opt-in per-request profiling
+
+A request is profiled when it carries the header "X-Profile: <PROFILING_TOKEN>", or at random with probability
+PROFILING_SAMPLE_RATE. Its profile is written to PROFILING_DIR and the functions with the most own time are listed in
+the X-Profile-Top response header:
+    cprofile: deterministic profile of every call, written as a pstats file (python -m pstats, snakeviz)
+    sampling: stack of the request thread sampled every PROFILING_INTERVAL_MS, written as collapsed stacks
+              (flamegraph.pl, speedscope)
+
+The storage calls a request awaits run on the threads of AsyncStockStore, which runs them under the profiler of the
+request through profile_call, so that they show in its profile rather than the wait of the request thread.
+
+Without a token and a sample rate no hook is registered, so requests pay nothing.
+"""
+import collections
+import cProfile
+import functools
+import hmac
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Any, Callable, Counter, List, Set, Tuple, cast
+
+from flask import Flask, Response, g, request
+
+PROFILING_MODES = ("cprofile", "sampling")
+
+
+class RequestProfile(cProfile.Profile):
+    """
+    cProfile profile of a request, including the calls it runs on other threads through profile_call
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.thread_profiles: List[cProfile.Profile] = []
+
+    def call(self, function: Callable):
+        """
+        Call a function from another thread than the request's, profiled as part of the request
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # the profiler of the request already sees every thread (python >= 3.12)
+            return function()
+        try:
+            return function()
+        finally:
+            profile.disable()
+            self.thread_profiles.append(profile)
+
+    def merged_stats(self) -> pstats.Stats:
+        """
+        Statistics of the request thread and of the calls profiled on other threads
+        """
+        return pstats.Stats(self, *self.thread_profiles)
+
+
+class SamplingProfiler:
+    """
+    Sample the stack of the request thread, and of the threads running a call of the request, from a background thread
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.thread_ids: Set[int] = {threading.get_ident()}
+        self.stacks: Counter[str] = collections.Counter()
+        self._started = self._elapsed = 0.0
+        self._n_rounds = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="request-sampler", daemon=True
+        )
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._elapsed = time.perf_counter() - self._started
+        self._stopped.set()
+        self._thread.join()
+
+    def call(self, function: Callable):
+        """
+        Call a function from another thread than the request's, its thread is sampled during the call
+        """
+        thread_id = threading.get_ident()
+        self.thread_ids.add(thread_id)
+        try:
+            return function()
+        finally:
+            self.thread_ids.discard(thread_id)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()  # pylint: disable = protected-access
+            if self._stopped.is_set():
+                break
+            self._n_rounds += 1
+            for thread_id in list(self.thread_ids):
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self.stacks[_collapse(frame)] += 1
+
+    def dump(self, path: str):
+        """
+        Write the samples as collapsed stacks, one "root;...;leaf count" line per distinct stack
+        """
+        with open(path, "w") as output:
+            for stack, count in self.stacks.items():
+                output.write("{} {}\n".format(stack, count))
+
+    def top(self, n_functions: int) -> List[Tuple[str, float]]:
+        """
+        Functions found most often at the top of the stack, with their estimated own time in ms
+        """
+        leaves: Counter[str] = collections.Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        # the sampler waits for the GIL, so sampling rounds are spread over the request rather than exactly interval
+        # apart
+        n_rounds = max(self._n_rounds, 1)
+        return [
+            (function, self._elapsed * 1000 * count / n_rounds)
+            for function, count in leaves.most_common(n_functions)
+        ]
+
+
+def _collapse(frame) -> str:
+    """
+    Collapsed stack of a frame, from the outermost call to the frame
+    """
+    names = []
+    while frame is not None:
+        names.append(
+            "{}:{}".format(frame.f_globals.get("__name__", "?"), frame.f_code.co_name)
+        )
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+# profiler of the request being handled, seen by the coroutines of its view
+_current_profiler: ContextVar = ContextVar("profiler", default=None)
+
+
+def profile_call(function: Callable) -> Callable:
+    """
+    Bind a function to the profiler of the current request, if it is profiled, to be called on another thread
+
+    Args:
+        function (Callable): function without arguments, e.g. a storage call sent to a thread pool
+
+    Returns:
+        Callable: the function itself when the request is not profiled
+    """
+    profiler = _current_profiler.get()
+    if profiler is None:
+        return function
+    return functools.partial(profiler.call, function)
+
+
+def _cprofile_top(profiler: RequestProfile, n_functions: int):
+    """
+    Functions with the most own time in a cProfile profile, with their own time in ms
+    """
+    # the raw entries of the statistics are not part of the pstats type stubs
+    stats = cast(Any, profiler.merged_stats()).stats
+    ranked = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)
+    return [
+        ("{}:{}".format(os.path.basename(filename), function), own_time * 1000)
+        for (filename, _, function), (_, _, own_time, _, _) in ranked[:n_functions]
+    ]
+
+
+def _should_profile(config) -> bool:
+    token = config["PROFILING_TOKEN"]
+    header = request.headers.get("X-Profile")
+    if token and header and hmac.compare_digest(header, token):
+        return True
+    return random.random() < config["PROFILING_SAMPLE_RATE"]
+
+
+def init_app(app: Flask):
+    """
+    Profile requests according to the PROFILING_* settings of the app config
+
+    Args:
+        app (Flask): app to instrument
+    """
+    config = app.config
+    if not config["PROFILING_TOKEN"] and not config["PROFILING_SAMPLE_RATE"]:
+        return
+    mode = config["PROFILING_MODE"]
+    if mode not in PROFILING_MODES:
+        raise ValueError(
+            "PROFILING_MODE must be one of {}, got {!r}".format(PROFILING_MODES, mode)
+        )
+    directory = config["PROFILING_DIR"]
+    os.makedirs(directory, exist_ok=True)
+
+    def start_profiler():
+        if not _should_profile(config):
+            return
+        if mode == "cprofile":
+            profiler = RequestProfile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # another request of this process is being profiled, only one profiler can be active at a time
+                return
+        else:
+            profiler = SamplingProfiler(config["PROFILING_INTERVAL_MS"] / 1000)
+            profiler.start()
+        g.profiler = profiler
+        g.profiler_token = _current_profiler.set(profiler)
+
+    def stop_profiler(response: Response) -> Response:
+        profiler = g.pop("profiler", None)
+        if profiler is None:
+            return response
+        if mode == "cprofile":
+            profiler.disable()
+        else:
+            profiler.stop()
+
+        endpoint = re.sub(r"[^A-Za-z0-9]+", "_", request.path).strip("_")
+        name = "{}-{}-{}-{}".format(
+            time.strftime("%Y%m%dT%H%M%S"), os.getpid(), endpoint, uuid.uuid4().hex[:8]
+        )
+        if mode == "cprofile":
+            filename = name + ".prof"
+            profiler.merged_stats().dump_stats(os.path.join(directory, filename))
+            top = _cprofile_top(profiler, config["PROFILING_TOP"])
+        else:
+            filename = name + ".collapsed"
+            profiler.dump(os.path.join(directory, filename))
+            top = profiler.top(config["PROFILING_TOP"])
+
+        response.headers["X-Profile-File"] = filename
+        response.headers["X-Profile-Top"] = ", ".join(
+            "{}={:.2f}ms".format(function, milliseconds)
+            for function, milliseconds in top
+        )
+        return response
+
+    def forget_profiler(_error):
+        # also after a failed request, the next request served by the thread must not see the profiler
+        token = g.pop("profiler_token", None)
+        if token is not None:
+            _current_profiler.reset(token)
+
+    app.before_request(start_profiler)
+    app.after_request(stop_profiler)
+    app.teardown_request(forget_profiler)
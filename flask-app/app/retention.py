@@ -0,0 +1,286 @@
+"""
+Retention of the stock report history
+
+The history only grows, so with STOCK_RETENTION_DAYS set the reports older than that many days are compacted in the
+background: StockStore.compact replaces them by daily summaries, which keep the daily history of GET
+/stocklevel/history, and keeps the newest report of each location whatever its age, so the latest stock levels do not
+change. A thread of each worker process checks every CHECK_INTERVAL seconds whether STOCK_COMPACTION_INTERVAL seconds
+went by since the last compaction, the worker holding the lock on <STOCK_COMPACTION_STATUS>.lock compacts while the
+others keep serving reads and writes.
+
+The progress, the time of the last successful compaction and the reports compacted and bytes reclaimed so far are
+written to the STOCK_COMPACTION_STATUS json file, shared by the workers of a host, and exported as the
+stock_compaction_* metrics.
+
+With STOCK_STALE_AFTER set, GET /stocklevel leaves out the locations whose latest report is older than that many
+seconds, see stale_cutoff.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+from flask import Flask
+
+from app.storage import DATETIME_FORMAT, StockStore
+
+logger = logging.getLogger(__name__)
+
+# seconds between two checks of whether a compaction is due
+CHECK_INTERVAL = 60
+# seconds between two writes of the progress of a compaction to the status file
+PROGRESS_INTERVAL = 1.0
+# the stale cutoff moves by steps of this many seconds, so that the ETags of the reports change at most this often
+STALE_RESOLUTION = 60
+
+
+class Compactor:
+    """
+    Background compaction of the history of a store according to a retention policy
+    """
+
+    def __init__(
+        self,
+        get_store: Callable[[], StockStore],
+        retention_days: int,
+        interval: float,
+        status_path: str,
+    ):
+        """
+        Args:
+            get_store (Callable[[], StockStore]): returns the store of the process
+            retention_days (int): days during which the raw reports are kept
+            interval (float): seconds between two compactions
+            status_path (str): json file of the status of the compactions, shared by the workers of a host
+        """
+        self.get_store = get_store
+        self.retention_days = retention_days
+        self.interval = interval
+        self.status_path = status_path
+        self.lock_path = status_path + ".lock"
+        self._reset()
+        # a forked worker starts its own thread, the thread of its parent is not forked
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.stop)
+
+    def _reset(self):
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def ensure_started(self):
+        """
+        Start the background thread in this process, lazily so that no thread is forked with the gunicorn master
+        """
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._stopped.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name="compactor", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread, a compaction in progress is finished first
+        """
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(min(CHECK_INTERVAL, self.interval)):
+            try:
+                self.run_once()
+            except NotImplementedError:
+                logger.warning("The storage backend does not compact its history")
+                return
+            except Exception:  # pylint: disable = broad-except
+                # tried again at the next interval
+                logger.exception("Compaction of the stock history failed")
+
+    def cutoff(self) -> datetime:
+        """
+        Reports made before this time (naive UTC), the start of the day retention_days ago, are compacted
+        """
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        return today - timedelta(days=self.retention_days)
+
+    def run_once(self, force: bool = False) -> Optional[Dict[str, int]]:
+        """
+        Compact the history unless another process is compacting it or it was compacted less than interval seconds
+        ago
+
+        Args:
+            force (bool): compact even if the last compaction is recent
+
+        Returns:
+            Optional[Dict[str, int]]: result of StockStore.compact, None when skipped
+        """
+        lock = os.open(self.lock_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None  # another worker is compacting
+            status = self.status()
+            if not force and time.time() - status.get("finished", 0) < self.interval:
+                return None
+
+            cutoff = self.cutoff()
+            status.update(
+                running=True,
+                progress=0.0,
+                started=time.time(),
+                cutoff=cutoff.strftime(DATETIME_FORMAT),
+            )
+            self._write_status(status)
+            written = [time.monotonic()]
+
+            def progress(fraction: float):
+                status["progress"] = fraction
+                if time.monotonic() - written[0] >= PROGRESS_INTERVAL:
+                    self._write_status(status)
+                    written[0] = time.monotonic()
+
+            try:
+                result = self.get_store().compact(cutoff, progress)
+            except BaseException as error:
+                status.update(running=False, finished=time.time(), error=repr(error))
+                self._write_status(status)
+                raise
+
+            status.update(
+                running=False,
+                progress=1.0,
+                finished=time.time(),
+                last_success=time.time(),
+                last_result=result,
+                error=None,
+            )
+            status["reports_compacted_total"] = (
+                status.get("reports_compacted_total", 0) + result["reports_compacted"]
+            )
+            status["reclaimed_bytes_total"] = (
+                status.get("reclaimed_bytes_total", 0) + result["bytes_reclaimed"]
+            )
+            self._write_status(status)
+            logger.info("Compacted the stock history", extra=result)
+            return result
+        finally:
+            # also releases the lock
+            os.close(lock)
+
+    def running(self) -> bool:
+        """
+        Whether a process of the host is compacting the history
+        """
+        try:
+            lock = os.open(self.lock_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            return False
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(lock)
+
+    def status(self) -> Dict:
+        """
+        Status of the compactions written by the workers of the host, empty before the first one
+        """
+        try:
+            with open(self.status_path) as status_file:
+                return json.load(status_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_status(self, status: Dict):
+        path = "{}.{}.tmp".format(self.status_path, os.getpid())
+        with open(path, "w") as status_file:
+            json.dump(status, status_file)
+        # readers never see a partial file
+        os.replace(path, self.status_path)
+
+    def gauges(self) -> Dict[str, float]:
+        """
+        stock_compaction_* metrics
+        """
+        status = self.status()
+        running = self.running()
+        progress = status.get("progress", 0.0) if running else 0.0
+        return {
+            "stock_compaction_running": float(running),
+            "stock_compaction_progress_ratio": progress,
+            "stock_compaction_last_success_timestamp_seconds": status.get(
+                "last_success", 0
+            ),
+            "stock_compaction_reports_compacted_total": status.get(
+                "reports_compacted_total", 0
+            ),
+            "stock_compaction_reclaimed_bytes_total": status.get(
+                "reclaimed_bytes_total", 0
+            ),
+        }
+
+
+def stale_cutoff(stale_after: float) -> Optional[str]:
+    """
+    Datetime of the oldest report still fresh, as formatted in the reports, or None when stale reports are shown
+
+    Args:
+        stale_after (float): STOCK_STALE_AFTER, seconds after which a report is stale, 0 to show every report
+
+    Returns:
+        Optional[str]: DATETIME_FORMAT string, moving by steps of STALE_RESOLUTION seconds
+    """
+    if not stale_after:
+        return None
+    cutoff = time.time() - stale_after
+    cutoff -= cutoff % STALE_RESOLUTION
+    return time.strftime(DATETIME_FORMAT, time.gmtime(cutoff))
+
+
+def hide_stale(records: Iterable[Dict], cutoff: str) -> Iterator[Dict]:
+    """
+    Leave out the reports made before cutoff, see stale_cutoff
+
+    The datetimes of the reports are compared as strings, DATETIME_FORMAT sorts like the time.
+    """
+    return (record for record in records if record["datetime"] >= cutoff)
+
+
+def init_app(app: Flask, get_store: Callable[[], StockStore]) -> Optional[Compactor]:
+    """
+    Compact the history of the store in the background according to the STOCK_RETENTION_DAYS and STOCK_COMPACTION_*
+    settings of the app config
+
+    Args:
+        app (Flask): app whose first request of each worker starts the compaction thread
+        get_store (Callable[[], StockStore]): returns the store of the process
+
+    Returns:
+        Optional[Compactor]: None when the retention is disabled
+    """
+    config = app.config
+    if not config["STOCK_RETENTION_DAYS"]:
+        return None
+    compactor = Compactor(
+        get_store,
+        config["STOCK_RETENTION_DAYS"],
+        config["STOCK_COMPACTION_INTERVAL"],
+        config["STOCK_COMPACTION_STATUS"],
+    )
+    app.extensions["compactor"] = compactor
+    app.before_request(compactor.ensure_started)
+    return compactor
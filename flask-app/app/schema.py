@@ -4,7 +4,17 @@ This script defines the schemas of the models of the API inputs/ outputs using M
 
 https://marshmallow.readthedocs.io/en/stable/quickstart.html
 """
-from marshmallow import INCLUDE, Schema, fields, validate
+from datetime import timezone
+
+from webargs.fields import DelimitedList
+from marshmallow import (
+    INCLUDE,
+    Schema,
+    ValidationError,
+    fields,
+    validate,
+    validates_schema,
+)
 
 
 class ColourSchema(Schema):
@@ -87,6 +97,20 @@ class ErrorResponseSchema(Schema):
     error = fields.Nested(ErrorDetailSchema)
 
 
+# product types the stock is reported for, in the order of the rows of the stock level matrix
+PRODUCT_TYPES = [
+    "toilet_paper",
+    "soap",
+    "hand_sanitiser",
+    "milk",
+    "bread",
+    "pasta",
+    "tinned_food",
+    "fresh_fruit",
+    "fresh_vegetables",
+]
+
+
 class StockProductTypeSchema(Schema):
     """
 
@@ -94,19 +118,7 @@ class StockProductTypeSchema(Schema):
 
     product_type = fields.Str(
         required=True,
-        validate=validate.OneOf(
-            [
-                "toilet_paper",
-                "soap",
-                "hand_sanitiser",
-                "milk",
-                "bread",
-                "pasta",
-                "tinned_food",
-                "fresh_fruit",
-                "fresh_vegetables",
-            ]
-        ),
+        validate=validate.OneOf(PRODUCT_TYPES),
         description="Product type the report relates to",
     )
 
@@ -139,9 +151,198 @@ class StockItemSchema(StockProductTypeSchema):
     )  # format='%Y-%m-%dT%H:%M:%Sz'
 
 
+class StockReportItemSchema(StockItemSchema):
+    """
+    Stock item of a report (extends Stock item schema)
+    """
+
+    distance_km = fields.Float(
+        required=False, description="Distance from lat/lng of a radius query"
+    )
+
+
+# fields of the stock items returned by the report, may be projected with the "fields" parameter
+STOCK_REPORT_FIELDS = sorted(StockReportItemSchema().fields)
+
+
+class StockLevelQuerySchema(StockProductTypeSchema):
+    """
+    Query string parameters of the stock level report (extends Product Types Schema)
+    """
+
+    stream = fields.Bool(
+        required=False,
+        missing=False,
+        description="Stream the report as newline delimited json (application/x-ndjson)",
+    )
+
+    # "near me" query: reports within radius_km of (lat, lng)
+    lat = fields.Float(
+        validate=validate.Range(min=-90, max=90), description="Latitude of the user"
+    )
+    lng = fields.Float(
+        validate=validate.Range(min=-180, max=180),
+        description="Longitude of the user",
+    )
+    radius_km = fields.Float(
+        validate=validate.Range(min=0, max=500),
+        description="Search radius around lat/lng in km",
+    )
+
+    # bounding box query
+    min_lat = fields.Float(validate=validate.Range(min=-90, max=90))
+    min_lng = fields.Float(validate=validate.Range(min=-180, max=180))
+    max_lat = fields.Float(validate=validate.Range(min=-90, max=90))
+    max_lng = fields.Float(validate=validate.Range(min=-180, max=180))
+
+    # pagination, ordered by geocode
+    limit = fields.Int(
+        validate=validate.Range(min=1, max=10000),
+        description="Maximum number of locations in the page",
+    )
+    cursor = fields.Str(description="next_cursor of the previous page")
+
+    # point in time snapshot
+    as_of = fields.DateTime(
+        description="Report the stock levels as they were at this time (UTC)"
+    )
+
+    # projection, "fields" is reserved by marshmallow so it is loaded as "projection"
+    projection = DelimitedList(
+        fields.Str(),
+        data_key="fields",
+        validate=validate.ContainsOnly(STOCK_REPORT_FIELDS),
+        description="Comma separated fields of each stock item to return",
+    )
+
+    @validates_schema
+    def validate_area(self, data, **kwargs):  # pylint: disable = unused-argument
+        """
+        A radius query needs lat, lng and radius_km, a bounding box query needs all four corners
+        """
+        radius = [name for name in ("lat", "lng", "radius_km") if name in data]
+        bbox = [
+            name for name in ("min_lat", "min_lng", "max_lat", "max_lng") if name in data
+        ]
+        if radius and bbox:
+            raise ValidationError("Use either lat/lng/radius_km or a bounding box")
+        if radius and len(radius) < 3:
+            raise ValidationError("lat, lng and radius_km must be given together")
+        if bbox and len(bbox) < 4:
+            raise ValidationError(
+                "min_lat, min_lng, max_lat and max_lng must be given together"
+            )
+        if (radius or bbox) and ("limit" in data or "cursor" in data):
+            raise ValidationError("limit and cursor cannot be used with an area query")
+        if "as_of" in data and (radius or bbox or "limit" in data or "cursor" in data):
+            raise ValidationError(
+                "as_of cannot be used with an area query or pagination"
+            )
+        if bbox and (
+            data["min_lat"] > data["max_lat"] or data["min_lng"] > data["max_lng"]
+        ):
+            raise ValidationError("The bounding box minimum must be below its maximum")
+
+
 class StockLevelReportSchema(Schema):
     """
     A submission of the stock level of a specific product type at a specific location
     """
 
-    data = fields.List(fields.Nested(StockItemSchema))
+    data = fields.List(fields.Nested(StockReportItemSchema))
+    next_cursor = fields.Str(
+        allow_none=True,
+        description="Cursor of the next page when a limit is given, null on the last page",
+    )
+
+
+class StockLevelMatrixSchema(Schema):
+    """
+    Latest stock level of every product type at every location
+    """
+
+    version = fields.Int(
+        description="Version of the matrix, increases with every submitted report"
+    )
+    product_types = fields.List(fields.Str(), description="Product type of each row")
+    locations = fields.List(fields.Str(), description="Geocode of each column, sorted")
+    levels = fields.List(
+        fields.List(fields.Int(allow_none=True)),
+        description="levels[row][column], null when the location has no report for the product type",
+    )
+
+
+class StockBatchErrorSchema(Schema):
+    """
+    Validation error of a single report of a batch submission
+    """
+
+    index = fields.Int(required=True, description="Position of the report in the batch")
+    message = fields.Dict(
+        required=True, description="Validation error messages for each field"
+    )
+
+
+class StockBatchResponseSchema(StandardResponseSchema):
+    """
+    Response of a batch submission of stock levels (extends Standard Response Schema)
+    """
+
+    accepted = fields.Int(required=True, description="Number of reports recorded")
+    rejected = fields.Int(required=True, description="Number of invalid reports")
+    errors = fields.List(fields.Nested(StockBatchErrorSchema), required=True)
+
+
+class StockHistoryQuerySchema(StockProductTypeSchema):
+    """
+    Query string parameters of the stock level history of a location (extends Product Types Schema)
+    """
+
+    geocode = fields.Str(required=True, description="Geocode of the location")
+    start = fields.DateTime(
+        description="Start of the time range (UTC), defaults to 7 days before end"
+    )
+    end = fields.DateTime(description="End of the time range (UTC), defaults to now")
+    bucket = fields.Str(
+        missing="hour",
+        validate=validate.OneOf(["hour", "day"]),
+        description="Size of the time buckets",
+    )
+
+    @validates_schema
+    def validate_range(self, data, **kwargs):  # pylint: disable = unused-argument
+        """
+        The time range must not end before it starts
+        """
+        if "start" not in data or "end" not in data:
+            return
+        # naive datetimes are UTC, as for the stored reports
+        start, end = (
+            data[name].replace(tzinfo=data[name].tzinfo or timezone.utc)
+            for name in ["start", "end"]
+        )
+        if start > end:
+            raise ValidationError("start must be before end")
+
+
+class StockHistoryBucketSchema(Schema):
+    """
+    Aggregated stock levels of a location over one time bucket
+    """
+
+    bucket_start = fields.Str(
+        required=True, description="Start of the bucket format='%Y-%m-%dT%H:%M:%Sz'"
+    )
+    count = fields.Int(required=True, description="Number of reports")
+    min = fields.Int(required=True, description="Lowest reported stock level")
+    max = fields.Int(required=True, description="Highest reported stock level")
+    mean = fields.Float(required=True, description="Mean reported stock level")
+    last = fields.Int(required=True, description="Most recent reported stock level")
+
+
+class StockHistoryResponseSchema(Schema):
+    """
+    Stock level history of a location, buckets without reports are omitted
+    """
+
+    data = fields.List(fields.Nested(StockHistoryBucketSchema))
@@ -0,0 +1,1789 @@
+"""
+Storage backends for the stock reports
+
+submit_stocklevel and get_stocklevel in utils.py go through the StockStore interface, the backend is chosen with the
+DB_BACKEND setting of DbConfig in config.py:
+    csv: append-only csv history file with an in-process index of the latest reports
+    columnar: append-only memory mapped columnar history (see columnar.py) with the same in-process index
+    sql: SQLAlchemy table, e.g. the postgres service in docker-compose.yaml or a local sqlite file
+
+AsyncStockStore exposes a backend to the async endpoints, its blocking calls run on a bounded thread pool.
+"""
+import asyncio
+import calendar
+import collections
+import csv
+import fcntl
+import functools
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from app.geo import BoundingBox, haversine_km, radius_bbox, record_position
+from app.index import (
+    BACKFILL_MIN_ROWS,
+    BUCKET_SECONDS,
+    CsvHistoryTail,
+    LatestStockIndex,
+    StockRollups,
+    StockTimeline,
+    rollup_record,
+)
+from app.profiling import profile_call
+from config import DbConfig
+
+if TYPE_CHECKING:
+    # numpy is only imported by the columnar backend, the csv and sql workers start without it
+    import numpy as np
+
+# Column order of the history file, matches the header of db/stock_db.csv
+STOCK_COLUMNS = [
+    "datetime",
+    "geocode",
+    "input_address",
+    "lat",
+    "lng",
+    "product_type",
+    "resolved_address",
+    "stock_level",
+]
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%Sz"
+
+# Columns of the daily summaries of the reports compacted out of a csv history, see CsvStockStore.compact
+SUMMARY_COLUMNS = [
+    "product_type",
+    "geocode",
+    "day",
+    "count",
+    "min",
+    "max",
+    "sum",
+    "last_datetime",
+    "last_stock_level",
+]
+
+# Supported fsync policies for the history file
+FSYNC_POLICIES = ("always", "interval", "never")
+# reports of the sql backend compacted per transaction
+COMPACTION_BATCH = 500
+# sql dialects upserting the rollup tables with INSERT ... ON CONFLICT DO UPDATE
+UPSERT_DIALECTS = ("postgresql", "sqlite")
+_last_fsync = 0.0  # time of the last fsync made by this worker process
+
+
+def _format_stock_row(stock_data: Dict) -> str:
+    """
+    Format a stock report as a single csv line following STOCK_COLUMNS
+
+    Args:
+        stock_data (Dict): follows the schema of the StockItemSchema object found in schema.py
+
+    Returns:
+        str: csv encoded line, including the line terminator
+    """
+    row = dict(stock_data)
+    if isinstance(row["datetime"], datetime):
+        row["datetime"] = row["datetime"].strftime(DATETIME_FORMAT)
+
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerow(
+        [row.get(column, "") for column in STOCK_COLUMNS]
+    )
+    return buffer.getvalue()
+
+
+def _sync_file(fd: int, policy: str, interval: float):
+    """
+    fsync the history file according to the configured policy
+
+    Args:
+        fd (int): file descriptor of the open history file
+        policy (str): one of FSYNC_POLICIES
+        interval (float): seconds between fsyncs when the policy is "interval"
+    """
+    global _last_fsync  # pylint: disable = global-statement
+
+    if policy == "always":
+        os.fsync(fd)
+    elif policy == "interval":
+        now = time.monotonic()
+        if now - _last_fsync >= interval:
+            os.fsync(fd)
+            _last_fsync = now
+
+
+def append_lines(filepath: str, lines: List[str], header: str = "") -> int:
+    """
+    Append lines to a file while holding an exclusive cross-process lock
+
+    The lines are written with a single write call on a file opened in append mode, so a report is never
+    interleaved with a report from another gunicorn worker. The header is written first when the file is empty.
+
+    Args:
+        filepath (str): path of the file to append to
+        lines (List[str]): encoded lines, each including its line terminator
+        header (str): header line written when the file is empty
+
+    Returns:
+        int: size of the file after the write
+    """
+    policy = DbConfig["DB_FSYNC"]
+    if policy not in FSYNC_POLICIES:
+        raise ValueError(
+            "DB_FSYNC must be one of {}, got {!r}".format(FSYNC_POLICIES, policy)
+        )
+
+    while True:
+        fd = os.open(filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # Block until no other process is writing to the file
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if _replaced(filepath, fd):
+                    # compacted while waiting for the lock, append to the new file instead
+                    continue
+                data = "".join(lines)
+                if header and os.fstat(fd).st_size == 0:
+                    data = header + data
+                os.write(fd, data.encode("utf-8"))
+                _sync_file(fd, policy, DbConfig["DB_FSYNC_INTERVAL"])
+                return os.fstat(fd).st_size
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+
+def _replaced(filepath: str, fd: int) -> bool:
+    """
+    Whether the path no longer names the open file, e.g. replaced by a compaction of the history
+    """
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return True
+    opened = os.fstat(fd)
+    return (stat.st_dev, stat.st_ino) != (opened.st_dev, opened.st_ino)
+
+
+def _epoch_seconds(timestamp) -> int:
+    """
+    Seconds since the epoch of a report datetime, naive datetimes and strings are UTC
+    """
+    if isinstance(timestamp, str):
+        timestamp = datetime.strptime(timestamp, DATETIME_FORMAT)
+    if timestamp.tzinfo is None:
+        return calendar.timegm(timestamp.timetuple())
+    return int(timestamp.timestamp())
+
+
+def _format_epoch(seconds: int) -> str:
+    """
+    Report datetime string of seconds since the epoch
+    """
+    return time.strftime(DATETIME_FORMAT, time.gmtime(int(seconds)))
+
+
+class StockStore:
+    """
+    Interface of a stock report storage backend
+    """
+
+    def submit(self, records: List[Dict]):
+        """
+        Store stock reports
+
+        Args:
+            records (List[Dict]): follow the schema of the StockItemSchema object found in schema.py
+        """
+        raise NotImplementedError
+
+    def latest(self, product_type: str) -> List[Dict]:
+        """
+        Get the newest report of every location for a product type
+
+        Args:
+            product_type (str): one of the given product types
+
+        Returns:
+            List[Dict]: stock reports, most recent first
+        """
+        raise NotImplementedError
+
+    def version(self, product_type: str) -> Tuple[int, Optional[datetime]]:
+        """
+        Version of the reports of a product type, bumped by every submitted report
+
+        Args:
+            product_type (str): one of the given product types
+
+        Returns:
+            Tuple[int, Optional[datetime]]: monotonically increasing version and the time the reports of the product type
+                last changed (UTC), (0, None) when there is no report
+        """
+        raise NotImplementedError
+
+    def iter_latest(self, product_type: str) -> Iterator[Dict]:
+        """
+        Iterate over the newest report of every location for a product type as they are read from storage
+
+        Unlike latest() the reports are not sorted, so they can be streamed without holding the full report in memory.
+
+        Args:
+            product_type (str): one of the given product types
+
+        Returns:
+            Iterator[Dict]: stock reports
+        """
+        return iter(self.latest(product_type))
+
+    def page(self, product_type: str, after: Optional[str], limit: int) -> List[Dict]:
+        """
+        Get the newest reports of a product type ordered by geocode, starting after a given geocode
+
+        The geocode is a stable ordering key, so the pages do not shift while new reports arrive and a deep page
+        costs the same as the first one.
+
+        Args:
+            product_type (str): one of the given product types
+            after (Optional[str]): last geocode of the previous page, None for the first page
+            limit (int): maximum number of reports
+
+        Returns:
+            List[Dict]: stock reports
+        """
+        raise NotImplementedError
+
+    def within(self, product_type: str, bbox: BoundingBox) -> List[Dict]:
+        """
+        Get the newest report of every location of a product type inside a bounding box
+
+        Args:
+            product_type (str): one of the given product types
+            bbox (BoundingBox): (min_lat, min_lng, max_lat, max_lng)
+
+        Returns:
+            List[Dict]: stock reports
+        """
+        raise NotImplementedError
+
+    def nearby(
+        self, product_type: str, lat: float, lng: float, radius_km: float
+    ) -> List[Dict]:
+        """
+        Get the newest report of every location of a product type within a radius, nearest first
+
+        Args:
+            product_type (str): one of the given product types
+            lat (float): latitude of the centre in degrees
+            lng (float): longitude of the centre in degrees
+            radius_km (float): radius of the search
+
+        Returns:
+            List[Dict]: stock reports with their distance_km from the centre
+        """
+        records = []
+        for record in self.within(product_type, radius_bbox(lat, lng, radius_km)):
+            position = record_position(record)
+            if position is None:
+                # lat/lng are not numbers, so it is not within any radius
+                continue
+            distance = haversine_km(lat, lng, *position)
+            if distance <= radius_km:
+                records.append(dict(record, distance_km=round(distance, 3)))
+        records.sort(key=lambda record: record["distance_km"])
+        return records
+
+    def matrix_version(self, product_types: List[str]) -> int:
+        """
+        Version of the stock level matrix, bumped by every submitted report, see matrix()
+
+        Args:
+            product_types (List[str]): product type of each row
+
+        Returns:
+            int: monotonically increasing version
+        """
+        return sum(self.version(product_type)[0] for product_type in product_types)
+
+    def matrix(self, product_types: List[str]) -> Dict:
+        """
+        Get the latest stock level of every product type at every location in one dense matrix
+
+        Args:
+            product_types (List[str]): product type of each row
+
+        Returns:
+            Dict: version (see matrix_version), product_types, locations (sorted geocodes) and levels, one row per
+                product type with a stock level or None for each location
+        """
+        version = self.matrix_version(product_types)
+        latest = {
+            product_type: {
+                record["geocode"]: record["stock_level"]
+                for record in self.latest(product_type)
+            }
+            for product_type in product_types
+        }
+        locations = sorted(set().union(*latest.values()))
+        return dict(
+            version=version,
+            product_types=list(product_types),
+            locations=locations,
+            levels=[
+                [latest[product_type].get(geocode) for geocode in locations]
+                for product_type in product_types
+            ],
+        )
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Statistics of the stored reports exported as metrics, a backend omits the ones it cannot get cheaply
+
+        Returns:
+            Dict[str, float]: reports, locations and size_bytes of the history
+        """
+        return {}
+
+    def as_of(self, product_type: str, timestamp: datetime) -> List[Dict]:
+        """
+        Get the newest report of every location for a product type at a point in time
+
+        Args:
+            product_type (str): one of the given product types
+            timestamp (datetime): point in time (UTC), reports made at that exact time are included
+
+        Returns:
+            List[Dict]: stock reports, most recent first
+        """
+        raise NotImplementedError
+
+    def history(
+        self,
+        product_type: str,
+        geocode: str,
+        bucket: str,
+        start: datetime,
+        end: datetime,
+    ) -> List[Dict]:
+        """
+        Get hourly or daily aggregates of the stock level of a location
+
+        Args:
+            product_type (str): one of the given product types
+            geocode (str): geocode of the location
+            bucket (str): "hour" or "day"
+            start (datetime): start of the time range (UTC)
+            end (datetime): end of the time range (UTC)
+
+        Returns:
+            List[Dict]: count, min, max, mean and last stock level of each bucket with reports, oldest first
+        """
+        raise NotImplementedError
+
+    def compact(
+        self, cutoff: datetime, progress: Callable[[float], None]
+    ) -> Dict[str, int]:
+        """
+        Replace the reports made before a point in time by daily summaries, see retention.py
+
+        The newest report of each location is kept whatever its age, so the latest stock levels and the versions do
+        not change. The daily history keeps its aggregates, the hourly history and as_of are only exact after the
+        cutoff. Reads and writes go on during the compaction.
+
+        Args:
+            cutoff (datetime): reports made before this time (UTC), the start of a day, are compacted
+            progress (Callable[[float], None]): called with the fraction of the work done
+
+        Returns:
+            Dict[str, int]: reports_compacted, summaries written and bytes_reclaimed
+
+        Raises:
+            NotImplementedError: the backend cannot compact its history
+        """
+        raise NotImplementedError
+
+
+class IndexedStockStore(StockStore):
+    """
+    Stock reports appended to an append-only history, queried through an in-process LatestStockIndex
+
+    Subclasses implement submit() and refresh(), which indexes the reports appended since the last refresh.
+    """
+
+    def __init__(self):
+        self.index = LatestStockIndex(cell_size=DbConfig["GEO_CELL_SIZE"])
+        # hourly and daily aggregates of each location, updated with the index
+        self.rollups = StockRollups()
+        # every report of each location sorted by datetime, for point-in-time queries
+        self.timeline = StockTimeline()
+        # timeline reference of the latest report of each location, and the latest reports by reference
+        self._latest_references: Dict[Tuple[str, str], int] = {}
+        self._latest_records: Dict[int, Dict] = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Index the reports appended to the history since the last refresh, including other workers' reports
+        """
+        raise NotImplementedError
+
+    def reset(self):
+        """
+        Forget every indexed report, e.g. before reading a replaced history from the start
+        """
+        self.index.reset()
+        self.rollups.reset()
+        self.timeline.reset()
+        self._latest_references.clear()
+        self._latest_records.clear()
+
+    def _place(self, record: Dict, reference: int, count: bool = True):
+        """
+        Add a report to the index, see LatestStockIndex.add
+
+        Args:
+            record (Dict): normalised stock report
+            reference (int): reference to the report held by the timeline
+            count (bool): count the report in the versions, False when the caller counts the reports in bulk
+        """
+        if not (self.index.add(record) if count else self.index.place(record)):
+            return
+        location = (record["product_type"], record["geocode"])
+        previous = self._latest_references.get(location)
+        if previous is not None:
+            del self._latest_records[previous]
+        self._latest_references[location] = reference
+        self._latest_records[reference] = record
+
+    def _reader(self) -> Callable[[List[int]], List[Dict]]:
+        """
+        Function reading back the reports of timeline references, bound to the history indexed so far so that it can
+        be called without the lock
+        """
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, float]:
+        self.refresh()
+        reports, locations = self.index.counts()
+        return dict(reports=reports, locations=locations)
+
+    def latest(self, product_type: str) -> List[Dict]:
+        # pick up reports written by other workers
+        self.refresh()
+        return self.index.latest(product_type)
+
+    def version(self, product_type: str) -> Tuple[int, Optional[datetime]]:
+        self.refresh()
+        version, modified = self.index.version(product_type)
+        if modified is None:
+            return version, None
+        # workers cannot agree on a wall clock time, use the newest report instead
+        return version, datetime.strptime(modified, DATETIME_FORMAT)
+
+    def iter_latest(self, product_type: str) -> Iterator[Dict]:
+        self.refresh()
+        return self.index.iter_latest(product_type)
+
+    def page(self, product_type: str, after: Optional[str], limit: int) -> List[Dict]:
+        self.refresh()
+        return self.index.page(product_type, after, limit)
+
+    def within(self, product_type: str, bbox: BoundingBox) -> List[Dict]:
+        self.refresh()
+        return self.index.within(product_type, bbox)
+
+    def matrix_version(self, product_types: List[str]) -> int:
+        self.refresh()
+        return self.index.counts()[0]
+
+    def matrix(self, product_types: List[str]) -> Dict:
+        self.refresh()
+        # the matrix is updated in place by refresh()
+        with self._lock:
+            return self.index.matrix(product_types)
+
+    def as_of(self, product_type: str, timestamp: datetime) -> List[Dict]:
+        self.refresh()
+        with self._lock:
+            references = self.timeline.as_of(product_type, _epoch_seconds(timestamp))
+            # the latest reports are indexed, only the older ones are read back from the history
+            latest = [self._latest_records.get(reference) for reference in references]
+            older = [
+                reference
+                for reference, record in zip(references, latest)
+                if record is None
+            ]
+            read = self._reader()
+        older_records = iter(read(older) if older else [])
+        records = [
+            next(older_records) if record is None else record for record in latest
+        ]
+        records.sort(key=lambda record: record["datetime"], reverse=True)
+        return records
+
+    def history(
+        self,
+        product_type: str,
+        geocode: str,
+        bucket: str,
+        start: datetime,
+        end: datetime,
+    ) -> List[Dict]:
+        self.refresh()
+        # the buckets are folded into new arrays by refresh()
+        with self._lock:
+            return self.rollups.query(
+                product_type,
+                geocode,
+                bucket,
+                _epoch_seconds(start),
+                _epoch_seconds(end),
+            )
+
+
+def _read_summaries(path: str) -> Iterator[Tuple[str, str, int, List[int]]]:
+    """
+    Read a daily summaries file written by _write_summaries
+
+    Returns:
+        Iterator[Tuple[str, str, int, List[int]]]: product_type, geocode, start of the day (seconds since the epoch) and
+            aggregates [count, min, max, sum, last datetime, last stock level] of each summary
+    """
+    try:
+        summaries_file = open(path, newline="")
+    except FileNotFoundError:
+        return
+    with summaries_file:
+        for row in csv.DictReader(summaries_file):
+            yield row["product_type"], row["geocode"], _epoch_seconds(row["day"]), [
+                int(row["count"]),
+                int(row["min"]),
+                int(row["max"]),
+                int(row["sum"]),
+                _epoch_seconds(row["last_datetime"]),
+                int(row["last_stock_level"]),
+            ]
+
+
+def _write_summaries(path: str, rollups: StockRollups) -> int:
+    """
+    Write the daily buckets of rollups as a summaries file, see SUMMARY_COLUMNS
+
+    Returns:
+        int: number of summaries written
+    """
+    n_summaries = 0
+    with open(path, "w", newline="") as summaries_file:
+        writer = csv.writer(summaries_file, lineterminator="\n")
+        writer.writerow(SUMMARY_COLUMNS)
+        for product_type, geocode, start, aggregates in rollups.buckets("day"):
+            count, minimum, maximum, total, last_datetime, last = aggregates
+            writer.writerow(
+                [
+                    product_type,
+                    geocode,
+                    _format_epoch(start),
+                    count,
+                    minimum,
+                    maximum,
+                    total,
+                    _format_epoch(last_datetime),
+                    last,
+                ]
+            )
+            n_summaries += 1
+        summaries_file.flush()
+        os.fsync(summaries_file.fileno())
+    return n_summaries
+
+
+def _complete_size(filepath: str, size: int) -> int:
+    """
+    Size of the complete lines among the first size bytes of a file, a write may still be in flight at the end
+    """
+    with open(filepath, "rb") as history:
+        history.seek(max(0, size - 65536))
+        data = history.read(size - history.tell())
+    return size - len(data) + data.rfind(b"\n") + 1
+
+
+class CsvStockStore(IndexedStockStore):
+    """
+    Stock reports appended to a csv history file
+    """
+
+    def __init__(self, filepath: str):
+        super().__init__()
+        self.filepath = filepath
+        # daily summaries of the reports compacted out of the history, e.g. db/stock_db.daily.csv
+        self.summaries_path = os.path.splitext(filepath)[0] + ".daily.csv"
+        self._tail = CsvHistoryTail(filepath)
+        # held by the thread indexing a replaced history, see _rebuild
+        self._rebuild_lock = threading.Lock()
+        self._load_summaries()
+        self.refresh()
+
+    def _load_summaries(self):
+        """
+        Add the summaries of the compacted reports to the daily rollups, the reports still count in the versions
+        """
+        locations: Dict[Tuple[str, str], int] = {}
+        location_index, starts, rows = [], [], []
+        for product_type, geocode, start, aggregates in _read_summaries(
+            self.summaries_path
+        ):
+            location_index.append(
+                locations.setdefault((product_type, geocode), len(locations))
+            )
+            starts.append(start)
+            rows.append(aggregates)
+            self.index.count(product_type, aggregates[0], _format_epoch(aggregates[4]))
+        if rows:
+            # only needed once the history was compacted
+            import numpy as np  # pylint: disable = import-outside-toplevel
+
+            self.rollups.merge_many(
+                "day",
+                list(locations),
+                location_index,
+                starts,
+                list(np.array(rows, dtype=np.int64).T),
+            )
+
+    def refresh(self):
+        if self._tail.replaced():
+            self._rebuild()
+        with self._lock:
+            if self._tail.replaced():
+                # another thread is indexing the replaced history, the current index answers meanwhile
+                return
+            while True:
+                # a large history is read in parts
+                restarted, records, offsets = self._tail.read()
+                if restarted:
+                    # replaced since the check above, e.g. compacted: the summaries were replaced before the history
+                    self.reset()
+                    self._load_summaries()
+                if not records:
+                    return
+
+                if len(records) < BACKFILL_MIN_ROWS:
+                    for record, offset in zip(records, offsets):
+                        timestamp = _epoch_seconds(record["datetime"])
+                        self.rollups.add(
+                            record["product_type"],
+                            record["geocode"],
+                            timestamp,
+                            record["stock_level"],
+                        )
+                        self.timeline.add(
+                            record["product_type"], record["geocode"], timestamp, offset
+                        )
+                        # the timeline holds the offsets of the reports, only the latest ones stay in memory
+                        self._place(record, offset)
+                else:
+                    self._backfill(records, offsets)
+
+    def _rebuild(self):
+        """
+        Index a replaced history, e.g. compacted, and its summaries into new structures then swap them in
+
+        The history is indexed without the lock, so that the queries keep being answered by the current index in the
+        meantime, at the cost of holding both indexes until the swap. Only the reports appended since are indexed
+        under the lock.
+        """
+        if not self._rebuild_lock.acquire(blocking=False):
+            return  # another thread is rebuilding
+        try:
+            if not self._tail.replaced():
+                return  # rebuilt by another thread since the caller checked
+            rebuilt = type(self)(self.filepath)
+            with self._lock:
+                rebuilt.refresh()
+                self.index, self.rollups, self.timeline = (
+                    rebuilt.index,
+                    rebuilt.rollups,
+                    rebuilt.timeline,
+                )
+                self._latest_references = rebuilt._latest_references
+                self._latest_records = rebuilt._latest_records
+                self._tail = rebuilt._tail
+        finally:
+            self._rebuild_lock.release()
+
+    def _reader(self) -> Callable[[List[int]], List[Dict]]:
+        return self._tail.reader()
+
+    def stats(self) -> Dict[str, float]:
+        stats = super().stats()
+        if os.path.exists(self.filepath):
+            stats["size_bytes"] = os.path.getsize(self.filepath)
+            if os.path.exists(self.summaries_path):
+                stats["size_bytes"] += os.path.getsize(self.summaries_path)
+        return stats
+
+    def _backfill(self, records: List[Dict], offsets: List[int]):
+        """
+        Index many reports with vectorised numpy operations, e.g. when reading the history at startup
+
+        Only the newest report of each location is placed in the index, like in ColumnarStockStore._index_rows.
+        """
+        # only needed to read a large history
+        import numpy as np  # pylint: disable = import-outside-toplevel
+
+        locations: Dict[Tuple[str, str], int] = {}
+        location_index = np.array(
+            [
+                locations.setdefault(
+                    (record["product_type"], record["geocode"]), len(locations)
+                )
+                for record in records
+            ],
+            dtype=np.int64,
+        )
+        # DATETIME_FORMAT without its "z" suffix is ISO 8601
+        timestamps = np.array(
+            [record["datetime"][:-1] for record in records], dtype="datetime64[s]"
+        ).astype(np.int64)
+        self.rollups.add_many(
+            list(locations),
+            location_index,
+            timestamps,
+            [record["stock_level"] for record in records],
+        )
+        self.timeline.add_many(list(locations), location_index, timestamps, offsets)
+
+        counts = collections.Counter(record["product_type"] for record in records)
+        newest: Dict[str, str] = {}
+        # the last report of each location sorted by datetime then line
+        order = np.lexsort((np.arange(len(records)), timestamps, location_index))
+        is_last = np.ones(len(order), dtype=bool)
+        is_last[:-1] = location_index[order][1:] != location_index[order][:-1]
+        for position in order[is_last].tolist():
+            record = records[position]
+            self._place(record, offsets[position], count=False)
+            product_type = record["product_type"]
+            newest[product_type] = max(newest.get(product_type, ""), record["datetime"])
+        for product_type, count in counts.items():
+            self.index.count(product_type, count, newest[product_type])
+
+    def submit(self, records: List[Dict]):
+        append_lines(
+            self.filepath,
+            [_format_stock_row(record) for record in records],
+            header=",".join(STOCK_COLUMNS) + "\n",
+        )
+        # the index reads the appended reports back from the end of the file
+        self.refresh()
+
+    def _scan(
+        self,
+        size: int,
+        progress: Callable[[float], None],
+        header: Callable[[bytes], object],
+    ) -> Iterator[Tuple[int, Dict, bytes]]:
+        """
+        Read the reports of the first size bytes of the history, which end with a complete line
+
+        Args:
+            size (int): bytes to read
+            progress (Callable[[float], None]): called with the fraction of the bytes read
+            header (Callable[[bytes], object]): called with the header line, e.g. the write of a file, its result
+                is ignored
+
+        Returns:
+            Iterator[Tuple[int, Dict, bytes]]: line number, raw report and line of each report
+        """
+        with open(self.filepath, "rb") as history:
+            line = history.readline()
+            header(line)
+            columns = next(csv.reader([line.decode("utf-8")]))
+            done = len(line)
+            for number, line in enumerate(history):
+                if done >= size:
+                    break
+                done += len(line)
+                values = next(csv.reader([line.decode("utf-8")]), None)
+                if values:
+                    yield number, dict(zip(columns, values)), line
+                if number % 10000 == 0:
+                    progress(done / size)
+        progress(1.0)
+
+    def compact(
+        self, cutoff: datetime, progress: Callable[[float], None]
+    ) -> Dict[str, int]:
+        """
+        Rewrite the history without the reports made before cutoff, their daily summaries are written to
+        summaries_path
+
+        The history is read twice without any lock, then the reports appended meanwhile are copied to the end of the
+        compacted history and it replaces the history, while holding the lock of the writers for that short copy
+        only. Every worker then indexes the compacted history and the summaries again.
+        """
+        result = dict(reports_compacted=0, summaries=0, bytes_reclaimed=0)
+        cutoff_text = cutoff.strftime(DATETIME_FORMAT)
+        try:
+            stat = os.stat(self.filepath)
+        except FileNotFoundError:
+            return result
+        size = _complete_size(self.filepath, stat.st_size)
+        if size == 0:
+            return result
+
+        # first pass: the newest report of each location is kept whatever its age
+        newest: Dict[Tuple[str, str], Tuple[str, int]] = {}
+        n_old = 0
+        for number, record, _ in self._scan(
+            size, lambda done: progress(done / 2), lambda line: None
+        ):
+            location = (record["product_type"], record["geocode"])
+            current = newest.get(location)
+            # later lines win ties, like in LatestStockIndex
+            if current is None or record["datetime"] >= current[0]:
+                newest[location] = (record["datetime"], number)
+            if record["datetime"] < cutoff_text:
+                n_old += 1
+        if n_old == sum(1 for latest, _ in newest.values() if latest < cutoff_text):
+            progress(1.0)
+            return result
+
+        # second pass: copy the kept reports, aggregate the others per location and day
+        summaries = StockRollups()
+        compacted_path = self.filepath + ".compacted"
+        with open(compacted_path, "wb") as compacted:
+            for number, record, line in self._scan(
+                size, lambda done: progress(0.5 + done / 2), compacted.write
+            ):
+                location = (record["product_type"], record["geocode"])
+                if record["datetime"] >= cutoff_text or newest[location][1] == number:
+                    compacted.write(line)
+                    continue
+                timestamp = _epoch_seconds(record["datetime"])
+                stock_level = int(float(record["stock_level"]))
+                summaries.merge(
+                    location[0],
+                    location[1],
+                    "day",
+                    timestamp - timestamp % BUCKET_SECONDS["day"],
+                    [1, stock_level, stock_level, stock_level, timestamp, stock_level],
+                )
+                result["reports_compacted"] += 1
+
+            # with the summaries of the previous compactions
+            summaries_size = 0
+            if os.path.exists(self.summaries_path):
+                summaries_size = os.path.getsize(self.summaries_path)
+            for product_type, geocode, start, aggregates in _read_summaries(
+                self.summaries_path
+            ):
+                summaries.merge(product_type, geocode, "day", start, aggregates)
+            result["summaries"] = _write_summaries(
+                self.summaries_path + ".tmp", summaries
+            )
+
+            fd = os.open(self.filepath, os.O_RDONLY)
+            try:
+                # wait for the writers in progress, the next ones wait for the swap
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    compacted_inode = os.fstat(fd).st_ino == stat.st_ino
+                    if _replaced(self.filepath, fd) or not compacted_inode:
+                        raise RuntimeError(
+                            "{} was replaced during its compaction".format(
+                                self.filepath
+                            )
+                        )
+                    # reports appended during the compaction
+                    end = os.fstat(fd).st_size
+                    offset = size
+                    while offset < end:
+                        data = os.pread(fd, min(end - offset, 1 << 20), offset)
+                        compacted.write(data)
+                        offset += len(data)
+                    compacted.flush()
+                    os.fsync(compacted.fileno())
+                    # summaries first, a worker indexing the old history with the new summaries reads both again
+                    # once it sees the history replaced
+                    os.replace(self.summaries_path + ".tmp", self.summaries_path)
+                    os.replace(compacted_path, self.filepath)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+
+        # the summaries of a few reports may outweigh them
+        result["bytes_reclaimed"] = max(
+            0,
+            end
+            + summaries_size
+            - os.path.getsize(self.filepath)
+            - os.path.getsize(self.summaries_path),
+        )
+        return result
+
+
+class ColumnarStockStore(IndexedStockStore):
+    """
+    Stock reports appended to a memory mapped columnar history, see columnar.py
+    """
+
+    def __init__(self, directory: str):
+        # imported here so the other backends do not load numpy
+        from app.columnar import ColumnarHistory  # pylint: disable = import-outside-toplevel
+
+        super().__init__()
+        self.columnar = ColumnarHistory(directory)
+        self._rows = 0  # rows of the history indexed so far
+        self.refresh()
+
+    def submit(self, records: List[Dict]):
+        columns: Dict[str, list] = {column: [] for column in STOCK_COLUMNS}
+        for record in records:
+            for column in STOCK_COLUMNS:
+                columns[column].append(record[column])
+        columns["datetime"] = [_epoch_seconds(value) for value in columns["datetime"]]
+        columns["lat"] = [float(value) for value in columns["lat"]]
+        columns["lng"] = [float(value) for value in columns["lng"]]
+
+        policy, interval = DbConfig["DB_FSYNC"], DbConfig["DB_FSYNC_INTERVAL"]
+        self.columnar.append(columns, sync=lambda fd: _sync_file(fd, policy, interval))
+        self.refresh()
+
+    def refresh(self):
+        with self._lock:
+            n_rows = self.columnar.row_count()
+            if n_rows < self._rows:
+                # the history was replaced
+                self.reset()
+                self._rows = 0
+            if n_rows == self._rows:
+                return
+            self._index_rows(self.columnar.columns(n_rows), self._rows, n_rows)
+            self._rows = n_rows
+
+    def _index_rows(self, columns: Dict[str, "np.ndarray"], start: int, end: int):
+        """
+        Index rows [start, end) with vectorised numpy operations
+
+        Only the newest row of each (product_type, geocode) pair is decoded, so indexing millions of rows at startup
+        costs python work proportional to the number of locations, not reports.
+        """
+        import numpy as np  # pylint: disable = import-outside-toplevel
+
+        product_types = columns["product_type"][start:end]
+        geocodes = columns["geocode"][start:end]
+        timestamps = columns["datetime"][start:end]
+
+        # number of reports and newest report of each product type
+        codes, inverse = np.unique(product_types, return_inverse=True)
+        counts = np.bincount(inverse)
+        newest = np.full(len(codes), np.iinfo(np.int64).min)
+        np.maximum.at(newest, inverse, timestamps)
+        for code, count, timestamp in zip(codes, counts, newest):
+            self.index.count(
+                self.columnar.decode("product_type", code),
+                int(count),
+                _format_epoch(timestamp),
+            )
+
+        # (product_type, geocode) groups of the rows sorted by datetime then row
+        order = np.lexsort((np.arange(end - start), timestamps, geocodes, product_types))
+        sorted_types, sorted_geocodes = product_types[order], geocodes[order]
+        is_last = np.ones(len(order), dtype=bool)
+        is_last[:-1] = (sorted_types[1:] != sorted_types[:-1]) | (
+            sorted_geocodes[1:] != sorted_geocodes[:-1]
+        )
+        is_first = np.ones(len(order), dtype=bool)
+        is_first[1:] = is_last[:-1]
+        groups = np.cumsum(is_first) - 1  # group of each sorted row
+        decode = self.columnar.decode
+        locations = [
+            (decode("product_type", product_type), decode("geocode", geocode))
+            for product_type, geocode in zip(
+                sorted_types[is_first].tolist(), sorted_geocodes[is_first].tolist()
+            )
+        ]
+        rows = order + start
+
+        # the last row of each group is the newest report of its location
+        last_rows = rows[is_last].tolist()
+        for row, record in zip(last_rows, self._records(columns, last_rows)):
+            self._place(record, row, count=False)
+
+        # the timeline references the rows
+        sorted_times = timestamps[order]
+        stock_levels = columns["stock_level"][start:end][order]
+        if end - start < BACKFILL_MIN_ROWS:
+            for group, timestamp, row, stock_level in zip(
+                groups.tolist(),
+                sorted_times.tolist(),
+                rows.tolist(),
+                stock_levels.tolist(),
+            ):
+                product_type, geocode = locations[group]
+                self.timeline.add(product_type, geocode, timestamp, row)
+                self.rollups.add(product_type, geocode, timestamp, stock_level)
+            return
+        self.timeline.add_many(locations, groups, sorted_times, rows)
+        self.rollups.add_many(locations, groups, sorted_times, stock_levels)
+
+    def stats(self) -> Dict[str, float]:
+        stats = super().stats()
+        directory = self.columnar.directory
+        stats["size_bytes"] = sum(
+            os.path.getsize(os.path.join(directory, name))
+            for name in os.listdir(directory)
+        )
+        return stats
+
+    def _reader(self) -> Callable[[List[int]], List[Dict]]:
+        # the timeline holds row numbers
+        return functools.partial(self._records, self.columnar.columns(self._rows))
+
+    def _records(self, columns: Dict[str, "np.ndarray"], rows: List[int]) -> List[Dict]:
+        """
+        Decode rows to stock reports shaped like the csv backend output
+        """
+        import numpy as np  # pylint: disable = import-outside-toplevel
+
+        values = {name: column[rows] for name, column in columns.items()}
+        decoded = {}
+        for name in ("product_type", "geocode", "input_address", "resolved_address"):
+            dictionary = self.columnar.dictionary(name)
+            decoded[name] = [dictionary[code] for code in values[name].tolist()]
+        # DATETIME_FORMAT is ISO 8601 with a "z" suffix
+        datetimes = np.char.add(
+            np.datetime_as_string(values["datetime"].astype("datetime64[s]")), "z"
+        )
+        return [
+            dict(
+                datetime=report_datetime,
+                geocode=geocode,
+                input_address=input_address,
+                lat=repr(lat),
+                lng=repr(lng),
+                product_type=product_type,
+                resolved_address=resolved_address,
+                stock_level=stock_level,
+            )
+            for (
+                report_datetime,
+                geocode,
+                input_address,
+                lat,
+                lng,
+                product_type,
+                resolved_address,
+                stock_level,
+            ) in zip(
+                datetimes.tolist(),
+                decoded["geocode"],
+                decoded["input_address"],
+                values["lat"].tolist(),
+                values["lng"].tolist(),
+                decoded["product_type"],
+                decoded["resolved_address"],
+                values["stock_level"].tolist(),
+            )
+        ]
+
+
+class SqlStockStore(StockStore):
+    """
+    Stock reports stored in a SQL table through a pooled SQLAlchemy engine
+    """
+
+    def __init__(self, uri: str):
+        # import here so the csv backend does not need SQLAlchemy
+        import sqlalchemy as sa  # pylint: disable = import-outside-toplevel
+
+        self.sa = sa
+        engine_options: Dict[str, object] = dict(pool_pre_ping=True)
+        if not uri.startswith("sqlite"):
+            # sqlite picks its own pool, the sizes only apply to server databases
+            engine_options.update(
+                pool_size=DbConfig["DB_POOL_SIZE"],
+                max_overflow=DbConfig["DB_POOL_MAX_OVERFLOW"],
+                pool_recycle=DbConfig["DB_POOL_RECYCLE"],
+            )
+        self.engine = sa.create_engine(uri, **engine_options)
+
+        metadata = sa.MetaData()
+        self.table = sa.Table(
+            "stock_report",
+            metadata,
+            sa.Column(
+                "id",
+                sa.BigInteger().with_variant(sa.Integer, "sqlite"),
+                primary_key=True,
+            ),
+            sa.Column("datetime", sa.DateTime, nullable=False),
+            sa.Column("geocode", sa.String(64), nullable=False),
+            sa.Column("input_address", sa.String(255)),
+            sa.Column("lat", sa.Float, nullable=False),
+            sa.Column("lng", sa.Float, nullable=False),
+            sa.Column("product_type", sa.String(32), nullable=False),
+            sa.Column("resolved_address", sa.String(255)),
+            sa.Column("stock_level", sa.SmallInteger, nullable=False),
+            # serves the "latest report per geocode" query of a product type
+            sa.Index("ix_stock_report_latest", "product_type", "geocode", "datetime"),
+            # serves the bounding box queries of a product type
+            sa.Index("ix_stock_report_position", "product_type", "lat", "lng"),
+        )
+        # version of the reports of each product type, bumped in the transaction inserting reports
+        self.versions = sa.Table(
+            "stock_version",
+            metadata,
+            sa.Column("product_type", sa.String(32), primary_key=True),
+            sa.Column("version", sa.BigInteger, nullable=False),
+            sa.Column("modified", sa.DateTime, nullable=False),
+        )
+        # hourly and daily aggregates of each location, updated in the transaction inserting reports
+        self.rollup_tables = {
+            "hour": self._rollup_table(metadata, "stock_hourly"),
+            "day": self._rollup_table(metadata, "stock_daily"),
+        }
+        with self.engine.begin() as connection:
+            missing = not sa.inspect(connection).has_table("stock_hourly")
+            metadata.create_all(connection)
+            if missing:
+                # the reports inserted before the rollup tables existed
+                self._backfill_rollups(connection)
+        # a worker forked by gunicorn --preload must not reuse the pooled connections of the master
+        os.register_at_fork(after_in_child=self._forget_connections)
+
+    def _forget_connections(self):
+        self.engine.dispose(close=False)
+
+    def _rollup_table(self, metadata, name: str):
+        """
+        Table of the aggregates of each location per bucket, see StockRollups
+        """
+        sa = self.sa
+        return sa.Table(
+            name,
+            metadata,
+            sa.Column("product_type", sa.String(32), primary_key=True),
+            sa.Column("geocode", sa.String(64), primary_key=True),
+            sa.Column("bucket_start", sa.DateTime, primary_key=True),
+            sa.Column("count", sa.Integer, nullable=False),
+            sa.Column("min", sa.SmallInteger, nullable=False),
+            sa.Column("max", sa.SmallInteger, nullable=False),
+            sa.Column("sum", sa.BigInteger, nullable=False),
+            sa.Column("last_datetime", sa.DateTime, nullable=False),
+            sa.Column("last_stock_level", sa.SmallInteger, nullable=False),
+        )
+
+    def submit(self, records: List[Dict]):
+        rows = [self._to_row(record) for record in records]
+        counts = collections.Counter(row["product_type"] for row in rows)
+        rollups = StockRollups()
+        for row in rows:
+            rollups.add(
+                row["product_type"],
+                row["geocode"],
+                _epoch_seconds(row["datetime"]),
+                row["stock_level"],
+            )
+        with self.engine.begin() as connection:
+            connection.execute(self.table.insert(), rows)
+            for product_type, count in counts.items():
+                self._bump_version(connection, product_type, count)
+            self._roll_up(connection, rollups)
+
+    def _backfill_rollups(self, connection):
+        """
+        Aggregate every report into the rollup tables
+        """
+        table = self.table
+        rollups = StockRollups()
+        rows = connection.execution_options(stream_results=True).execute(
+            self.sa.select(
+                table.c.product_type,
+                table.c.geocode,
+                table.c.datetime,
+                table.c.stock_level,
+            )
+        )
+        for product_type, geocode, timestamp, stock_level in rows:
+            rollups.add(product_type, geocode, _epoch_seconds(timestamp), stock_level)
+        self._roll_up(connection, rollups)
+
+    def _roll_up(self, connection, rollups: StockRollups):
+        """
+        Combine the buckets of rollups with the rows of the rollup tables
+        """
+        for bucket_size, table in self.rollup_tables.items():
+            rows = [
+                dict(
+                    product_type=product_type,
+                    geocode=geocode,
+                    bucket_start=datetime.utcfromtimestamp(start),
+                    count=aggregates[0],
+                    min=aggregates[1],
+                    max=aggregates[2],
+                    sum=aggregates[3],
+                    last_datetime=datetime.utcfromtimestamp(aggregates[4]),
+                    last_stock_level=aggregates[5],
+                )
+                for product_type, geocode, start, aggregates in rollups.buckets(
+                    bucket_size
+                )
+            ]
+            if not rows:
+                continue
+            # concurrent transactions lock the rows of the buckets in the same order
+            rows.sort(
+                key=lambda row: (
+                    row["product_type"],
+                    row["geocode"],
+                    row["bucket_start"],
+                )
+            )
+            if self.engine.dialect.name in UPSERT_DIALECTS:
+                self._upsert(connection, table, rows)
+                continue
+
+            # one bucket at a time, in a savepoint as another worker may insert it concurrently
+            sa = self.sa
+            for row in rows:
+                new = {
+                    name: sa.literal(value, table.c[name].type)
+                    for name, value in row.items()
+                }
+                update = (
+                    table.update()
+                    .where(
+                        table.c.product_type == row["product_type"],
+                        table.c.geocode == row["geocode"],
+                        table.c.bucket_start == row["bucket_start"],
+                    )
+                    .values(**self._combined(table, new))
+                )
+                if connection.execute(update).rowcount > 0:
+                    continue
+                try:
+                    with connection.begin_nested():
+                        connection.execute(table.insert().values(**row))
+                except sa.exc.IntegrityError:
+                    connection.execute(update)
+
+    def _upsert(self, connection, table, rows: List[Dict]):
+        """
+        Insert the rows of a rollup table, combined with the existing rows of the same buckets
+        """
+        # only the dialect in use is loaded, the insert of each dialect has its own type
+        insert: Callable
+        if self.engine.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import (  # pylint: disable = import-outside-toplevel
+                insert as postgresql_insert,
+            )
+
+            insert = postgresql_insert
+        else:
+            from sqlalchemy.dialects.sqlite import (  # pylint: disable = import-outside-toplevel
+                insert as sqlite_insert,
+            )
+
+            insert = sqlite_insert
+        statement = insert(table)
+        connection.execute(
+            statement.on_conflict_do_update(
+                index_elements=[
+                    table.c.product_type,
+                    table.c.geocode,
+                    table.c.bucket_start,
+                ],
+                set_=self._combined(table, statement.excluded),
+            ),
+            rows,
+        )
+
+    def _combined(self, table, new) -> Dict:
+        """
+        Values of a rollup row combined with new aggregates, the newer last report wins ties like in StockRollups
+
+        Args:
+            table (sa.Table): rollup table
+            new: column expressions of the new aggregates by name
+
+        Returns:
+            Dict: update expression of each aggregate column
+        """
+        sa = self.sa
+        newer = new["last_datetime"] >= table.c.last_datetime
+        return dict(
+            count=table.c["count"] + new["count"],
+            min=sa.case(
+                (new["min"] < table.c["min"], new["min"]), else_=table.c["min"]
+            ),
+            max=sa.case(
+                (new["max"] > table.c["max"], new["max"]), else_=table.c["max"]
+            ),
+            sum=table.c["sum"] + new["sum"],
+            last_datetime=sa.case(
+                (newer, new["last_datetime"]), else_=table.c.last_datetime
+            ),
+            last_stock_level=sa.case(
+                (newer, new["last_stock_level"]), else_=table.c.last_stock_level
+            ),
+        )
+
+    def _bump_version(self, connection, product_type: str, count: int):
+        """
+        Increase the version of a product type by the number of reports inserted
+        """
+        versions = self.versions
+        now = datetime.utcnow()
+        update = (
+            versions.update()
+            .where(versions.c.product_type == product_type)
+            .values(version=versions.c.version + count, modified=now)
+        )
+        if connection.execute(update).rowcount > 0:
+            return
+
+        # first report of the product type, in a savepoint as another worker may insert it concurrently
+        try:
+            with connection.begin_nested():
+                connection.execute(
+                    versions.insert().values(
+                        product_type=product_type, version=count, modified=now
+                    )
+                )
+        except self.sa.exc.IntegrityError:
+            connection.execute(update)
+
+    def version(self, product_type: str) -> Tuple[int, Optional[datetime]]:
+        versions = self.versions
+        query = self.sa.select(versions.c.version, versions.c.modified).where(
+            versions.c.product_type == product_type
+        )
+        with self.engine.connect() as connection:
+            row = connection.execute(query).first()
+        if row is None:
+            return 0, None
+        return row[0], row[1]
+
+    def matrix_version(self, product_types: List[str]) -> int:
+        # one query rather than one per product type
+        sa = self.sa
+        query = sa.select(
+            sa.func.coalesce(sa.func.sum(self.versions.c.version), 0)
+        ).where(self.versions.c.product_type.in_(product_types))
+        with self.engine.connect() as connection:
+            return int(connection.execute(query).scalar_one())
+
+    def stats(self) -> Dict[str, float]:
+        # the versions count the inserted reports, counting the rows or locations would scan the table
+        sa = self.sa
+        with self.engine.connect() as connection:
+            reports = connection.execute(
+                sa.select(sa.func.coalesce(sa.func.sum(self.versions.c.version), 0))
+            ).scalar_one()
+            stats: Dict[str, float] = dict(reports=int(reports))
+            if self.engine.dialect.name == "postgresql":
+                stats["size_bytes"] = connection.execute(
+                    sa.text(
+                        "SELECT pg_total_relation_size('stock_report')"
+                        " + pg_total_relation_size('stock_hourly')"
+                        " + pg_total_relation_size('stock_daily')"
+                    )
+                ).scalar_one()
+        return stats
+
+    def latest(self, product_type: str) -> List[Dict]:
+        with self.engine.connect() as connection:
+            rows = connection.execute(self._latest_query(product_type))
+            records = [self._from_row(row) for row in rows]
+        records.sort(key=lambda record: record["datetime"], reverse=True)
+        return records
+
+    def iter_latest(self, product_type: str) -> Iterator[Dict]:
+        with self.engine.connect() as connection:
+            # server side cursor, rows are fetched in chunks while the caller consumes them
+            rows = connection.execution_options(stream_results=True).execute(
+                self._latest_query(product_type)
+            )
+            for row in rows:
+                yield self._from_row(row)
+
+    def page(self, product_type: str, after: Optional[str], limit: int) -> List[Dict]:
+        query = self._latest_query(product_type, after=after, limit=limit)
+        with self.engine.connect() as connection:
+            return [self._from_row(row) for row in connection.execute(query)]
+
+    def within(self, product_type: str, bbox: BoundingBox) -> List[Dict]:
+        with self.engine.connect() as connection:
+            rows = connection.execute(self._latest_query(product_type, bbox))
+            return [self._from_row(row) for row in rows]
+
+    def as_of(self, product_type: str, timestamp: datetime) -> List[Dict]:
+        # ix_stock_report_latest is a time-sorted index of each location, searched up to the given time
+        query = self._latest_query(product_type, as_of=self._to_utc(timestamp))
+        with self.engine.connect() as connection:
+            records = [self._from_row(row) for row in connection.execute(query)]
+        records.sort(key=lambda record: record["datetime"], reverse=True)
+        return records
+
+    def history(
+        self,
+        product_type: str,
+        geocode: str,
+        bucket: str,
+        start: datetime,
+        end: datetime,
+    ) -> List[Dict]:
+        # a range scan of the primary key of the rollup table, maintained by submit()
+        table = self.rollup_tables[bucket]
+        first = _epoch_seconds(start)
+        first -= first % BUCKET_SECONDS[bucket]
+        query = (
+            self.sa.select(
+                table.c.bucket_start,
+                table.c["count"],
+                table.c["min"],
+                table.c["max"],
+                table.c["sum"],
+                table.c.last_datetime,
+                table.c.last_stock_level,
+            )
+            .where(
+                table.c.product_type == product_type,
+                table.c.geocode == geocode,
+                table.c.bucket_start >= datetime.utcfromtimestamp(first),
+                table.c.bucket_start <= self._to_utc(end),
+            )
+            .order_by(table.c.bucket_start)
+        )
+        with self.engine.connect() as connection:
+            rows = connection.execute(query).all()
+        records = []
+        for bucket_start, *aggregates in rows:
+            aggregates[4] = _epoch_seconds(aggregates[4])
+            records.append(rollup_record(_epoch_seconds(bucket_start), aggregates))
+        return records
+
+    def compact(
+        self, cutoff: datetime, progress: Callable[[float], None]
+    ) -> Dict[str, int]:
+        """
+        Delete the reports made before cutoff in batches of COMPACTION_BATCH, then the hourly rollups before cutoff
+        one day at a time, each batch in one short transaction
+
+        The daily rollups are maintained by submit(), so no summaries are written. The reports inserted once the
+        compaction started are left alone. The space of the deleted rows is reused by the database, bytes_reclaimed
+        is only measured on postgresql.
+        """
+        sa, table = self.sa, self.table
+        cutoff = self._to_utc(cutoff)
+        result = dict(reports_compacted=0, summaries=0, bytes_reclaimed=0)
+        size = self.stats().get("size_bytes", 0)
+        hourly = self.rollup_tables["hour"]
+        with self.engine.connect() as connection:
+            max_id = connection.execute(sa.select(sa.func.max(table.c.id))).scalar()
+            if max_id is None:
+                return result
+            total = connection.execute(
+                sa.select(sa.func.count()).where(
+                    table.c.datetime < cutoff, table.c.id <= max_id
+                )
+            ).scalar_one()
+            # the newest report of each location is kept whatever its age
+            rank = (
+                sa.func.row_number()
+                .over(
+                    partition_by=(table.c.product_type, table.c.geocode),
+                    order_by=(table.c.datetime.desc(), table.c.id.desc()),
+                )
+                .label("rank")
+            )
+            ranked = sa.select(table.c.id, rank).where(table.c.id <= max_id).subquery()
+            kept = set(
+                connection.execute(
+                    sa.select(ranked.c.id).where(ranked.c.rank == 1)
+                ).scalars()
+            )
+            oldest_hour = connection.execute(
+                sa.select(sa.func.min(hourly.c.bucket_start))
+            ).scalar()
+
+        after, done = 0, 0
+        while True:
+            with self.engine.begin() as connection:
+                ids = (
+                    connection.execute(
+                        sa.select(table.c.id)
+                        .where(
+                            table.c.id > after,
+                            table.c.id <= max_id,
+                            table.c.datetime < cutoff,
+                        )
+                        .order_by(table.c.id)
+                        .limit(COMPACTION_BATCH)
+                    )
+                    .scalars()
+                    .all()
+                )
+                if not ids:
+                    break
+                after = ids[-1]
+                done += len(ids)
+                ids = [report_id for report_id in ids if report_id not in kept]
+                if ids:
+                    connection.execute(table.delete().where(table.c.id.in_(ids)))
+                    result["reports_compacted"] += len(ids)
+            progress(min(done / total, 1.0) / 2)
+
+        # the hourly history is only kept after the cutoff, like the reports
+        day = timedelta(days=1)
+        if oldest_hour is not None and oldest_hour < cutoff:
+            days = (cutoff - oldest_hour) / day
+            start = oldest_hour
+            while start < cutoff:
+                end = min(start + day, cutoff)
+                with self.engine.begin() as connection:
+                    connection.execute(
+                        hourly.delete().where(
+                            hourly.c.bucket_start >= start, hourly.c.bucket_start < end
+                        )
+                    )
+                start = end
+                progress(0.5 + min((start - oldest_hour) / day / days, 1.0) / 2)
+
+        result["bytes_reclaimed"] = int(
+            max(0, size - self.stats().get("size_bytes", 0))
+        )
+        progress(1.0)
+        return result
+
+    def _latest_query(
+        self,
+        product_type: str,
+        bbox: Optional[BoundingBox] = None,
+        after: Optional[str] = None,
+        limit: Optional[int] = None,
+        as_of: Optional[datetime] = None,
+    ):
+        """
+        Single indexed query selecting the newest report of every location for a product type
+
+        A location does not move, so the bounding box is applied to all its reports before picking the newest one.
+        When a limit is given the locations are ordered by geocode, starting after the geocode "after". Reports made
+        after as_of are ignored.
+        """
+        sa, table = self.sa, self.table
+        columns = [table.c[column] for column in STOCK_COLUMNS]
+
+        condition = table.c.product_type == product_type
+        if bbox is not None:
+            min_lat, min_lng, max_lat, max_lng = bbox
+            condition = sa.and_(
+                condition,
+                table.c.lat.between(min_lat, max_lat),
+                table.c.lng.between(min_lng, max_lng),
+            )
+        if after is not None:
+            condition = sa.and_(condition, table.c.geocode > after)
+        if as_of is not None:
+            condition = sa.and_(condition, table.c.datetime <= as_of)
+
+        if self.engine.dialect.name == "postgresql":
+            # DISTINCT ON walks ix_stock_report_latest in order
+            return (
+                sa.select(*columns)
+                .where(condition)
+                .distinct(table.c.geocode)
+                .order_by(
+                    table.c.geocode, table.c.datetime.desc(), table.c.id.desc()
+                )
+                .limit(limit)
+            )
+
+        rank = (
+            sa.func.row_number()
+            .over(
+                partition_by=table.c.geocode,
+                order_by=(table.c.datetime.desc(), table.c.id.desc()),
+            )
+            .label("rank")
+        )
+        ranked = (
+            sa.select(*columns, rank).where(condition).subquery()
+        )
+        query = sa.select(*[ranked.c[column] for column in STOCK_COLUMNS]).where(
+            ranked.c.rank == 1
+        )
+        if limit is not None:
+            query = query.order_by(ranked.c.geocode).limit(limit)
+        return query
+
+    @staticmethod
+    def _to_row(record: Dict) -> Dict:
+        """
+        Convert a stock report to a table row, datetimes are stored as naive UTC
+        """
+        row: Dict[str, Any] = {column: record.get(column) for column in STOCK_COLUMNS}
+        row["datetime"] = SqlStockStore._to_utc(row["datetime"])
+        row["lat"] = float(row["lat"])
+        row["lng"] = float(row["lng"])
+        row["stock_level"] = int(row["stock_level"])
+        return row
+
+    @staticmethod
+    def _to_utc(timestamp) -> datetime:
+        """
+        Naive UTC datetime of a report datetime, strings and naive datetimes are UTC
+        """
+        if isinstance(timestamp, str):
+            return datetime.strptime(timestamp, DATETIME_FORMAT)
+        if timestamp.tzinfo is not None:
+            return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        return timestamp
+
+    @staticmethod
+    def _from_row(row) -> Dict:
+        """
+        Convert a table row to a stock report shaped like the csv backend output
+        """
+        record = dict(zip(STOCK_COLUMNS, row))
+        record["datetime"] = record["datetime"].strftime(DATETIME_FORMAT)
+        record["lat"] = repr(record["lat"])
+        record["lng"] = repr(record["lng"])
+        return record
+
+
+class AsyncStockStore:
+    """
+    Awaitable facade of a StockStore, the blocking file or database work runs on a bounded thread pool
+
+    The pool bounds the storage calls in progress in a worker process independently of the number of requests being
+    served, e.g. to the size of the sql connection pool. Calls beyond the bound wait for a free thread.
+    """
+
+    def __init__(self, store: StockStore, max_workers: Optional[int] = None):
+        self.store = store
+        self.executor = ThreadPoolExecutor(
+            max_workers or DbConfig["DB_EXECUTOR_THREADS"],
+            thread_name_prefix="storage",
+        )
+
+    async def run(self, function: Callable, *args):
+        """
+        Run a blocking function on the storage thread pool, under the profiler of the request if it is profiled
+
+        Args:
+            function (Callable): function to run, e.g. a method of the store
+            *args: arguments of the function
+
+        Returns:
+            result of the function
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, profile_call(functools.partial(function, *args))
+        )
+
+    async def submit(self, records: List[Dict]):
+        """
+        See StockStore.submit
+        """
+        return await self.run(self.store.submit, records)
+
+    async def latest(self, product_type: str) -> List[Dict]:
+        """
+        See StockStore.latest
+        """
+        return await self.run(self.store.latest, product_type)
+
+    async def version(self, product_type: str) -> Tuple[int, Optional[datetime]]:
+        """
+        See StockStore.version
+        """
+        return await self.run(self.store.version, product_type)
+
+    async def page(
+        self, product_type: str, after: Optional[str], limit: int
+    ) -> List[Dict]:
+        """
+        See StockStore.page
+        """
+        return await self.run(self.store.page, product_type, after, limit)
+
+    async def within(self, product_type: str, bbox: BoundingBox) -> List[Dict]:
+        """
+        See StockStore.within
+        """
+        return await self.run(self.store.within, product_type, bbox)
+
+    async def nearby(
+        self, product_type: str, lat: float, lng: float, radius_km: float
+    ) -> List[Dict]:
+        """
+        See StockStore.nearby
+        """
+        return await self.run(self.store.nearby, product_type, lat, lng, radius_km)
+
+    async def matrix_version(self, product_types: List[str]) -> int:
+        """
+        See StockStore.matrix_version
+        """
+        return await self.run(self.store.matrix_version, product_types)
+
+    async def matrix(self, product_types: List[str]) -> Dict:
+        """
+        See StockStore.matrix
+        """
+        return await self.run(self.store.matrix, product_types)
+
+    async def as_of(self, product_type: str, timestamp: datetime) -> List[Dict]:
+        """
+        See StockStore.as_of
+        """
+        return await self.run(self.store.as_of, product_type, timestamp)
+
+    async def history(
+        self,
+        product_type: str,
+        geocode: str,
+        bucket: str,
+        start: datetime,
+        end: datetime,
+    ) -> List[Dict]:
+        """
+        See StockStore.history
+        """
+        return await self.run(
+            self.store.history, product_type, geocode, bucket, start, end
+        )
+
+    def close(self):
+        """
+        Wait for the storage calls in progress and stop the thread pool
+        """
+        self.executor.shutdown(wait=True)
+
+
+def create_store() -> StockStore:
+    """
+    Create the storage backend configured in DbConfig
+
+    Returns:
+        StockStore: storage backend
+    """
+    backend = DbConfig["DB_BACKEND"]
+    if backend == "csv":
+        return CsvStockStore(DbConfig["DB_FILEPATH"])
+    if backend == "columnar":
+        return ColumnarStockStore(DbConfig["DB_COLUMNAR_DIR"])
+    if backend == "sql":
+        return SqlStockStore(DbConfig["DB_URI"])
+    raise ValueError(
+        "Unknown DB_BACKEND {!r}, use 'csv', 'columnar' or 'sql'".format(backend)
+    )
@@ -1,110 +1,512 @@
 """
 Underlying API functions
 """
-import os
+import asyncio
+import base64
 import logging
-import sys
+import os
+from datetime import datetime, timedelta, timezone
 
-import pandas as pd
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
-from typing import Dict
+from marshmallow import EXCLUDE, ValidationError
 
-from config import DbConfig
+from app.dedup import DedupCache, SubmissionInProgress, submission_key
+from app.geo import BoundingBox
+from app.metrics import registry, stage
+from app.schema import PRODUCT_TYPES, StockItemSchema
+from app.storage import AsyncStockStore, StockStore, create_store
+from app.validation import CompiledSchema, compile_schema
+from app.write_buffer import WriteBuffer, WriteBufferClosed, WriteBufferFull
 
 
-def create_logger(log_level: int = logging.DEBUG) -> logging.Logger:
-    """ Create a logger object to be used throughout the script
+def create_logger(
+    name: str = "app", log_level: Optional[int] = None
+) -> logging.Logger:
+    """ Get a logger of the app, its records are written by the handler set up in logs.py
 
     Args:
-        log_level (int): The level of the logs (see https://docs.python.org/3/library/logging.html)
+        name (str): name of the logger, a child of "app" e.g. the __name__ of the module
+        log_level (int): The level of the logs (see https://docs.python.org/3/library/logging.html), LOG_LEVEL of the
+            app config by default
 
     Returns:
         logging.Logger: Our logging object
     """
-    # Instantiate a logging object
-    logger = logging.getLogger(__name__)
-    # Set the level of the logs
-    logger.setLevel(log_level)
+    # Instantiate a logging object, no handler is added here: the handler of the "app" logger writes every record once
+    logger = logging.getLogger(name)
+    if log_level is not None:
+        # Set the level of the logs
+        logger.setLevel(log_level)
 
-    # create a logging format
-    formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s", "%Y-%m-%d %H:%M:%S"
-    )
+    return logger
 
-    # create a file and stream handler handler
-    stream_handler = logging.StreamHandler(sys.stdout)
-    # Set the formatting
-    stream_handler.setFormatter(formatter)
-    # Add the handler to the logger object
-    logger.addHandler(stream_handler)
 
-    return logger
+logger = create_logger(__name__)
+
+
+# validator of the submitted reports, generated once per worker process, unknown fields are dropped like webargs does
+STOCK_ITEM_SCHEMA: CompiledSchema = compile_schema(StockItemSchema(unknown=EXCLUDE))
+
+# time range of the stock level history when no start is given
+HISTORY_DEFAULT_DAYS = 7
+
+_store: Optional[StockStore] = None  # created on first use in each worker process
+_async_store: Optional[AsyncStockStore] = None  # thread pool of the async endpoints, see get_async_store
+_write_buffer: Optional[WriteBuffer] = None  # set by configure_write_buffer in write-behind mode
+_dedup_cache: Optional[DedupCache] = None  # set by configure_dedup_cache unless IDEMPOTENCY_DB is empty
+
+
+def get_store() -> StockStore:
+    """
+    Get the storage backend of this worker process, it is created from DbConfig on first use
 
+    Returns:
+        StockStore: storage backend
+    """
+    global _store  # pylint: disable = global-statement
+
+    if _store is None:
+        _store = create_store()
+    return _store
 
-logger = create_logger()
 
+def get_async_store() -> AsyncStockStore:
+    """
+    Get the awaitable facade of the storage backend of this worker process, used by the async endpoints
 
-def submit_stocklevel(stock_data: Dict) -> bool:
+    Returns:
+        AsyncStockStore: storage backend running its blocking calls on a bounded thread pool
+    """
+    global _async_store  # pylint: disable = global-statement
+
+    if _async_store is None:
+        _async_store = AsyncStockStore(get_store())
+    return _async_store
+
+
+def _forget_async_store():
+    global _async_store  # pylint: disable = global-statement
+
+    # the threads of the pool are not copied into a forked worker, it creates its own pool
+    _async_store = None
+
+
+os.register_at_fork(after_in_child=_forget_async_store)
+
+
+def configure_write_buffer(config: Dict):
+    """
+    Enable the write-behind mode when STOCK_WRITE_BUFFER is set in the Flask app config
+
+    Args:
+        config (Dict): Flask app config, see BaseConfig in config.py
+    """
+    global _write_buffer  # pylint: disable = global-statement
+
+    if _write_buffer is not None:
+        _write_buffer.close()
+        _write_buffer = None
+
+    if config.get("STOCK_WRITE_BUFFER"):
+        _write_buffer = WriteBuffer(
+            lambda records: get_store().submit(records),
+            max_records=config["STOCK_WRITE_BUFFER_MAX_RECORDS"],
+            max_delay_ms=config["STOCK_WRITE_BUFFER_MAX_DELAY_MS"],
+            queue_size=config["STOCK_WRITE_BUFFER_QUEUE_SIZE"],
+            ack=config["STOCK_WRITE_BUFFER_ACK"],
+            enqueue_timeout=config["STOCK_WRITE_BUFFER_ENQUEUE_TIMEOUT"],
+        )
+
+
+def configure_dedup_cache(config: Dict):
+    """
+    Deduplicate retried stock submissions unless IDEMPOTENCY_DB is empty in the Flask app config
+
+    Args:
+        config (Dict): Flask app config, see BaseConfig in config.py
+    """
+    global _dedup_cache  # pylint: disable = global-statement
+
+    _dedup_cache = None
+    if config.get("IDEMPOTENCY_DB"):
+        _dedup_cache = DedupCache(
+            config["IDEMPOTENCY_DB"],
+            ttl=config["IDEMPOTENCY_TTL"],
+            max_keys=config["IDEMPOTENCY_MAX_KEYS"],
+        )
+
+
+async def _write(records: List[Dict]):
+    """
+    Write reports to the storage backend, through the write buffer in write-behind mode
+    """
+    store = get_async_store()
+    with stage("storage_write"):
+        if _write_buffer is None:
+            await store.submit(records)
+            return
+        try:
+            try:
+                # without waiting while the queue has room, so no thread is held until the commit
+                committed = _write_buffer.enqueue(records, timeout=0)
+            except WriteBufferFull:
+                committed = await store.run(_write_buffer.enqueue, records)
+        except WriteBufferClosed:
+            # shutting down, write synchronously
+            await store.submit(records)
+            return
+        if committed is not None:
+            await asyncio.wrap_future(committed)
+
+
+async def submit_stocklevel(
+    stock_data: Dict, idempotency_key: Optional[str] = None
+) -> bool:
     """
     Submit a stock level of a given location to be recorded in the 'db'
 
+    The report is appended to the storage backend, existing reports are never read or rewritten, so the cost of a
+    write does not depend on the size of the history. A retry of a submission, with the same idempotency key or
+    without a key the same report, is not written again (see dedup.py).
+
     Args:
         stock_data (Dict): follows the schema of the StockLevelReportSchema object found in schema.py
+        idempotency_key (Optional[str]): Idempotency-Key header of the request
+
+    Returns:
+        bool: True if successful update, False when the submission was made already
+
+    Raises:
+        ValidationError: the idempotency key was used for another report
+    """
+    # the cache the submission was claimed in, even if configure_dedup_cache replaces it meanwhile
+    dedup_cache = _dedup_cache
+    key = None
+    if dedup_cache is not None:
+        key, fingerprint = submission_key(stock_data, idempotency_key)
+        store = get_async_store()
+        with stage("deduplicate"):
+            previous = await store.run(dedup_cache.claim, key, fingerprint)
+        if previous is not None:
+            previous_fingerprint, written = previous
+            if previous_fingerprint != fingerprint:
+                raise ValidationError(
+                    {"Idempotency-Key": ["Already used for another stock report"]}
+                )
+            if not written:
+                # its outcome is not known yet, the earlier submission may still fail
+                raise SubmissionInProgress()
+            registry.inc("stock_duplicate_submissions_total", ())
+            logger.debug("Stock report submitted already", extra=dict(key=key))
+            return False
+
+    # submit stock level and geocode to the configured storage backend (csv file or sql database), see storage.py
+    try:
+        await _write([stock_data])
+    except BaseException:
+        if dedup_cache is not None and key is not None:
+            # the retry of a failed submission is written
+            await store.run(dedup_cache.release, key)
+        raise
+    if dedup_cache is not None and key is not None:
+        await store.run(dedup_cache.complete, key)
+
+    logger.debug("Wrote stock report", extra=dict(n_reports=1))
+
+    return True
+
+
+def validate_stocklevel(item) -> Dict:
+    """
+    Validate a stock report against the StockItemSchema object found in schema.py
+
+    Args:
+        item: raw stock report, e.g. the decoded json body of a request
 
     Returns:
-        bool: True if successful update
+        Dict: deserialized report
+
+    Raises:
+        ValidationError: the report is invalid, with the same messages as StockItemSchema().load
+    """
+    with stage("validate"):
+        return STOCK_ITEM_SCHEMA.load(item)
+
+
+def validate_stocklevels(items: List) -> Tuple[List[Dict], List[Dict]]:
     """
+    Validate a batch of stock reports against the StockItemSchema object found in schema.py
 
-    # submit stock level and geocode to our "database" (CSV)
-    # this is a hack for demostrative purposes only, use a SQL/ no-SQL when creating your own app and proper error handling
-    # look at sql alchemy if you want to use a sql db with flask
+    Args:
+        items (List): raw stock reports, e.g. the decoded json body of a batch request
 
-    if os.path.exists(DbConfig["DB_FILEPATH"]):
-        db = pd.read_csv(DbConfig["DB_FILEPATH"])
-    else:
-        db = pd.DataFrame()
+    Returns:
+        Tuple[List[Dict], List[Dict]]: valid deserialized reports and an error for each invalid report, an error holds
+            the position of the report in the batch and the marshmallow error messages
+    """
+    with stage("validate"):
+        return STOCK_ITEM_SCHEMA.load_many(items)
 
-    timestamp = stock_data.pop("datetime").strftime(
-        "%Y-%m-%dT%H:%M:%Sz"
-    )  # convert timestamp to str
-    stock_data["datetime"] = timestamp
-    db = db.append(stock_data, ignore_index=True)
 
-    logger.info("Writing to database file")
+async def submit_stocklevels(records: List[Dict]) -> int:
+    """
+    Submit a batch of stock levels to be recorded in the 'db' in a single storage operation
 
-    # Write to the file
-    db.to_csv(DbConfig["DB_FILEPATH"], index=False)
+    Args:
+        records (List[Dict]): follow the schema of the StockItemSchema object found in schema.py
 
-    logger.info("Wrote successfully")
+    Returns:
+        int: number of reports recorded
+    """
+    if not records:
+        return 0
 
-    return True
+    await _write(records)
 
+    logger.debug("Wrote stock reports", extra=dict(n_reports=len(records)))
 
-def get_stocklevel(product_type: str) -> pd.DataFrame:
+    return len(records)
+
+
+async def get_stocklevel(product_type: str) -> List[Dict]:
     """
     Get the stock level report for a given product
 
+    The report is answered by the storage backend without scanning the full history.
+
+    Args:
+        product_type (str): one of the given product types
+
+    Returns:
+        stock_level_report (List[Dict]): report of the most recent stock levels for a given product type. E.g loo roll for each location
+    """
+    logger.debug("Reading stock levels", extra=dict(product_type=product_type))
+
+    with stage("storage_read"):
+        return await get_async_store().latest(product_type)
+
+
+async def get_stocklevel_as_of(product_type: str, as_of: datetime) -> List[Dict]:
+    """
+    Get the stock level report for a given product as it was at a point in time
+
+    Each location is answered with a binary search in its time-sorted reports, the full history is not scanned.
+
+    Args:
+        product_type (str): one of the given product types
+        as_of (datetime): point in time, naive datetimes are UTC
+
+    Returns:
+        List[Dict]: most recent stock level of each location at that time, most recent first
+    """
+    logger.debug("Reading stock levels", extra=dict(product_type=product_type))
+
+    with stage("storage_read"):
+        return await get_async_store().as_of(product_type, as_of)
+
+
+async def get_stocklevel_version(product_type: str) -> Tuple[int, Optional[datetime]]:
+    """
+    Get the version of the stock level report of a given product, it changes whenever a report is submitted
+
+    Args:
+        product_type (str): one of the given product types
+
+    Returns:
+        Tuple[int, Optional[datetime]]: version and the time the reports of the product type last changed (UTC)
+    """
+    with stage("storage_read"):
+        return await get_async_store().version(product_type)
+
+
+async def get_stocklevel_matrix_version() -> int:
+    """
+    Get the version of the stock level matrix, it changes whenever a report is submitted
+
+    Returns:
+        int: version, see get_stocklevel_matrix
+    """
+    with stage("storage_read"):
+        return await get_async_store().matrix_version(PRODUCT_TYPES)
+
+
+async def get_stocklevel_matrix() -> Dict:
+    """
+    Get the most recent stock level of every product type at every location at once
+
+    The matrix is kept up to date by the storage backend as reports are written, the index backends copy it once
+    per version rather than building a report per product type.
+
+    Returns:
+        Dict: version, product_types (PRODUCT_TYPES), locations (sorted geocodes) and levels, one row per product
+            type with the stock level of each location or None
+    """
+    logger.debug("Reading stock level matrix")
+
+    with stage("storage_read"):
+        return await get_async_store().matrix(PRODUCT_TYPES)
+
+
+def encode_cursor(geocode: str) -> str:
+    """
+    Opaque pagination cursor pointing after a location
+
+    Args:
+        geocode (str): geocode of the last location of a page
+
+    Returns:
+        str: url safe cursor
+    """
+    return base64.urlsafe_b64encode(geocode.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> str:
+    """
+    Decode a cursor created with encode_cursor
+
+    Args:
+        cursor (str): url safe cursor
+
+    Returns:
+        str: geocode of the last location of the previous page
+
+    Raises:
+        ValueError: the cursor was not created by encode_cursor
+    """
+    # binascii.Error and UnicodeError are both ValueErrors
+    return base64.b64decode(cursor, altchars=b"-_", validate=True).decode("utf-8")
+
+
+async def get_stocklevel_page(
+    product_type: str, cursor: Optional[str], limit: int
+) -> Tuple[List[Dict], Optional[str]]:
+    """
+    Get a page of the stock level report for a given product, ordered by geocode
+
+    Args:
+        product_type (str): one of the given product types
+        cursor (Optional[str]): next_cursor of the previous page, None for the first page
+        limit (int): maximum number of locations in the page
+
+    Returns:
+        Tuple[List[Dict], Optional[str]]: most recent stock level of each location of the page and the cursor of the
+            next page, None on the last page
+
+    Raises:
+        ValueError: invalid cursor
+    """
+    logger.debug("Reading stock levels", extra=dict(product_type=product_type))
+
+    after = None if cursor is None else decode_cursor(cursor)
+    # fetch one extra location to know if there is a next page
+    with stage("storage_read"):
+        records = await get_async_store().page(product_type, after, limit + 1)
+    if len(records) <= limit:
+        return records, None
+    records = records[:limit]
+    return records, encode_cursor(records[-1]["geocode"])
+
+
+def project_stocklevels(records: Iterable[Dict], fields: List[str]) -> Iterator[Dict]:
+    """
+    Keep only the given fields of each stock report
+
+    Args:
+        records (Iterable[Dict]): stock reports
+        fields (List[str]): fields to keep
+
+    Returns:
+        Iterator[Dict]: projected stock reports
+    """
+    return (
+        {field: record[field] for field in fields if field in record}
+        for record in records
+    )
+
+
+async def get_stocklevel_nearby(
+    product_type: str, lat: float, lng: float, radius_km: float
+) -> List[Dict]:
+    """
+    Get the stock level report for a given product around a position
+
+    Args:
+        product_type (str): one of the given product types
+        lat (float): latitude of the centre in degrees
+        lng (float): longitude of the centre in degrees
+        radius_km (float): radius of the search
+
+    Returns:
+        List[Dict]: most recent stock level of each location within the radius, nearest first
+    """
+    logger.debug("Reading stock levels", extra=dict(product_type=product_type))
+
+    with stage("storage_read"):
+        return await get_async_store().nearby(product_type, lat, lng, radius_km)
+
+
+async def get_stocklevel_within(product_type: str, bbox: BoundingBox) -> List[Dict]:
+    """
+    Get the stock level report for a given product inside a bounding box
+
     Args:
         product_type (str): one of the given product types
+        bbox (BoundingBox): (min_lat, min_lng, max_lat, max_lng)
 
     Returns:
-        stock_level_report (pd.DataFrame): report of the most recent stock levels for a given product type. E.g loo roll for each location
-    """
-    #############################################
-    # EXERCISE 4:
-    #############################################
-    #### WRITE YOUR CODE HERE ####
-    # pd.read_csv(DbConfig["DB_FILEPATH"], dtype= {"datetime":, "resolved_address", "lat", "lng", "stock_level"})
-    reports_df = pd.read_csv(DbConfig["DB_FILEPATH"])
-    logger.debug(product_type)
-    # logger.debug(reports_df)
-    reports_df = reports_df[reports_df["product_type"] == product_type]
-    reports_df = reports_df.sort_values("datetime", ascending=False)
-    reports_df = reports_df.drop_duplicates("geocode", keep="first")
-
-    # logger.debug(reports_df)
-    # pd.DataFrame(
-    #     columns=["datetime", "resolved_address", "lat", "lng", "stock_level"]
-    # )
-    # TEMP CHANGE WHAT IS RETURNED (hint should be a data frame in the below format)
-    return reports_df
+        List[Dict]: most recent stock level of each location inside the bounding box
+    """
+    logger.debug("Reading stock levels", extra=dict(product_type=product_type))
+
+    with stage("storage_read"):
+        return await get_async_store().within(product_type, bbox)
+
+
+def iter_stocklevel(product_type: str) -> Iterator[Dict]:
+    """
+    Stream the stock level report for a given product, one location at a time
+
+    Args:
+        product_type (str): one of the given product types
+
+    Returns:
+        Iterator[Dict]: most recent stock level of each location, in storage order
+    """
+    logger.debug("Reading stock levels", extra=dict(product_type=product_type))
+
+    return get_store().iter_latest(product_type)
+
+
+async def get_stocklevel_history(
+    product_type: str,
+    geocode: str,
+    bucket: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> List[Dict]:
+    """
+    Get the stock level history of a location aggregated per hour or per day
+
+    The aggregates are maintained by the storage backend as reports are written, the history is not scanned.
+
+    Args:
+        product_type (str): one of the given product types
+        geocode (str): geocode of the location
+        bucket (str): "hour" or "day"
+        start (Optional[datetime]): start of the time range, defaults to HISTORY_DEFAULT_DAYS before end
+        end (Optional[datetime]): end of the time range, defaults to now
+
+    Returns:
+        List[Dict]: count, min, max, mean and last stock level of each bucket with reports, oldest first
+    """
+    logger.debug("Reading stock levels", extra=dict(product_type=product_type))
+
+    if end is None:
+        end = datetime.now(timezone.utc)
+    if start is None:
+        start = end - timedelta(days=HISTORY_DEFAULT_DAYS)
+    with stage("storage_read"):
+        return await get_async_store().history(
+            product_type, geocode, bucket, start, end
+        )
@@ -0,0 +1,318 @@
+"""
+Compiled validation of the api schemas
+
+compile_schema() generates, once, a load function specialised for a marshmallow schema: the fields are read, type
+checked and validated by straight-line code instead of marshmallow's generic field dispatch. The generated function
+only accepts records it can vouch for, i.e. every field present with its plain json type and valid. Any other record
+(missing or invalid field, value needing a conversion, e.g. "3" for an integer) is loaded by marshmallow again, so the
+result and the errors, in the structure returned by IncorrectArgument.display_error_message, are exactly those of
+schema.load.
+
+Supported: Str, Int, Float and DateTime (iso format) fields with the OneOf, Range and Length validators. A schema
+with any other field, validator or hook is loaded by marshmallow only.
+"""
+import math
+import re
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple, cast
+
+from marshmallow import INCLUDE, RAISE, Schema, ValidationError, fields, validate
+from marshmallow.utils import missing as missing_
+
+# "2021-03-01T10:00:00Z" or with up to 6 fraction digits, any other iso format is left to marshmallow
+_UTC_DATETIME = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?Z\Z"
+)
+
+# returned by the generated functions for a record marshmallow has to load
+_INVALID = object()
+
+
+class NotCompilable(Exception):
+    """
+    Raised for a schema, field or validator the compiler does not support
+    """
+
+
+def _parse_utc_datetime(value: str):
+    """
+    Parse the UTC iso datetimes sent by the clients like marshmallow.utils.from_iso_datetime, _INVALID otherwise
+    """
+    match = _UTC_DATETIME.match(value)
+    if match is None:
+        return _INVALID
+    year, month, day, hour, minute, second, fraction = match.groups()
+    try:
+        return datetime(
+            int(year),
+            int(month),
+            int(day),
+            int(hour),
+            int(minute),
+            int(second),
+            int(fraction.ljust(6, "0")) if fraction else 0,
+            timezone.utc,
+        )
+    except ValueError:
+        return _INVALID
+
+
+def _is_finite(value: float) -> bool:
+    return not (math.isnan(value) or math.isinf(value))
+
+
+class _Generator:
+    """
+    Source code and namespace of the load function of a schema
+    """
+
+    def __init__(self):
+        self.lines: List[str] = []
+        self.namespace: Dict = dict(
+            _INVALID=_INVALID,
+            _MISSING=missing_,
+            _parse_utc_datetime=_parse_utc_datetime,
+            _is_finite=_is_finite,
+        )
+
+    def constant(self, name: str, value) -> str:
+        """
+        Make a value available to the generated code under a unique name
+        """
+        name = "{}_{}".format(name, len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def line(self, indent: int, code: str):
+        self.lines.append("    " * indent + code)
+
+
+def _field_checks(
+    generator: _Generator, field: fields.Field, variable: str, indent: int
+):
+    """
+    Generate the type check, conversion and validation of the value of a field, _INVALID is returned when they fail
+    """
+    if field.allow_none:
+        raise NotCompilable("allow_none")
+    # exact classes, subclasses convert differently, e.g. UUID is a String
+    field_class = field.__class__
+    if field_class is fields.DateTime:
+        date_format = cast(fields.DateTime, field).format
+        if date_format not in (None, "iso", "iso8601"):
+            raise NotCompilable("DateTime format {!r}".format(date_format))
+        generator.line(indent, "if {}.__class__ is not str:".format(variable))
+        generator.line(indent + 1, "return _INVALID")
+        generator.line(indent, "{0} = _parse_utc_datetime({0})".format(variable))
+        generator.line(indent, "if {} is _INVALID:".format(variable))
+        generator.line(indent + 1, "return _INVALID")
+    elif field_class is fields.Integer:
+        # bools are ints but rejected by marshmallow, the class is compared rather than isinstance
+        generator.line(indent, "if {}.__class__ is not int:".format(variable))
+        generator.line(indent + 1, "return _INVALID")
+    elif field_class is fields.Float:
+        if cast(fields.Float, field).allow_nan:
+            raise NotCompilable("allow_nan")
+        generator.line(
+            indent,
+            "if {0}.__class__ is not float or not _is_finite({0}):".format(variable),
+        )
+        generator.line(indent + 1, "return _INVALID")
+    elif field_class is fields.String:
+        generator.line(indent, "if {}.__class__ is not str:".format(variable))
+        generator.line(indent + 1, "return _INVALID")
+    else:
+        raise NotCompilable(field_class.__name__)
+
+    for validator in field.validators:
+        if isinstance(validator, validate.OneOf):
+            choices = generator.constant("choices", frozenset(validator.choices))
+            generator.line(indent, "if {} not in {}:".format(variable, choices))
+        elif isinstance(validator, validate.Range):
+            conditions = []
+            if validator.min is not None:
+                operator = "<" if getattr(validator, "min_inclusive", True) else "<="
+                conditions.append(
+                    "{} {} {}".format(variable, operator, repr(validator.min))
+                )
+            if validator.max is not None:
+                operator = ">" if getattr(validator, "max_inclusive", True) else ">="
+                conditions.append(
+                    "{} {} {}".format(variable, operator, repr(validator.max))
+                )
+            if not conditions:
+                continue
+            generator.line(indent, "if {}:".format(" or ".join(conditions)))
+        elif isinstance(validator, validate.Length):
+            size = "len({})".format(variable)
+            if validator.equal is not None:
+                conditions = ["{} != {}".format(size, validator.equal)]
+            else:
+                conditions = []
+                if validator.min is not None:
+                    conditions.append("{} < {}".format(size, validator.min))
+                if validator.max is not None:
+                    conditions.append("{} > {}".format(size, validator.max))
+            if not conditions:
+                continue
+            generator.line(indent, "if {}:".format(" or ".join(conditions)))
+        else:
+            raise NotCompilable(validator.__class__.__name__)
+        generator.line(indent + 1, "return _INVALID")
+
+
+def _generate(schema: Schema) -> Tuple[Callable, str]:
+    """
+    Generate the load function of a schema
+
+    Returns:
+        Tuple[Callable, str]: function returning the loaded record or _INVALID, and its source code
+
+    Raises:
+        NotCompilable: the schema uses a feature the compiler does not support
+    """
+    # a defaultdict, loading a schema adds empty entries
+    hooks = schema._hooks  # pylint: disable = protected-access
+    if schema.many or schema.partial or any(hooks.values()):
+        raise NotCompilable("many, partial or hooks")
+    if schema.unknown == INCLUDE:
+        raise NotCompilable("unknown=INCLUDE")
+
+    generator = _Generator()
+    generator.line(0, "def load(data):")
+    generator.line(1, "if data.__class__ is not dict:")
+    generator.line(2, "return _INVALID")
+    keys = []
+    assignments = []
+    for position, (name, field) in enumerate(schema.load_fields.items()):
+        key = field.data_key if field.data_key is not None else name
+        attribute = field.attribute or name
+        keys.append(key)
+        variable = "value_{}".format(position)
+        generator.line(1, "{} = data.get({!r}, _MISSING)".format(variable, key))
+        # load_default is named missing before marshmallow 3.13
+        if hasattr(field, "load_default"):
+            default = field.load_default
+        else:
+            default = field.missing
+        if field.required or default is not missing_:
+            # required fields are reported by marshmallow, defaults are filled in by marshmallow too
+            generator.line(1, "if {} is _MISSING:".format(variable))
+            generator.line(2, "return _INVALID")
+            _field_checks(generator, field, variable, 1)
+            assignments.append((attribute, variable, False))
+        else:
+            generator.line(1, "if {} is not _MISSING:".format(variable))
+            _field_checks(generator, field, variable, 2)
+            assignments.append((attribute, variable, True))
+
+    if schema.unknown == RAISE:
+        known = generator.constant("known", frozenset(keys))
+        generator.line(1, "if not data.keys() <= {}:".format(known))
+        generator.line(2, "return _INVALID")
+
+    generator.line(
+        1,
+        "record = {{{}}}".format(
+            ", ".join(
+                "{!r}: {}".format(attribute, variable)
+                for attribute, variable, optional in assignments
+                if not optional
+            )
+        ),
+    )
+    for attribute, variable, optional in assignments:
+        if optional:
+            generator.line(1, "if {} is not _MISSING:".format(variable))
+            generator.line(2, "record[{!r}] = {}".format(attribute, variable))
+    generator.line(1, "return record")
+
+    source = "\n".join(generator.lines) + "\n"
+    exec(  # pylint: disable = exec-used
+        compile(source, "<compiled {}>".format(schema.__class__.__name__), "exec"),
+        generator.namespace,
+    )
+    return generator.namespace["load"], source
+
+
+class CompiledSchema:
+    """
+    marshmallow schema with a generated fast path, see compile_schema
+    """
+
+    def __init__(self, schema: Schema):
+        self.schema = schema
+        self._load: Optional[Callable] = None
+        self.source: Optional[str] = None
+        try:
+            self._load, self.source = _generate(schema)
+        except NotCompilable:
+            # loaded by marshmallow only
+            pass
+
+    @property
+    def compiled(self) -> bool:
+        """
+        True when records are loaded by generated code, False when the schema is only loaded by marshmallow
+        """
+        return self._load is not None
+
+    def load(self, data) -> Dict:
+        """
+        Deserialize and validate a record like schema.load
+
+        Args:
+            data: raw record, e.g. a decoded json object
+
+        Returns:
+            Dict: deserialized record
+
+        Raises:
+            ValidationError: same error as schema.load
+        """
+        if self._load is not None:
+            record = self._load(data)
+            if record is not _INVALID:
+                return record
+        return self.schema.load(data)
+
+    def load_many(self, items: List) -> Tuple[List[Dict], List[Dict]]:
+        """
+        Deserialize and validate many records, an invalid record does not stop the others
+
+        Args:
+            items (List): raw records
+
+        Returns:
+            Tuple[List[Dict], List[Dict]]: valid deserialized records and an error for each invalid record, an error
+                holds the position of the record in items and the marshmallow error messages
+        """
+        fast_load = self._load
+        schema_load = self.schema.load
+        records: List[Dict] = []
+        errors: List[Dict] = []
+        append = records.append
+        for position, item in enumerate(items):
+            if fast_load is not None:
+                record = fast_load(item)
+                if record is not _INVALID:
+                    append(record)
+                    continue
+            try:
+                append(schema_load(item))
+            except ValidationError as error:
+                errors.append(dict(index=position, message=error.messages))
+        return records, errors
+
+
+def compile_schema(schema: Schema) -> CompiledSchema:
+    """
+    Generate the fast path of a schema, call once at import time rather than per request
+
+    Args:
+        schema (Schema): schema instance, its unknown setting applies (use EXCLUDE to drop unknown fields like webargs)
+
+    Returns:
+        CompiledSchema: schema with load and load_many methods
+    """
+    return CompiledSchema(schema)
@@ -0,0 +1,219 @@
+"""
+Write-behind buffer for stock submissions
+
+Validated reports are put on a bounded in-memory queue and a background thread group-commits them to the storage
+backend every STOCK_WRITE_BUFFER_MAX_RECORDS reports or STOCK_WRITE_BUFFER_MAX_DELAY_MS milliseconds, whichever comes
+first. With STOCK_WRITE_BUFFER_ACK = "commit" a request waits for the commit of its group, with "enqueue" it returns as
+soon as its reports are queued (reports still in the queue are lost if the worker is killed).
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ACK_MODES = ("commit", "enqueue")
+
+
+class WriteBufferFull(Exception):
+    """
+    Raised when the queue stays full for longer than the enqueue timeout
+    """
+
+
+class WriteBufferClosed(Exception):
+    """
+    Raised when reports are queued after the buffer was closed, they are to be written synchronously
+    """
+
+
+class _Pending:
+    """
+    Reports of one request waiting in the queue
+    """
+
+    def __init__(self, records: List[Dict], wait: bool):
+        self.records = records
+        # resolved by the background thread once the group of the reports is committed
+        self.committed: Optional[Future] = Future() if wait else None
+
+
+class WriteBuffer:
+    """
+    Bounded queue of stock reports group-committed by a background thread
+    """
+
+    def __init__(
+        self,
+        commit: Callable[[List[Dict]], None],
+        max_records: int = 500,
+        max_delay_ms: float = 20,
+        queue_size: int = 10000,
+        ack: str = "commit",
+        enqueue_timeout: float = 1.0,
+    ):
+        if ack not in ACK_MODES:
+            raise ValueError(
+                "STOCK_WRITE_BUFFER_ACK must be one of {}, got {!r}".format(
+                    ACK_MODES, ack
+                )
+            )
+        self.commit = commit
+        self.max_records = max_records
+        self.max_delay = max_delay_ms / 1000
+        self.ack = ack
+        self.enqueue_timeout = enqueue_timeout
+        self._queue: "queue.Queue[Optional[_Pending]]" = queue.Queue(queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._closed = False
+        # enqueue() calls past the closed check, close() waits for them so no report is queued after the last drain
+        self._n_enqueuing = 0
+        self._state = threading.Condition()
+        atexit.register(self.close)
+
+    def submit(self, records: List[Dict]):
+        """
+        Queue reports to be committed by the background thread
+
+        Args:
+            records (List[Dict]): follow the schema of the StockItemSchema object found in schema.py
+
+        Raises:
+            WriteBufferFull: the queue stayed full for enqueue_timeout seconds
+            Exception: with ack "commit", the error raised by the commit of the group
+        """
+        try:
+            committed = self.enqueue(records)
+        except WriteBufferClosed:
+            # shutting down, write synchronously
+            self.commit(records)
+            return
+        if committed is not None:
+            committed.result()
+
+    def enqueue(
+        self, records: List[Dict], timeout: Optional[float] = None
+    ) -> Optional[Future]:
+        """
+        Queue reports to be committed by the background thread, without waiting for the commit
+
+        Args:
+            records (List[Dict]): follow the schema of the StockItemSchema object found in schema.py
+            timeout (Optional[float]): seconds to wait for room in the queue, enqueue_timeout by default
+
+        Returns:
+            Optional[Future]: with ack "commit", resolved once the reports are committed or failed with the error of
+                the commit, e.g. awaited through asyncio.wrap_future. None with ack "enqueue"
+
+        Raises:
+            WriteBufferFull: the queue stayed full for timeout seconds
+            WriteBufferClosed: the buffer was closed, the reports were not queued
+        """
+        with self._state:
+            if self._closed:
+                raise WriteBufferClosed("Stock write buffer is closed")
+            self._n_enqueuing += 1
+        try:
+            self._ensure_started()
+            pending = _Pending(records, wait=self.ack == "commit")
+            try:
+                self._queue.put(
+                    pending,
+                    timeout=self.enqueue_timeout if timeout is None else timeout,
+                )
+            except queue.Full:
+                raise WriteBufferFull(
+                    "Stock write buffer is full, retry the submission later"
+                )
+            return pending.committed
+        finally:
+            with self._state:
+                self._n_enqueuing -= 1
+                self._state.notify_all()
+
+    def close(self):
+        """
+        Commit every queued report and stop the background thread, registered to run at interpreter exit
+        """
+        with self._state:
+            if self._closed:
+                return
+            self._closed = True
+            self._state.wait_for(lambda: self._n_enqueuing == 0)
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)  # wake the thread up, it drains the queue before stopping
+            self._thread.join()
+
+    def _ensure_started(self):
+        """
+        Start the background thread in this process, lazily so that no thread is forked with the gunicorn master
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="stock-write-buffer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        """
+        Background thread: collect a group of reports then commit it in one storage operation
+        """
+        stopping = False
+        while True:
+            group: List[_Pending] = []
+            n_records = 0
+            deadline = 0.0
+            while n_records < self.max_records:
+                try:
+                    if stopping:
+                        # only drain what is already queued
+                        pending = self._queue.get_nowait()
+                    elif not group:
+                        pending = self._queue.get()
+                    else:
+                        pending = self._queue.get(
+                            timeout=max(deadline - time.monotonic(), 0)
+                        )
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stopping = True
+                    continue
+                if not group:
+                    # the delay of a group starts with its first report
+                    deadline = time.monotonic() + self.max_delay
+                group.append(pending)
+                n_records += len(pending.records)
+
+            if group:
+                self._commit_group(group)
+            if stopping and self._queue.empty():
+                return
+
+    def _commit_group(self, group: List[_Pending]):
+        """
+        Commit the reports of a group and release the requests waiting on it
+        """
+        records = [record for pending in group for record in pending.records]
+        error = None
+        try:
+            self.commit(records)
+        except Exception as commit_error:  # pylint: disable = broad-except
+            logger.exception("Group commit of %s reports failed", len(records))
+            error = commit_error
+
+        for pending in group:
+            if pending.committed is None:
+                continue
+            if error is None:
+                pending.committed.set_result(None)
+            else:
+                pending.committed.set_exception(error)
@@ -0,0 +1,10 @@
+"""
+ASGI entry point of the app, see app/asgi.py
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 4
+"""
+from app import create_app
+from app.asgi import AsgiApp
+
+# Initialise Flask App object wrapped for an ASGI server
+app = AsgiApp(create_app())
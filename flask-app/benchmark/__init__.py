@@ -0,0 +1,10 @@
+"""
+Benchmarks of the stock level API
+
+Generate a synthetic history shaped like db/stock_db.csv, then measure the stock level endpoints against a copy of it:
+    python -m benchmark generate --rows 1000000 --stores 5000 --output /tmp/stock_db.csv
+    python -m benchmark run --dataset /tmp/stock_db.csv --processes 4 --output results.json
+
+Results are written as json (throughput and p50/p95/p99 latency of each scenario), so two commits can be compared with
+a plain diff.
+"""
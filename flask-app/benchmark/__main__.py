@@ -0,0 +1,221 @@
+"""
+Command line of the benchmarks, see benchmark/__init__.py
+
+usage:
+    python -m benchmark generate --rows 100000 --output /tmp/stock_db.csv
+    python -m benchmark run --dataset /tmp/stock_db.csv [--backend columnar] [--processes 4] [--output results.json]
+    python -m benchmark run --url http://localhost:5000 --processes 8
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from app.columnar import convert_csv
+from benchmark.dataset import parse_product_mix, write_csv
+from benchmark.load import (
+    SCENARIOS,
+    Scenario,
+    client_driver,
+    run as run_scenario,
+    run_processes,
+    summarize,
+)
+from config import DbConfig
+
+
+def _git_commit() -> Optional[str]:
+    """
+    Commit of the benchmarked code, None outside a git checkout
+    """
+    try:
+        return (
+            subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+            .stdout.decode("ascii")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _prepare_backend(dataset: str, backend: str, workdir: str) -> Dict:
+    """
+    Copy the dataset to a scratch directory and point the storage settings at it, submissions never touch the
+    original file. Must run before the storage backend is opened.
+    """
+    csv_path = os.path.join(workdir, "stock_db.csv")
+    shutil.copyfile(dataset, csv_path)
+    # config.py is already imported, also set the environment for processes which import it again
+    DbConfig["DB_BACKEND"], DbConfig["DB_FILEPATH"] = backend, csv_path
+    environment = dict(DB_BACKEND=backend, CSV_FILE=csv_path)
+    if backend == "columnar":
+        directory = os.path.join(workdir, "stock_db.columns")
+        convert_csv(csv_path, directory)
+        DbConfig["DB_COLUMNAR_DIR"] = environment["COLUMNAR_DIR"] = directory
+    os.environ.update(environment)
+
+    with open(csv_path, "rb") as history:
+        n_rows = sum(1 for _ in history) - 1
+    return dict(path=os.path.abspath(dataset), rows=n_rows, backend=backend)
+
+
+def _startup_seconds() -> float:
+    """
+    Time to create the app, which opens the storage backend and indexes the history
+    """
+    from app import create_app  # pylint: disable = import-outside-toplevel
+
+    started = time.perf_counter()
+    create_app()
+    return round(time.perf_counter() - started, 3)
+
+
+def run(args) -> Dict:
+    """
+    Run every requested scenario and collect the results
+    """
+    product_mix = parse_product_mix(args.product_mix)
+    output = dict(
+        git_commit=_git_commit(),
+        created=datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%Sz"),
+        python=platform.python_version(),
+        mode="http" if args.url else "client",
+        url=args.url,
+        processes=args.processes,
+        requests_per_process=args.requests,
+        product_mix=product_mix,
+        results={},
+    )
+
+    workdir = None
+    try:
+        if not args.url:
+            workdir = tempfile.mkdtemp(prefix="stock-benchmark-")
+            output["dataset"] = _prepare_backend(args.dataset, args.backend, workdir)
+            output["startup_s"] = _startup_seconds()
+
+        for name in args.scenarios.split(","):
+            scenario_args = (name, product_mix, args.stores)
+            if args.processes == 1 and not args.url:
+                send = client_driver()
+                latencies, errors, elapsed = run_scenario(
+                    send, Scenario(*scenario_args), args.requests
+                )
+                output["results"][name] = summarize(latencies, errors, elapsed)
+            else:
+                output["results"][name] = run_processes(
+                    args.url, scenario_args, args.requests, args.processes
+                )
+    finally:
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return output
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        prog="python -m benchmark", description="Benchmarks of the stock level API"
+    )
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser(
+        "generate", help="write a synthetic history shaped like db/stock_db.csv"
+    )
+    generate.add_argument("--rows", type=int, default=100000, help="number of reports")
+    generate.add_argument(
+        "--stores", type=int, default=1000, help="number of locations"
+    )
+    generate.add_argument(
+        "--product-mix",
+        default="",
+        help="relative weights e.g. toilet_paper=3,milk=1, every product type equally by default",
+    )
+    generate.add_argument(
+        "--days", type=float, default=30, help="time span of the history"
+    )
+    generate.add_argument(
+        "--seed", type=int, default=0, help="seed of the random generator"
+    )
+    generate.add_argument("--output", required=True, help="csv file to create")
+
+    run_command = commands.add_parser(
+        "run", help="measure the stock level endpoints and print the results as json"
+    )
+    target = run_command.add_mutually_exclusive_group(required=True)
+    target.add_argument(
+        "--dataset",
+        help="history to benchmark against with the Flask test client, it is copied first",
+    )
+    target.add_argument(
+        "--url", help="running server to send requests to, e.g. http://localhost:5000"
+    )
+    run_command.add_argument(
+        "--backend",
+        default="csv",
+        choices=["csv", "columnar"],
+        help="storage backend loaded with the dataset",
+    )
+    run_command.add_argument(
+        "--scenarios",
+        default="report,submit",
+        help="comma separated scenarios: report, submit",
+    )
+    run_command.add_argument(
+        "--requests", type=int, default=1000, help="requests per process"
+    )
+    run_command.add_argument(
+        "--processes", type=int, default=1, help="concurrent processes"
+    )
+    run_command.add_argument(
+        "--stores", type=int, default=1000, help="locations of the submitted reports"
+    )
+    run_command.add_argument("--product-mix", default="", help="see generate")
+    run_command.add_argument("--output", help="json file to write, stdout by default")
+
+    args = arg_parser.parse_args(argv)
+    try:
+        parse_product_mix(args.product_mix)
+    except ValueError as error:
+        arg_parser.error(str(error))
+    if args.command == "run":
+        unknown = set(args.scenarios.split(",")) - set(SCENARIOS)
+        if unknown:
+            arg_parser.error(
+                "unknown scenarios {}, use {}".format(sorted(unknown), SCENARIOS)
+            )
+
+    if args.command == "generate":
+        write_csv(
+            args.output,
+            args.rows,
+            n_stores=args.stores,
+            product_mix=parse_product_mix(args.product_mix),
+            seed=args.seed,
+            days=args.days,
+        )
+        print("Wrote {} reports to {}".format(args.rows, args.output))
+        return
+
+    results = json.dumps(run(args), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(results + "\n")
+    else:
+        sys.stdout.write(results + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Synthetic stock report histories shaped like db/stock_db.csv
+"""
+import csv
+import io
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+from app.schema import PRODUCT_TYPES  # product types accepted by the API
+from app.storage import STOCK_COLUMNS
+
+# stores are spread around London like the sample history
+CENTRE = (51.5, -0.12)
+SPREAD_DEGREES = 0.3
+
+
+def parse_product_mix(text: str) -> Dict[str, float]:
+    """
+    Parse relative product weights, e.g. "toilet_paper=3,milk=1"
+
+    Args:
+        text (str): comma separated product_type=weight pairs, an empty string weights every product type equally
+
+    Returns:
+        Dict[str, float]: weight of each product type
+
+    Raises:
+        ValueError: unknown product type or invalid weight
+    """
+    if not text:
+        return {product_type: 1.0 for product_type in PRODUCT_TYPES}
+
+    mix = {}
+    for pair in text.split(","):
+        product_type, _, weight = pair.partition("=")
+        if product_type not in PRODUCT_TYPES:
+            raise ValueError(
+                "Unknown product type {!r}, use one of {}".format(
+                    product_type, PRODUCT_TYPES
+                )
+            )
+        mix[product_type] = float(weight or 1)
+        if mix[product_type] < 0:
+            raise ValueError("Negative weight for {}".format(product_type))
+    if not sum(mix.values()):
+        raise ValueError("The product mix needs a positive weight")
+    return mix
+
+
+class Stores:
+    """
+    Randomly placed stores, each with a geocode and addresses like the geocoder output
+    """
+    def __init__(self, n_stores: int, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.lat = np.round(
+            CENTRE[0] + rng.uniform(-1, 1, n_stores) * SPREAD_DEGREES, 7
+        )
+        self.lng = np.round(
+            CENTRE[1] + rng.uniform(-1, 1, n_stores) * SPREAD_DEGREES, 7
+        )
+        self.geocodes = [
+            "{!r},{!r}".format(float(lat), float(lng))
+            for lat, lng in zip(self.lat, self.lng)
+        ]
+
+    def __len__(self) -> int:
+        return len(self.geocodes)
+
+    def report(self, store: int, product_type: str, timestamp: str, stock_level: int):
+        """
+        Stock report of a store, follows the schema of the StockItemSchema object found in schema.py
+        """
+        return dict(
+            datetime=timestamp,
+            geocode=self.geocodes[store],
+            input_address="store {}".format(store),
+            lat=repr(float(self.lat[store])),
+            lng=repr(float(self.lng[store])),
+            product_type=product_type,
+            resolved_address="{} High St, London, UK".format(store),
+            stock_level=stock_level,
+        )
+
+    def csv_fragments(self) -> List[str]:
+        """
+        Csv encoded geocode, input_address, lat and lng of each store, they are constant for a store
+        """
+        fragments = []
+        for store in range(len(self)):
+            buffer = io.StringIO()
+            report = self.report(store, "", "", 0)
+            csv.writer(buffer, lineterminator="").writerow(
+                [
+                    report[column]
+                    for column in ("geocode", "input_address", "lat", "lng")
+                ]
+            )
+            fragments.append(buffer.getvalue())
+        return fragments
+
+    def csv_addresses(self) -> List[str]:
+        """
+        Csv encoded resolved_address of each store
+        """
+        return [
+            '"{}"'.format(self.report(store, "", "", 0)["resolved_address"])
+            for store in range(len(self))
+        ]
+
+
+def product_weights(product_mix: Dict[str, float]):
+    """
+    Product types and their probabilities, in the same order
+    """
+    product_types = list(product_mix)
+    weights = np.array([product_mix[product_type] for product_type in product_types])
+    return product_types, weights / weights.sum()
+
+
+def generate_lines(
+    n_rows: int,
+    n_stores: int = 1000,
+    product_mix: Optional[Dict[str, float]] = None,
+    seed: int = 0,
+    start: datetime = datetime(2020, 3, 1, tzinfo=timezone.utc),
+    days: float = 30,
+    chunksize: int = 100000,
+) -> Iterator[str]:
+    """
+    Generate csv lines of a history in chronological order, chunk by chunk
+
+    Args:
+        n_rows (int): number of reports
+        n_stores (int): number of distinct locations
+        product_mix (Optional[Dict[str, float]]): weight of each product type, see parse_product_mix
+        seed (int): seed of the random generator, the same arguments always generate the same history
+        start (datetime): datetime of the first report
+        days (float): time span of the history
+        chunksize (int): lines generated at a time
+
+    Returns:
+        Iterator[str]: csv encoded lines following STOCK_COLUMNS, each including its line terminator
+    """
+    rng = np.random.default_rng(seed)
+    stores = Stores(n_stores, seed)
+    product_types, weights = product_weights(product_mix or parse_product_mix(""))
+    locations, addresses = stores.csv_fragments(), stores.csv_addresses()
+
+    first = int(start.timestamp())
+    span = int(days * 86400)
+    for chunk_start in range(0, n_rows, chunksize):
+        size = min(chunksize, n_rows - chunk_start)
+        offsets = np.arange(chunk_start, chunk_start + size) * span // max(n_rows, 1)
+        timestamps = np.datetime_as_string(
+            (first + offsets).astype("datetime64[s]"), unit="s"
+        )
+        store_ids = rng.integers(0, n_stores, size)
+        product_ids = rng.choice(len(product_types), size, p=weights)
+        stock_levels = rng.integers(0, 4, size)
+        yield "".join(
+            "{}z,{},{},{},{}\n".format(
+                timestamp,
+                locations[store],
+                product_types[product],
+                addresses[store],
+                stock_level,
+            )
+            for timestamp, store, product, stock_level in zip(
+                timestamps,
+                store_ids.tolist(),
+                product_ids.tolist(),
+                stock_levels.tolist(),
+            )
+        )
+
+
+def write_csv(path: str, n_rows: int, **kwargs) -> int:
+    """
+    Write a synthetic history file in the format of db/stock_db.csv
+
+    Args:
+        path (str): csv file to create, an existing file is replaced
+        n_rows (int): number of reports
+        **kwargs: see generate_lines
+
+    Returns:
+        int: number of reports written
+    """
+    with open(path, "w") as history:
+        history.write(",".join(STOCK_COLUMNS) + "\n")
+        for lines in generate_lines(n_rows, **kwargs):
+            history.write(lines)
+    return n_rows
+
+
+def current_timestamp() -> str:
+    """
+    Datetime of a report submitted now, in the ISO 8601 format accepted by the API
+    """
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -0,0 +1,215 @@
+"""
+Load generators for the stock level endpoints
+
+A scenario produces the requests, a driver sends them either through the Flask test client of an app created in the
+benchmark process, or over HTTP to a running server. run_processes() runs a driver in several processes at once, like
+several gunicorn workers or clients.
+"""
+import contextlib
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+import numpy as np
+
+from benchmark.dataset import Stores, current_timestamp, product_weights
+
+# (method, path, json body)
+Request = Tuple[str, str, Optional[Dict]]
+
+
+class Scenario:
+    """
+    Random requests to one endpoint
+    """
+    def __init__(
+        self, name: str, product_mix: Dict[str, float], n_stores: int, seed: int = 0
+    ):
+        self.name = name
+        self.product_types, self.weights = product_weights(product_mix)
+        self.stores = Stores(n_stores)
+        self.rng = np.random.default_rng(seed)
+
+    def _product_type(self) -> str:
+        return self.product_types[
+            self.rng.choice(len(self.product_types), p=self.weights)
+        ]
+
+    def request(self) -> Request:
+        """
+        Next request of the scenario
+        """
+        if self.name == "submit":
+            report = self.stores.report(
+                int(self.rng.integers(len(self.stores))),
+                self._product_type(),
+                current_timestamp(),
+                int(self.rng.integers(0, 4)),
+            )
+            return "POST", "/api/v1/stocklevel", report
+        if self.name == "report":
+            query = urlencode(dict(product_type=self._product_type()))
+            return "GET", "/api/v1/stocklevel?" + query, None
+        raise ValueError("Unknown scenario {!r}".format(self.name))
+
+
+SCENARIOS = ("report", "submit")
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> Dict:
+    """
+    Throughput and latency percentiles of a run
+
+    Args:
+        latencies (List[float]): seconds taken by each request
+        errors (int): number of requests which did not answer 200
+        elapsed (float): wall clock seconds of the run
+
+    Returns:
+        Dict: requests, errors, throughput in requests per second and latencies in milliseconds
+    """
+    if not latencies:
+        return dict(requests=0, errors=errors, throughput_rps=0.0)
+    milliseconds = np.asarray(latencies) * 1000
+    p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+    return dict(
+        requests=len(latencies),
+        errors=errors,
+        throughput_rps=round(len(latencies) / elapsed, 1),
+        mean_ms=round(float(milliseconds.mean()), 3),
+        p50_ms=round(float(p50), 3),
+        p95_ms=round(float(p95), 3),
+        p99_ms=round(float(p99), 3),
+        max_ms=round(float(milliseconds.max()), 3),
+    )
+
+
+def client_driver() -> Callable[[Request], int]:
+    """
+    Send requests through the Flask test client of a new app, the storage backend is opened before returning
+    """
+    from app import create_app  # pylint: disable = import-outside-toplevel
+
+    client = create_app().test_client()
+    # per request debug logs would mostly measure the terminal
+    logging.getLogger("app.utils").setLevel(logging.WARNING)
+
+    def send(request: Request) -> int:
+        method, path, body = request
+        return client.open(path, method=method, json=body).status_code
+
+    return send
+
+
+def http_driver(url: str) -> Callable[[Request], int]:
+    """
+    Send requests over a keep-alive HTTP connection to a running server, e.g. http://localhost:5000
+    """
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(
+        parts.hostname or "localhost", parts.port or 80
+    )
+
+    def send(request: Request) -> int:
+        method, path, body = request
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        connection.request(method, parts.path.rstrip("/") + path, data, headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+
+    return send
+
+
+def run(send: Callable[[Request], int], scenario: Scenario, n_requests: int):
+    """
+    Send n_requests requests of a scenario one after the other
+
+    Returns:
+        Tuple[List[float], int, float]: latency of each request, number of errors and elapsed seconds
+    """
+    latencies, errors = [], 0
+    # the app prints request parameters, keep them out of the benchmark output
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        for _ in range(n_requests):
+            request = scenario.request()
+            request_started = time.perf_counter()
+            status = send(request)
+            latencies.append(time.perf_counter() - request_started)
+            if status != 200:
+                errors += 1
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def _worker(url, scenario_args, n_requests, barrier, results):
+    """
+    Process of run_processes: set up a driver, wait for the other processes, then run the scenario
+    """
+    send = http_driver(url) if url else client_driver()
+    scenario = Scenario(*scenario_args)
+    barrier.wait()
+    results.put(run(send, scenario, n_requests))
+
+
+def run_processes(
+    url: Optional[str],
+    scenario_args: Tuple,
+    n_requests: int,
+    processes: int,
+) -> Dict:
+    """
+    Run a scenario in several processes at once
+
+    Every process gets its own driver, i.e. its own app and storage backend with the test client like a gunicorn
+    worker, or its own connection with HTTP. The processes start sending requests together once they are all ready.
+
+    Args:
+        url (Optional[str]): server to send requests to, None to use the Flask test client
+        scenario_args (Tuple): name, product_mix and n_stores of the Scenario, the seed is set per process
+        n_requests (int): number of requests of each process
+        processes (int): number of processes
+
+    Returns:
+        Dict: see summarize, elapsed is the wall clock time of the slowest process
+    """
+    context = multiprocessing.get_context()
+    barrier = context.Barrier(processes)
+    results = context.Queue()
+    workers = [
+        context.Process(
+            target=_worker,
+            args=(url, scenario_args + (seed,), n_requests, barrier, results),
+        )
+        for seed in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    # latencies, errors and elapsed seconds of each process, see run()
+    outcomes: List[Tuple[List[float], int, float]] = []
+    while len(outcomes) < processes:
+        try:
+            outcomes.append(results.get(timeout=1))
+        except queue.Empty:
+            if any(worker.exitcode not in (None, 0) for worker in workers):
+                for worker in workers:
+                    worker.terminate()
+                raise RuntimeError("A benchmark process failed, see its traceback")
+    for worker in workers:
+        worker.join()
+
+    latencies = [latency for outcome in outcomes for latency in outcome[0]]
+    errors = sum(outcome[1] for outcome in outcomes)
+    elapsed = max(outcome[2] for outcome in outcomes)
+    return summarize(latencies, errors, elapsed)
@@ -0,0 +1,30 @@
+"""
+Build time generation of the OpenAPI documents served by the app, e.g. /apispec_1.json, and of the gzip and brotli
+variants of the documents and the Swagger UI assets
+
+usage: python build_openapi.py openapi
+then run the app with OPENAPI_SPEC_DIR=openapi, the workers serve the files instead of building the documents
+"""
+import argparse
+
+from app import create_app
+from app.openapi import write_assets, write_specs
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Write the OpenAPI documents of the app to a directory"
+    )
+    arg_parser.add_argument(
+        "directory",
+        help="output directory, one <endpoint>.json file per document and swagger-ui/ for the assets",
+    )
+    args = arg_parser.parse_args()
+
+    # only the routes are needed, the storage backend is not opened
+    app = create_app(open_store=False)
+    for endpoint, path in write_specs(
+        app, app.extensions["flasgger"], args.directory
+    ).items():
+        print("Wrote {} to {}".format(endpoint, path))
+    n_assets = write_assets(app, app.extensions["flasgger"], args.directory)
+    print("Compressed {} Swagger UI assets".format(n_assets))
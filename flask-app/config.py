@@ -3,6 +3,9 @@
 Define Flask App configuration settings for each environment
 """
 import os
+import tempfile
+
+from typing_extensions import TypedDict
 
 
 def get_db_connection_string() -> str:
@@ -43,6 +46,71 @@ class BaseConfig:
         "specs_route": "/swagger/",
     }
     SQLALCHEMY_DATABASE_URI = get_db_connection_string()
+    # json encoder of the responses: "orjson" (falls back to the stdlib when not installed) or "stdlib"
+    JSON_ENCODER = "orjson"
+    # maximum number of reports accepted by a single /stocklevel/batch request
+    STOCK_BATCH_MAX_RECORDS = 10000
+    # write-behind mode: reports are group-committed by a background thread, see app/write_buffer.py
+    STOCK_WRITE_BUFFER = os.getenv("STOCK_WRITE_BUFFER", "false").lower() == "true"
+    STOCK_WRITE_BUFFER_MAX_RECORDS = 500  # commit a group once it holds this many reports
+    STOCK_WRITE_BUFFER_MAX_DELAY_MS = 20  # or once its first report waited this long
+    STOCK_WRITE_BUFFER_QUEUE_SIZE = 10000  # requests waiting to be committed
+    STOCK_WRITE_BUFFER_ENQUEUE_TIMEOUT = 1.0  # seconds to wait for room in a full queue
+    # "commit": a request returns once its reports are stored, "enqueue": once they are queued
+    STOCK_WRITE_BUFFER_ACK = os.getenv("STOCK_WRITE_BUFFER_ACK", "commit")
+    # prometheus metrics served at /metrics, see app/metrics.py
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+    # directory shared by the gunicorn workers to aggregate their metrics, unset for a single process
+    METRICS_DIR = os.getenv("METRICS_DIR")
+    METRICS_FLUSH_INTERVAL = 1.0  # seconds between two snapshots of the metrics of a worker
+    # per-request profiling, see app/profiling.py: requests with the header "X-Profile: <PROFILING_TOKEN>" and a
+    # PROFILING_SAMPLE_RATE fraction of all requests are profiled, disabled when both are unset
+    PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+    PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+    PROFILING_MODE = os.getenv("PROFILING_MODE", "cprofile")  # "cprofile" or "sampling"
+    PROFILING_INTERVAL_MS = 5  # stack sampling interval of the "sampling" mode
+    PROFILING_DIR = os.getenv("PROFILING_DIR", "profiles")
+    PROFILING_TOP = 5  # functions listed in the X-Profile-Top response header
+    # threads of a worker running Flask under an ASGI server, see app/asgi.py
+    ASGI_THREADS = int(os.getenv("ASGI_THREADS", "32"))
+    # directory of the OpenAPI documents written by build_openapi.py, built on first request when unset or missing
+    OPENAPI_SPEC_DIR = os.getenv("OPENAPI_SPEC_DIR")
+    # seconds clients may reuse the OpenAPI documents and the Swagger UI page, then its assets, before revalidating them
+    OPENAPI_CACHE_MAX_AGE = int(os.getenv("OPENAPI_CACHE_MAX_AGE", "300"))
+    SWAGGER_UI_CACHE_MAX_AGE = int(os.getenv("SWAGGER_UI_CACHE_MAX_AGE", "86400"))
+    # logging of the app, see app/logs.py: records are written to stdout by a background thread of each worker
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG")
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # "text" or "json"
+    # fraction of the requests whose debug records are kept, e.g. the reports received by the stock endpoints
+    LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1.0"))
+    LOG_FLUSH_INTERVAL = 0.1  # seconds between two writes of the collected records
+    LOG_MAX_RECORDS = 10000  # records waiting to be written, more are dropped
+    # deduplication of retried stock submissions, see app/dedup.py: sqlite file shared by the workers of a host, e.g.
+    # on the volume of the history, disabled when empty
+    IDEMPOTENCY_DB = os.getenv("IDEMPOTENCY_DB", "")
+    IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "3600"))  # seconds a submission is remembered
+    IDEMPOTENCY_MAX_KEYS = 100000  # submissions remembered, the oldest are evicted first
+    # admission control of each worker, see app/admission.py: requests beyond the limits of their class wait in a
+    # bounded queue, then are shed with 503 and Retry-After
+    ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "true").lower() == "true"
+    # requests running at once in every class
+    ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "16"))
+    # (running, queued) requests of each class, highest priority first, running plus queued requests of every class
+    # should not exceed the threads of a worker (ASGI_THREADS, gunicorn --threads)
+    ADMISSION_LIMITS = {"write": (12, 8), "read": (12, 6), "other": (2, 2)}
+    ADMISSION_QUEUE_TIMEOUT = 1.0  # seconds a request waits in a queue before being shed
+    ADMISSION_RETRY_AFTER = 1  # seconds, Retry-After header of the shed requests
+    # retention of the stock history, see app/retention.py: the reports older than this many days, but the newest of
+    # each location, are compacted into daily summaries in the background, 0 to keep every report
+    STOCK_RETENTION_DAYS = int(os.getenv("STOCK_RETENTION_DAYS", "0"))
+    STOCK_COMPACTION_INTERVAL = float(os.getenv("STOCK_COMPACTION_INTERVAL", "3600"))  # seconds between compactions
+    # status of the compactions shared by the workers of a host, also locked by the worker compacting
+    STOCK_COMPACTION_STATUS = os.getenv(
+        "STOCK_COMPACTION_STATUS",
+        os.path.join(tempfile.gettempdir(), "stock_compaction.json"),
+    )
+    # GET /stocklevel leaves out the locations whose latest report is older than this many seconds, 0 to show them
+    STOCK_STALE_AFTER = float(os.getenv("STOCK_STALE_AFTER", "0"))
 
 
 class DevConfig(BaseConfig):
@@ -60,6 +128,8 @@ class ProductionConfig(BaseConfig):
     """
 
     FLASK_ENV = "production"
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+    LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.01"))
 
 
 class TestConfig(BaseConfig):
@@ -75,4 +145,41 @@ class TestConfig(BaseConfig):
 # class DbConfig:
 #     DB_FILEPATH = "stock_db.csv"
 
-DbConfig = dict(DB_FILEPATH=os.getenv("CSV_FILE", "flask/db/stock_db.csv"))
+class DbSettings(TypedDict):
+    """
+    Settings of the storage backend
+    """
+
+    DB_BACKEND: str
+    DB_FILEPATH: str
+    DB_COLUMNAR_DIR: str
+    DB_FSYNC: str
+    DB_FSYNC_INTERVAL: float
+    GEO_CELL_SIZE: float
+    DB_URI: str
+    DB_POOL_SIZE: int
+    DB_POOL_MAX_OVERFLOW: int
+    DB_POOL_RECYCLE: int
+    DB_EXECUTOR_THREADS: int
+
+
+DbConfig = DbSettings(
+    # storage backend of the stock reports: "csv", "columnar" or "sql"
+    DB_BACKEND=os.getenv("DB_BACKEND", "csv"),
+    DB_FILEPATH=os.getenv("CSV_FILE", "flask/db/stock_db.csv"),
+    # directory of the columnar history, convert the csv history with convert_to_columnar.py
+    DB_COLUMNAR_DIR=os.getenv("COLUMNAR_DIR", "flask/db/stock_db.columns"),
+    # fsync policy of the history files: "always" (every write), "interval" (at most every DB_FSYNC_INTERVAL seconds)
+    # or "never" (leave it to the OS)
+    DB_FSYNC=os.getenv("CSV_FSYNC", "interval"),
+    DB_FSYNC_INTERVAL=float(os.getenv("CSV_FSYNC_INTERVAL", "1.0")),
+    # size in degrees of the cells of the spatial grid over the latest reports (0.05 is about 5km)
+    GEO_CELL_SIZE=float(os.getenv("GEO_CELL_SIZE", "0.05")),
+    # SQLAlchemy url of the sql backend, e.g. "sqlite:///db/stock_db.sqlite" locally, defaults to the postgres service
+    DB_URI=os.getenv("DB_URI", BaseConfig.SQLALCHEMY_DATABASE_URI),
+    DB_POOL_SIZE=int(os.getenv("DB_POOL_SIZE", "5")),
+    DB_POOL_MAX_OVERFLOW=int(os.getenv("DB_POOL_MAX_OVERFLOW", "10")),
+    DB_POOL_RECYCLE=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    # threads running the blocking storage calls of the async endpoints in each worker process, see AsyncStockStore
+    DB_EXECUTOR_THREADS=int(os.getenv("DB_EXECUTOR_THREADS", "8")),
+)
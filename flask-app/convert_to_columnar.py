@@ -0,0 +1,24 @@
+"""
+One shot conversion of the csv stock report history to the columnar format read by DB_BACKEND=columnar
+
+usage: python convert_to_columnar.py db/stock_db.csv db/stock_db.columns
+"""
+import argparse
+
+from app.columnar import convert_csv
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Convert a csv stock report history to the columnar format"
+    )
+    arg_parser.add_argument("csv_path", help="csv history file, e.g. db/stock_db.csv")
+    arg_parser.add_argument(
+        "directory", help="columnar history directory, rows are appended to it"
+    )
+    arg_parser.add_argument(
+        "--chunksize", type=int, default=1000000, help="rows converted at a time"
+    )
+    args = arg_parser.parse_args()
+
+    n_rows = convert_csv(args.csv_path, args.directory, args.chunksize)
+    print("Converted {} rows to {}".format(n_rows, args.directory))
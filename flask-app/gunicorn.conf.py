@@ -0,0 +1,47 @@
+"""
+gunicorn settings of the app: gunicorn main:app (the file is read from the working directory)
+
+The app is created once in the master (preload_app) and the workers are forked from it, so the imported modules, the
+storage index and the OpenAPI documents are shared copy-on-write instead of being rebuilt by every worker. The
+threads, event loops, metrics and database connections of a worker are created lazily after the fork.
+"""
+import gc
+import os
+import shutil
+import tempfile
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# /metrics sums the snapshots the workers write to METRICS_DIR (see app/metrics.py), read by config.py once this file
+# is loaded: without one, a directory of this run is used and removed on exit
+_metrics_dir = None
+if workers > 1 and not os.getenv("METRICS_DIR"):
+    _metrics_dir = os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="stock-metrics-")
+
+
+def when_ready(server):
+    """
+    Master: build what every worker would otherwise build on its first request
+    """
+    if preload_app:
+        from app.openapi import load_specs  # pylint: disable = import-outside-toplevel
+
+        load_specs(server.app.wsgi())
+
+
+def pre_fork(server, worker):  # pylint: disable = unused-argument
+    """
+    Master: move the objects allocated so far to the permanent generation of the garbage collector, collections in a
+    worker then never write to (and copy) the pages shared with the master
+    """
+    gc.freeze()
+
+
+def on_exit(server):  # pylint: disable = unused-argument
+    """
+    Master: remove the metrics directory of this run
+    """
+    if _metrics_dir is not None:
+        shutil.rmtree(_metrics_dir, ignore_errors=True)
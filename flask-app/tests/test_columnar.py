@@ -0,0 +1,90 @@
+"""
+Dictionaries of the columnar history shared by threads, see app/columnar.py
+"""
+import threading
+
+from app.columnar import DICTIONARY_COLUMNS, ColumnarHistory
+
+
+def _columns(geocodes):
+    return dict(
+        {
+            name: ["{} {}".format(name, geocode) for geocode in geocodes]
+            for name in DICTIONARY_COLUMNS
+        },
+        datetime=[1583434491] * len(geocodes),
+        lat=[51.5] * len(geocodes),
+        lng=[-0.1] * len(geocodes),
+        stock_level=[2] * len(geocodes),
+    )
+
+
+def _run(target, args_list):
+    threads = [threading.Thread(target=target, args=args) for args in args_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_concurrent_dictionary_loads(tmp_path):
+    directory = str(tmp_path / "stock_db.columns")
+    history = ColumnarHistory(directory)
+    # another worker appends to the dictionaries between the loads of the request threads
+    other = ColumnarHistory(directory)
+    batches = iter(
+        [
+            ["g{}_{}".format(batch, number) for number in range(50)]
+            for batch in range(200)
+        ]
+    )
+    barrier = threading.Barrier(8, action=lambda: other.append(_columns(next(batches))))
+
+    def load():
+        for _ in range(200):
+            barrier.wait()
+            history.dictionary("geocode")
+
+    _run(load, [()] * 8)
+
+    values = history.dictionary("geocode")
+    assert values == ColumnarHistory(directory).dictionary("geocode")
+    assert len(values) == len(set(values)) == 200 * 50
+
+
+def test_concurrent_appends_and_decodes(tmp_path):
+    directory = str(tmp_path / "stock_db.columns")
+    history = ColumnarHistory(directory)
+    # each thread appends geocodes of its own and geocodes shared with the other threads
+    parts = [
+        [
+            ["g{}_{}".format(number, position), "g{}".format(position % 7)]
+            for position in range(40)
+        ]
+        for number in range(6)
+    ]
+
+    def append(part):
+        for geocodes in part:
+            history.append(_columns(geocodes))
+            n_rows = history.row_count()
+            codes = history.columns(n_rows)["geocode"]
+            for code in codes[-2:]:
+                history.decode("geocode", int(code))
+
+    _run(append, [(part,) for part in parts])
+
+    values = history.dictionary("geocode")
+    assert len(values) == len(set(values)) == 6 * 40 + 7
+    columns = history.columns(history.row_count())
+    decoded = sorted(
+        history.decode("geocode", int(code)) for code in columns["geocode"]
+    )
+    expected = sorted(
+        "geocode {}".format(geocode)
+        for part in parts
+        for geocodes in part
+        for geocode in geocodes
+    )
+    assert decoded == expected
+    assert ColumnarHistory(directory).dictionary("geocode") == values
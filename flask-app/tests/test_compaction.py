@@ -0,0 +1,135 @@
+"""
+Compaction of the stock history, see StockStore.compact
+"""
+import os
+import random
+import shutil
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.storage import DATETIME_FORMAT, CsvStockStore, SqlStockStore
+
+PRODUCT_TYPES = ["toilet_paper", "pasta"]
+NOW = datetime(2020, 4, 1)
+CUTOFF = datetime(2020, 3, 20)
+
+
+def _reports(n_reports: int, seed: int):
+    rng = random.Random(seed)
+    reports = []
+    for _ in range(n_reports):
+        made = NOW - timedelta(seconds=rng.randrange(40 * 86400))
+        reports.append(
+            dict(
+                datetime=made.strftime(DATETIME_FORMAT),
+                geocode="g{}".format(rng.randrange(40)),
+                input_address="1 High Street",
+                lat="51.5",
+                lng="-0.1",
+                product_type=rng.choice(PRODUCT_TYPES),
+                resolved_address="1 High Street, London",
+                stock_level=rng.randrange(4),
+            )
+        )
+    # a location only reported before the cutoff keeps its newest report
+    reports.append(dict(reports[0], geocode="g_old", datetime="2020-02-25T10:00:00z"))
+    reports.append(dict(reports[0], geocode="g_old", datetime="2020-02-26T10:00:00z"))
+    return reports
+
+
+def _key(record):
+    return (
+        record["product_type"],
+        record["geocode"],
+        record["datetime"],
+        str(record["stock_level"]),
+    )
+
+
+def _history(store, bucket):
+    return {
+        (product_type, geocode): store.history(
+            product_type, geocode, bucket, NOW - timedelta(days=60), NOW
+        )
+        for product_type in PRODUCT_TYPES
+        for geocode in ["g0", "g1", "g7", "g_old"]
+    }
+
+
+def _snapshot(store):
+    cutoff = CUTOFF.strftime(DATETIME_FORMAT)
+    snapshot = dict(
+        latest={pt: sorted(map(_key, store.latest(pt))) for pt in PRODUCT_TYPES},
+        versions={pt: store.version(pt)[0] for pt in PRODUCT_TYPES},
+        day=_history(store, "day"),
+        # exact after the cutoff only
+        hour={
+            location: [bucket for bucket in buckets if bucket["bucket_start"] >= cutoff]
+            for location, buckets in _history(store, "hour").items()
+        },
+        as_of={},
+    )
+    for days in [0, 3, 8, 11]:
+        for product_type in PRODUCT_TYPES:
+            records = store.as_of(product_type, CUTOFF + timedelta(days=days))
+            snapshot["as_of"][(product_type, days)] = sorted(map(_key, records))
+    return snapshot
+
+
+STORES = {
+    "csv": lambda directory: CsvStockStore(os.path.join(directory, "stock_db.csv")),
+    "sql": lambda directory: SqlStockStore(
+        "sqlite:///" + os.path.join(directory, "stock.sqlite")
+    ),
+}
+
+
+@pytest.mark.parametrize("backend", sorted(STORES))
+def test_compact_keeps_results(tmp_path, backend):
+    make = STORES[backend]
+    reports = _reports(3000, seed=1)
+    store = make(str(tmp_path))
+    for position in range(0, len(reports), 500):
+        store.submit(reports[position : position + 500])
+    before = _snapshot(store)
+
+    result = store.compact(CUTOFF, lambda fraction: None)
+    assert result["reports_compacted"] > 0
+
+    for compacted in [store, make(str(tmp_path))]:
+        after = _snapshot(compacted)
+        assert after["latest"] == before["latest"]
+        assert after["versions"] == before["versions"]
+        assert after["day"] == before["day"]
+        assert after["hour"] == before["hour"]
+        for query, records in before["as_of"].items():
+            cutoff = CUTOFF.strftime(DATETIME_FORMAT)
+            kept = [record for record in records if record[2] >= cutoff]
+            # the newest report of each location made before the cutoff is kept
+            assert set(after["as_of"][query]) <= set(records)
+            assert [
+                record for record in after["as_of"][query] if record[2] >= cutoff
+            ] == kept
+
+    # nothing left to compact
+    assert store.compact(CUTOFF, lambda fraction: None)["reports_compacted"] == 0
+
+
+def test_compacted_history_is_indexed_without_the_lock(tmp_path):
+    path = str(tmp_path / "stock_db.csv")
+    store = CsvStockStore(path)
+    store.submit(_reports(200, seed=2))
+    latest = sorted(map(_key, store.latest("pasta")))
+
+    replacement = str(tmp_path / "replacement.csv")
+    other = CsvStockStore(replacement)
+    other.submit(_reports(100, seed=3))
+    new_latest = sorted(map(_key, other.latest("pasta")))
+    shutil.copy(replacement, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+    # another thread is indexing the replaced history: the current index answers meanwhile
+    with store._rebuild_lock:  # pylint: disable = protected-access
+        assert sorted(map(_key, store.latest("pasta"))) == latest
+    assert sorted(map(_key, store.latest("pasta"))) == new_latest
@@ -0,0 +1,56 @@
+"""
+Claims of the submissions in the DedupCache, see app/dedup.py
+"""
+import sqlite3
+
+import pytest
+
+from app import dedup
+from app.dedup import DedupCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DedupCache(str(tmp_path / "keys.sqlite"), ttl=3600, max_keys=100)
+
+
+def test_retry_of_a_pending_submission_is_not_acknowledged(cache):
+    assert cache.claim("key:a", "f1") is None
+    assert cache.claim("key:a", "f1") == ("f1", False)
+    cache.complete("key:a")
+    assert cache.claim("key:a", "f1") == ("f1", True)
+    assert cache.claim("key:a", "f2") == ("f1", True)
+
+
+def test_released_key_is_claimed_again(cache):
+    assert cache.claim("key:a", "f1") is None
+    cache.release("key:a")
+    assert cache.claim("key:a", "f1") is None
+    cache.complete("key:a")
+    # a written submission is not forgotten
+    cache.release("key:a")
+    assert cache.claim("key:a", "f1") == ("f1", True)
+
+
+def test_abandoned_claim_expires(cache, monkeypatch):
+    monkeypatch.setattr(dedup, "PENDING_TTL", -1)
+    assert cache.claim("key:a", "f1") is None
+    # e.g. the worker was killed before writing the report
+    assert cache.claim("key:a", "f1") is None
+
+
+def test_keys_of_an_older_database_are_done(tmp_path):
+    path = str(tmp_path / "keys.sqlite")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE idempotency_keys ("
+        "key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, expires REAL NOT NULL"
+        ") WITHOUT ROWID"
+    )
+    connection.execute("INSERT INTO idempotency_keys VALUES ('key:a', 'f1', 1e12)")
+    connection.commit()
+    connection.close()
+
+    cache = DedupCache(path, ttl=3600, max_keys=100)
+    assert cache.claim("key:a", "f1") == ("f1", True)
+    assert cache.claim("key:b", "f1") is None
@@ -0,0 +1,168 @@
+"""
+LatestStockIndex read by request threads while reports are added, see IndexedStockStore.refresh
+"""
+import random
+import threading
+
+from app.index import LatestStockIndex
+from app.storage import CsvStockStore
+
+PRODUCT_TYPES = ["toilet_paper", "pasta"]
+BBOX = (51.0, -1.0, 52.0, 1.0)
+
+
+def _reports(n_reports: int, seed: int):
+    rng = random.Random(seed)
+    return [
+        dict(
+            datetime="2020-03-{:02d}T{:02d}:{:02d}:00z".format(
+                rng.randrange(1, 29), rng.randrange(24), rng.randrange(60)
+            ),
+            geocode="g{}".format(rng.randrange(300)),
+            input_address="1 High Street",
+            lat="{:.4f}".format(51.0 + rng.random()),
+            lng="{:.4f}".format(rng.random() - 0.5),
+            product_type=rng.choice(PRODUCT_TYPES),
+            resolved_address="1 High Street, London",
+            stock_level=rng.randrange(4),
+        )
+        for _ in range(n_reports)
+    ]
+
+
+def _read_concurrently(read, writer, n_readers=4):
+    """
+    Call read in a loop from reader threads until writer returns, the errors of the readers are returned
+    """
+    done = threading.Event()
+    errors = []
+
+    def reader():
+        try:
+            while not done.is_set():
+                read()
+        except Exception as error:  # pylint: disable = broad-except
+            errors.append(error)
+
+    readers = [threading.Thread(target=reader) for _ in range(n_readers)]
+    for thread in readers:
+        thread.start()
+    try:
+        writer()
+    finally:
+        done.set()
+        for thread in readers:
+            thread.join()
+    return errors
+
+
+def _check_reads(index, versions):
+    for product_type in PRODUCT_TYPES:
+        version, _ = index.version(product_type)
+        assert version >= versions.get(product_type, 0)
+        versions[product_type] = version
+
+        records = index.latest(product_type)
+        assert all(record["product_type"] == product_type for record in records)
+        assert len({record["geocode"] for record in records}) == len(records)
+        dates = [record["datetime"] for record in records]
+        assert dates == sorted(dates, reverse=True)
+
+        page = index.page(product_type, "g1", 50)
+        geocodes = [record["geocode"] for record in page]
+        assert geocodes == sorted(set(geocodes)) and all(g > "g1" for g in geocodes)
+
+        for record in index.within(product_type, BBOX):
+            assert record["product_type"] == product_type
+        list(index.iter_latest(product_type))
+    index.counts()
+
+
+def _expected(reports):
+    index = LatestStockIndex()
+    for record in reports:
+        index.add(record)
+    return index
+
+
+def test_concurrent_add_and_reads():
+    reports = [
+        dict(record, lat=float(record["lat"]), lng=float(record["lng"]))
+        for record in _reports(20000, seed=1)
+    ]
+    index = LatestStockIndex(cell_size=0.05)
+    lock = threading.Lock()
+
+    def writer():
+        for position in range(0, len(reports), 100):
+            # like refresh(), writers hold the lock of the store, readers do not
+            with lock:
+                for record in reports[position : position + 100]:
+                    index.add(record)
+
+    readers_versions = threading.local()
+
+    def read():
+        if not hasattr(readers_versions, "versions"):
+            readers_versions.versions = {}
+        _check_reads(index, readers_versions.versions)
+
+    assert _read_concurrently(read, writer) == []
+
+    expected = _expected(reports)
+    for product_type in PRODUCT_TYPES:
+        assert index.version(product_type) == expected.version(product_type)
+        assert index.latest(product_type) == expected.latest(product_type)
+        assert index.page(product_type, None, 1000) == expected.page(
+            product_type, None, 1000
+        )
+        assert sorted(
+            record["geocode"] for record in index.within(product_type, BBOX)
+        ) == sorted(record["geocode"] for record in expected.within(product_type, BBOX))
+    assert index.matrix(PRODUCT_TYPES) == expected.matrix(PRODUCT_TYPES)
+
+
+def test_refresh_while_reading(tmp_path):
+    path = str(tmp_path / "stock_db.csv")
+    reports = _reports(6000, seed=2)
+    store = CsvStockStore(path)
+    # the reports are appended by other workers, the store picks them up on refresh
+    writers = [CsvStockStore(path) for _ in range(3)]
+
+    def submit(worker, part):
+        for position in range(0, len(part), 50):
+            worker.submit(part[position : position + 50])
+
+    def writer():
+        threads = [
+            threading.Thread(target=submit, args=(worker, reports[number::3]))
+            for number, worker in enumerate(writers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    readers_versions = threading.local()
+
+    def read():
+        if not hasattr(readers_versions, "versions"):
+            readers_versions.versions = {}
+        store.refresh()
+        _check_reads(store.index, readers_versions.versions)
+
+    assert _read_concurrently(read, writer) == []
+
+    expected = CsvStockStore(str(tmp_path / "expected.csv"))
+    expected.submit(reports)
+
+    for product_type in PRODUCT_TYPES:
+        assert store.version(product_type)[0] == expected.version(product_type)[0]
+        # of reports of a location made at the same time, the last one written wins, so only the times are compared
+        assert {
+            record["geocode"]: record["datetime"]
+            for record in store.latest(product_type)
+        } == {
+            record["geocode"]: record["datetime"]
+            for record in expected.latest(product_type)
+        }
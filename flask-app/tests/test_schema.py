@@ -0,0 +1,37 @@
+"""
+Query string of the stock level history, see StockHistoryQuerySchema
+"""
+import pytest
+from marshmallow import ValidationError
+
+from app.schema import StockHistoryQuerySchema
+
+QUERY = {"geocode": "abc", "product_type": "milk"}
+
+
+@pytest.mark.parametrize(
+    "start, end",
+    [
+        ("2020-01-01T00:00:00", "2020-01-02T00:00:00Z"),
+        ("2020-01-01T00:00:00Z", "2020-01-02T00:00:00"),
+        # 23:00 UTC
+        ("2020-01-02T00:00:00+01:00", "2020-01-02T00:00:00"),
+    ],
+)
+def test_naive_and_aware_range(start, end):
+    data = StockHistoryQuerySchema().load(dict(QUERY, start=start, end=end))
+    assert data["geocode"] == "abc"
+
+
+@pytest.mark.parametrize(
+    "start, end",
+    [
+        ("2020-01-02T00:00:00", "2020-01-01T00:00:00Z"),
+        ("2020-01-02T00:00:00Z", "2020-01-01T00:00:00"),
+        ("2020-01-02T00:00:00", "2020-01-02T00:00:00+01:00"),
+    ],
+)
+def test_naive_and_aware_range_ending_before_start(start, end):
+    with pytest.raises(ValidationError) as error:
+        StockHistoryQuerySchema().load(dict(QUERY, start=start, end=end))
+    assert error.value.messages == {"_schema": ["start must be before end"]}
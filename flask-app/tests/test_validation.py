@@ -0,0 +1,191 @@
+"""
+Parity of the compiled validation of app/validation.py with marshmallow
+"""
+import copy
+import random
+
+import pytest
+from marshmallow import EXCLUDE, RAISE, Schema, ValidationError, fields, validate
+
+from app.schema import StockItemSchema
+from app.validation import compile_schema
+
+VALID_ITEM = {
+    "datetime": "2020-03-05T18:54:51Z",
+    "geocode": "gcpvj0",
+    "input_address": "1 High Street",
+    "lat": "51.5",
+    "lng": "-0.1",
+    "product_type": "milk",
+    "resolved_address": "1 High Street, London",
+    "stock_level": 2,
+}
+
+
+class OptionalFieldsSchema(Schema):
+    """
+    Schema using the other fields and validators the compiler supports
+    """
+
+    name = fields.Str(required=True, validate=validate.Length(min=1, max=8))
+    code = fields.Str(data_key="Code", validate=validate.Length(equal=3))
+    score = fields.Float(validate=validate.Range(min=0, max=1, max_inclusive=False))
+    count = fields.Int(attribute="n", validate=validate.Range(min=1))
+
+
+def _load(load, item):
+    """
+    Loaded record, or the error messages, of an item
+    """
+    try:
+        return "record", load(item)
+    except ValidationError as error:
+        return "error", error.messages
+
+
+def _with(**changes):
+    item = dict(VALID_ITEM)
+    for key, value in changes.items():
+        if value is KeyError:
+            del item[key]
+        else:
+            item[key] = value
+    return item
+
+
+STOCK_ITEMS = [
+    VALID_ITEM,
+    _with(datetime="2020-03-05T18:54:51.123Z"),
+    _with(datetime="2020-03-05T18:54:51.1234567Z"),
+    _with(datetime="2020-03-05T18:54:51+01:00"),
+    _with(datetime="2020-03-05T18:54:51"),
+    _with(datetime="2020-02-30T18:54:51Z"),
+    _with(datetime="yesterday"),
+    _with(datetime=1583434491),
+    _with(stock_level=0),
+    _with(stock_level=3),
+    _with(stock_level=4),
+    _with(stock_level=-1),
+    _with(stock_level="2"),
+    _with(stock_level=2.0),
+    _with(stock_level=2.5),
+    _with(stock_level=True),
+    _with(stock_level=None),
+    _with(product_type="caviar"),
+    _with(product_type=None),
+    _with(lat=51.5),
+    _with(lng=None),
+    _with(geocode=""),
+    _with(geocode=KeyError),
+    _with(datetime=KeyError, stock_level=KeyError),
+    _with(unknown="field"),
+    {},
+    [],
+    "not an object",
+    None,
+]
+
+
+@pytest.mark.parametrize("unknown", [EXCLUDE, RAISE])
+@pytest.mark.parametrize("item", STOCK_ITEMS)
+def test_stock_item_parity(item, unknown):
+    schema = StockItemSchema(unknown=unknown)
+    compiled = compile_schema(schema)
+    assert compiled.compiled
+    assert _load(compiled.load, copy.deepcopy(item)) == _load(
+        schema.load, copy.deepcopy(item)
+    )
+
+
+@pytest.mark.parametrize(
+    "item",
+    [
+        {"name": "a"},
+        {"name": "abcdefgh", "Code": "abc", "score": 0.5, "count": 3},
+        {"name": ""},
+        {"name": "abcdefghi"},
+        {"name": "a", "Code": "ab"},
+        {"name": "a", "code": "abc"},
+        {"name": "a", "score": 1.0},
+        {"name": "a", "score": 0},
+        {"name": "a", "score": float("nan")},
+        {"name": "a", "score": float("inf")},
+        {"name": "a", "count": 0},
+        {"name": "a", "count": 1.0},
+        {"name": "a", "n": 1},
+    ],
+)
+def test_optional_fields_parity(item):
+    schema = OptionalFieldsSchema(unknown=EXCLUDE)
+    compiled = compile_schema(schema)
+    assert compiled.compiled
+    assert _load(compiled.load, dict(item)) == _load(schema.load, dict(item))
+
+
+def test_fast_path_is_used(monkeypatch):
+    schema = StockItemSchema(unknown=EXCLUDE)
+    expected = schema.load(dict(VALID_ITEM))
+    compiled = compile_schema(schema)
+
+    def fail(_):
+        raise AssertionError("valid item loaded by marshmallow")
+
+    monkeypatch.setattr(schema, "load", fail)
+    assert compiled.load(dict(VALID_ITEM)) == expected
+    assert compiled.load_many([dict(VALID_ITEM)]) == ([expected], [])
+
+
+def test_unsupported_schema_is_loaded_by_marshmallow():
+    class NestedSchema(Schema):
+        items = fields.List(fields.Str())
+
+    compiled = compile_schema(NestedSchema())
+    assert not compiled.compiled
+    assert compiled.load({"items": ["a"]}) == {"items": ["a"]}
+
+
+def test_random_mutations_parity():
+    """
+    Records with random fields replaced by values of other types or out of range
+    """
+    schema = StockItemSchema(unknown=EXCLUDE)
+    compiled = compile_schema(schema)
+    values = [
+        None,
+        "",
+        "milk",
+        "2020-03-05T18:54:51Z",
+        0,
+        3,
+        7,
+        -2,
+        1.5,
+        True,
+        [],
+        {},
+    ]
+    rng = random.Random(0)
+    for _ in range(2000):
+        item = dict(VALID_ITEM)
+        for key in rng.sample(sorted(item), rng.randint(1, 3)):
+            if rng.random() < 0.2:
+                del item[key]
+            else:
+                item[key] = rng.choice(values)
+        assert _load(compiled.load, dict(item)) == _load(schema.load, dict(item))
+
+
+def test_load_many_parity():
+    schema = StockItemSchema(unknown=EXCLUDE)
+    compiled = compile_schema(schema)
+    records, errors = compiled.load_many(copy.deepcopy(STOCK_ITEMS))
+
+    expected_records, expected_errors = [], []
+    for position, item in enumerate(STOCK_ITEMS):
+        kind, result = _load(schema.load, copy.deepcopy(item))
+        if kind == "record":
+            expected_records.append(result)
+        else:
+            expected_errors.append(dict(index=position, message=result))
+    assert records == expected_records
+    assert errors == expected_errors
@@ -0,0 +1,81 @@
+"""
+Group commits of the write buffer and its shutdown, see app/write_buffer.py
+"""
+import atexit
+import threading
+
+import pytest
+
+from app.write_buffer import WriteBuffer, WriteBufferClosed
+
+
+class Commits:
+    """
+    Commit function recording the groups committed
+    """
+
+    def __init__(self):
+        self.groups = []
+        self._lock = threading.Lock()
+
+    def __call__(self, records):
+        with self._lock:
+            self.groups.append(list(records))
+
+    def records(self):
+        return sorted(record for group in self.groups for record in group)
+
+
+def test_registered_at_exit_once(monkeypatch):
+    registered = []
+    monkeypatch.setattr(atexit, "register", registered.append)
+    commits = Commits()
+    buffer = WriteBuffer(commits)
+    buffer.submit([1])
+    # the thread stops, e.g. it is not running in a forked worker, and is started again
+    thread = buffer._thread  # pylint: disable = protected-access
+    buffer._queue.put(None)  # pylint: disable = protected-access
+    thread.join()
+    buffer.submit([2])
+    assert buffer._thread is not thread  # pylint: disable = protected-access
+    assert registered == [buffer.close]
+    buffer.close()
+    assert commits.records() == [1, 2]
+
+
+def test_closed_buffer_writes_synchronously():
+    commits = Commits()
+    buffer = WriteBuffer(commits)
+    buffer.submit([1])
+    buffer.close()
+
+    with pytest.raises(WriteBufferClosed):
+        buffer.enqueue([2])
+    buffer.submit([3])
+    assert commits.groups[-1] == [3]
+    assert commits.records() == [1, 3]
+    # no thread was started again
+    assert not buffer._thread.is_alive()  # pylint: disable = protected-access
+
+
+def test_close_commits_concurrent_submissions():
+    commits = Commits()
+    buffer = WriteBuffer(commits, max_records=7, max_delay_ms=1, queue_size=5)
+    closing = threading.Event()
+
+    def submit(number):
+        for position in range(200):
+            if position == 50 and number == 0:
+                closing.set()
+            buffer.submit([(number, position)])
+
+    threads = [threading.Thread(target=submit, args=(number,)) for number in range(4)]
+    for thread in threads:
+        thread.start()
+    closing.wait()
+    buffer.close()
+    for thread in threads:
+        thread.join()
+    assert commits.records() == sorted(
+        (number, position) for number in range(4) for position in range(200)
+    )
@@ -13,3 +13,55 @@ CREATE TABLE IF NOT EXISTS codes_mcc_all (
         usda_description VARCHAR(255),
         PRIMARY KEY (code)
 );
+
+-- Stock level reports, see SqlStockStore in flask-app/app/storage.py
+CREATE TABLE IF NOT EXISTS stock_report (
+        id BIGSERIAL NOT NULL,
+        datetime TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        geocode VARCHAR(64) NOT NULL,
+        input_address VARCHAR(255),
+        lat FLOAT NOT NULL,
+        lng FLOAT NOT NULL,
+        product_type VARCHAR(32) NOT NULL,
+        resolved_address VARCHAR(255),
+        stock_level SMALLINT NOT NULL,
+        PRIMARY KEY (id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_stock_report_latest ON stock_report (product_type, geocode, datetime);
+CREATE INDEX IF NOT EXISTS ix_stock_report_position ON stock_report (product_type, lat, lng);
+
+-- Version of the stock reports of each product type, bumped with every insert into stock_report
+CREATE TABLE IF NOT EXISTS stock_version (
+        product_type VARCHAR(32) NOT NULL,
+        version BIGINT NOT NULL,
+        modified TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        PRIMARY KEY (product_type)
+);
+
+-- Hourly and daily aggregates of the stock level of each location, updated with every insert into stock_report
+CREATE TABLE IF NOT EXISTS stock_hourly (
+        product_type VARCHAR(32) NOT NULL,
+        geocode VARCHAR(64) NOT NULL,
+        bucket_start TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        count INTEGER NOT NULL,
+        min SMALLINT NOT NULL,
+        max SMALLINT NOT NULL,
+        sum BIGINT NOT NULL,
+        last_datetime TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        last_stock_level SMALLINT NOT NULL,
+        PRIMARY KEY (product_type, geocode, bucket_start)
+);
+
+CREATE TABLE IF NOT EXISTS stock_daily (
+        product_type VARCHAR(32) NOT NULL,
+        geocode VARCHAR(64) NOT NULL,
+        bucket_start TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        count INTEGER NOT NULL,
+        min SMALLINT NOT NULL,
+        max SMALLINT NOT NULL,
+        sum BIGINT NOT NULL,
+        last_datetime TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        last_stock_level SMALLINT NOT NULL,
+        PRIMARY KEY (product_type, geocode, bucket_start)
+);